@@ -0,0 +1,85 @@
+import statistics
+from datetime import datetime, timezone, timedelta
+
+from database import Database
+
+#
+# Heating analytics for a room, computed from the temperature history
+# (see Database.get_daily_room_stats and Database.get_setpoint_episodes)
+#
+#  - duty cycle: the fraction of the time the room was calling for heat
+#  - degree days: how much colder than base (degC) it was outside each day,
+#    so heating hours per degree day compares heating demand across weather
+#  - time to setpoint: how long the room took to warm up after the setpoint was raised
+#
+
+BASE_TEMPERATURE = 15.5           # degC, for heating degree days
+MAX_GAP = 600                     # seconds, longer gaps between samples are not counted
+MAX_EPISODES = 100                # most recent time to setpoint episodes returned
+
+def _seconds(start,end):
+  return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+def roomAnalytics(thermostat,date_from=None,date_to=None,base=BASE_TEMPERATURE):
+  if date_from is None:
+    date_from = (datetime.now(timezone.utc).astimezone() - timedelta(days=14)).isoformat()
+  if date_to is None:
+    date_to = datetime.now(timezone.utc).astimezone().isoformat()
+
+  db = Database()
+  if not db.sqlHistory():
+    raise NotImplementedError('Analytics need the history in the database, they are not available with BESIM_SEGMENTS')
+  conn = db.get_connection()
+  try:
+    with conn.transaction():      # both from the same snapshot
+      rows = db.get_daily_room_stats(thermostat,date_from,date_to,base,MAX_GAP,conn=conn)
+      episodes = db.get_setpoint_episodes(thermostat,date_from,date_to,conn=conn)
+  finally:
+    conn.close()
+
+  days = []
+  for row in rows:
+    days.append({
+      'day' : row['day'],
+      'hours' : row['seconds'] / 3600,
+      'heatingHours' : row['heating'] / 3600,
+      'dutyCycle' : row['heating'] / row['seconds'] if row['seconds'] else None,
+      'temp' : row['temp'],
+      'settemp' : row['settemp'],
+      'outsideTemp' : row['outside'],
+      'degreeDays' : row['degreedays'],
+    })
+
+  seconds = sum(row['seconds'] for row in rows)
+  heating = sum(row['heating'] for row in rows)
+  degreeDays = sum(row['degreedays'] for row in rows if row['degreedays'] is not None)
+
+  warmups = []
+  for episode in episodes:
+    warmups.append({
+      'start' : episode['start'],
+      'from' : episode['previous'],
+      'to' : episode['settemp'],
+      'temp' : episode['temp'],
+      'seconds' : _seconds(episode['start'],episode['reached']) if episode['reached'] is not None else None,
+    })
+  reached = [ warmup['seconds'] for warmup in warmups if warmup['seconds'] is not None ]
+
+  return {
+    'from' : date_from,
+    'to' : date_to,
+    'base' : base,
+    'dutyCycle' : heating / seconds if seconds else None,
+    'heatingHours' : heating / 3600,
+    'degreeDays' : degreeDays,
+    'heatingHoursPerDegreeDay' : heating / 3600 / degreeDays if degreeDays else None,
+    'timeToSetpoint' : {
+      'episodes' : len(warmups),
+      'reached' : len(reached),
+      'mean' : statistics.fmean(reached) if reached else None,
+      'median' : statistics.median(reached) if reached else None,
+      'max' : max(reached,default=None),
+      'recent' : warmups[-MAX_EPISODES:],
+    },
+    'days' : days,
+  }
@@ -1,25 +1,121 @@
 import logging
 import os
 import sys
+import atexit
+import signal
+import datetime
+import threading
+
+from logsetup import setupLogging, StartupTimer
+startup = StartupTimer()
 
 from udpserver import UdpServer
-from restapi import app
 from database import Database
+from shmstatus import StatusTable, getStatusTablePath
+from scheduler import getScheduler
+from persist import StateStore, getStatePath
+from status import getStatus
+from archive import getArchive
+from segmentstore import SegmentStore, getSegmentPath
+
+#
+# Startup is ordered so the UDP server is up as soon as possible: the socket is
+# bound first, so STATUS messages which arrive during startup are queued rather
+# than lost, and the REST API (flask) and the weather service (requests) are
+# only imported once the UDP server is running. Purging old records runs in the
+# background.
+#
+
+DAYS_TO_KEEP = 365*2
+
+logger = logging.getLogger(__name__)
 
 if __name__ == '__main__':
 
-  fmt = '[%(asctime)s %(filename)s->%(funcName)s():%(lineno)s] %(levelname)s: %(message)s'
-  logging.basicConfig(format=fmt,level=logging.DEBUG)
+  setupLogging()
+  startup.mark('imports')
 
   database_name=os.getenv('BESIM_DATABASE', 'besim.db')
-  database = Database(name=database_name)
-  if not database.check_migrations():
+  segmentPath = getSegmentPath()
+  database = Database(name=database_name,store=SegmentStore(segmentPath) if segmentPath is not None else None)
+
+  statusTablePath = getStatusTablePath()
+  statusTable = StatusTable.create(statusTablePath) if statusTablePath is not None else None
+
+  udpServer = UdpServer( ('',6199), statusTable=statusTable )
+  udpServer.bind()
+  startup.mark('bind')
+
+  # The migrations run alongside restoring the state, but must be complete before the UDP server logs to the database
+  migrated = []
+  migrations = threading.Thread(target=lambda: migrated.append(database.check_migrations()),name='migrations')
+  migrations.start()
+
+  # Restore the last known state of the devices, so it is available before they report
+  statePath = getStatePath()
+  stateStore = StateStore(statePath,udpServer) if statePath is not None else None
+  if stateStore is not None:
+    stateStore.load()
+
+  if statusTable is not None:
+    for deviceid, deviceStatus in getStatus()['devices'].items():
+      for room, roomStatus in deviceStatus['rooms'].items():
+        statusTable.write(deviceid,room,roomStatus)
+  startup.mark('state')
+
+  migrations.join()
+  if not migrated or not migrated[0]:
     sys.exit(1) # error should already have been logged
-  database.purge(365*2) # @todo currently only purging old records at startup
+  startup.mark('migrations')
+
+  if stateStore is not None:
+    stateStore.start()
+    atexit.register(stateStore.shutdown) # save the state on other exits, eg ctrl-c
+
+  def shutdown(signum,frame):
+    # docker stop: stop the UDP server and save the state before exiting, rather than relying on atexit
+    udpServer.shutdown()
+    if stateStore is not None:
+      stateStore.shutdown()
+    sys.exit(0)
+  signal.signal(signal.SIGTERM, shutdown)
 
-  udpServer = UdpServer( ('',6199) )
   udpServer.start()
+  startup.mark('udp')
+
+  getScheduler().every('purge',86400,database.purge,DAYS_TO_KEEP,delay=0,description='Purge old records')
+
+  # BESIM_ARCHIVE_MONTHS moves the history older than that many months from the database to the archive daily
+  archiveMonths = os.getenv('BESIM_ARCHIVE_MONTHS')
+  if archiveMonths and not database.sqlHistory():
+    logger.warning('BESIM_ARCHIVE_MONTHS is ignored as the history is not in the database (BESIM_SEGMENTS is set)')
+  elif archiveMonths:
+    def archive(months):
+      today = datetime.date.today()
+      month = today.year*12 + today.month-1 - months
+      getArchive().export(f'{month//12:04}-{month%12+1:02}',purge=True)
+    getScheduler().every('archive',86400,archive,int(archiveMonths),delay=60,description='Archive old records')
+
+  from weather import getWeatherService
+  getWeatherService() # start fetching the weather in the background
+  startup.mark('weather')
+
+  # BESIM_MODE=engine only runs the UDP server, and the REST API is served by
+  # separate worker processes (see wsgi.py) which connect to it over local IPC
+  mode=os.getenv('BESIM_MODE', 'all')
+  if mode == 'engine':
+    from ipc import EngineServer
+    engineServer = EngineServer(udpServer)
+    engineServer.start()
+    startup.mark('ipc')
+    startup.report()
+    udpServer.join()
+    sys.exit(0)
+
+  from restapi import app
   app.config['udpServer'] = udpServer
+  startup.mark('rest')
+  startup.report()
 
   host=os.getenv('FLASK_HOST', '0.0.0.0')
   port=os.getenv('FLASK_PORT', '80')
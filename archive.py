@@ -0,0 +1,260 @@
+import os
+import csv
+import gzip
+import time
+import fcntl
+import threading
+import logging
+from datetime import datetime, timezone, timedelta
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+#
+# Archives the temperature history from the database to gzipped CSV files,
+# one per table and month (in the local time of the records), eg
+#    archive/besim_temperature/2024-01.csv.gz
+#
+# Rows are streamed from the database to the file, so memory use does not
+# depend on the size of a month. A month is only archived once it is complete,
+# and a month which is already in the archive is not exported again.
+# Only one export runs at a time, across processes too (the engine's daily
+# job and the REST workers), using a lock on a file in the archive directory.
+# Exported months can then be purged from the database (a month archived
+# without purge is purged by a later export with purge, once its rows match
+# the archive file), and the history
+# endpoints can read them back from the archive.
+#
+
+TABLES = {
+  'besim_temperature' : ( 'ts', 'thermostat', 'temp', 'settemp', 'heating' ),
+  'besim_outside_temperature' : ( 'ts', 'temp' ),
+}
+
+NUMERIC = ( 'temp', 'settemp', 'heating' )
+
+def _number(v):
+  if v == '':
+    return None
+  try:
+    return int(v)
+  except ValueError:
+    return float(v)
+
+def _nextMonth(month):
+  year, mon = int(month[:4]), int(month[5:7])
+  return f'{year+1:04}-01' if mon==12 else f'{year:04}-{mon+1:02}'
+
+def _months(start,end):
+  # Months from start up to (excluding) end, as YYYY-MM
+  month = start
+  while month < end:
+    yield month
+    month = _nextMonth(month)
+
+def _checkHistory():
+  if not Database().sqlHistory():
+    raise NotImplementedError('The archive needs the history in the database, it is not available with BESIM_SEGMENTS')
+
+class Archive():
+  def __init__(self,path):
+    self.path = path
+    self.lock = threading.Lock()  # one export at a time in this process
+    self.lockFile = None          # held with flock while exporting, for the other processes
+    self.lastExport = None
+
+  def file(self,table,month):
+    return os.path.join(self.path,table,f'{month}.csv.gz')
+
+  def _acquire(self):
+    if not self.lock.acquire(blocking=False):
+      raise RuntimeError('An export is already running')
+    try:
+      os.makedirs(self.path,exist_ok=True)
+      f = open(os.path.join(self.path,'.lock'),'a')
+      try:
+        fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+      except BlockingIOError:
+        f.close()
+        raise RuntimeError('An export is already running in another process')
+    except BaseException:
+      self.lock.release()
+      raise
+    self.lockFile = f
+
+  def _release(self):
+    f, self.lockFile = self.lockFile, None
+    f.close()                     # releases the flock
+    self.lock.release()
+
+  def running(self):
+    # True if an export is running in this or another process
+    if self.lock.locked():
+      return True
+    path = os.path.join(self.path,'.lock')
+    if not os.path.exists(path):
+      return False
+    with open(path,'a') as f:
+      try:
+        fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+      except BlockingIOError:
+        return True
+      fcntl.flock(f,fcntl.LOCK_UN)
+    return False
+
+  def months(self,table):
+    # Months of the table which are in the archive
+    directory = os.path.join(self.path,table)
+    if not os.path.isdir(directory):
+      return []
+    return sorted(name[:7] for name in os.listdir(directory) if name.endswith('.csv.gz'))
+
+  def _exportMonth(self,conn,table,month):
+    # Returns the number of rows written to the archive
+    columns = TABLES[table]
+    path = self.file(table,month)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    sql = f"select {','.join(columns)} from {table} where ts >= ? and ts < ? order by ts"
+    count = 0
+    with gzip.open(tmp,'wt',newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(columns)
+      for rows in conn.fetchmany(sql,(month,_nextMonth(month))):
+        writer.writerows(rows)
+        count += len(rows)
+    if count:
+      os.replace(tmp,path)
+    else:
+      os.unlink(tmp)
+    return count
+
+  def _archivedRows(self,table,month):
+    # Returns the number of rows in the archive file of the month, None if there is no file
+    path = self.file(table,month)
+    if not os.path.isfile(path):
+      return None
+    with gzip.open(path,'rt',newline='') as f:
+      return sum(1 for row in csv.reader(f)) - 1   # less the header
+
+  def _purgeArchived(self,conn,table,month):
+    # Deletes the rows of a month which was archived by an earlier export without purge,
+    # if the archive file has the same number of rows as the database
+    sql = f"select count(*) as count from {table} where ts >= ? and ts < ?"
+    count = conn.fetchone(sql,(month,_nextMonth(month)))['count']
+    if not count:
+      return 0
+    archived = self._archivedRows(table,month)
+    if archived != count:
+      logger.warning(f'Not purging {table} for {month}: {count} rows in the database but {archived} in the archive')
+      return 0
+    conn.run_sql(f"delete from {table} where ts >= ? and ts < ?",(month,_nextMonth(month)))
+    return count
+
+  def export(self,before=None,purge=False):
+    # Exports each complete month before the month before (YYYY-MM, default the current month)
+    # which is not already archived, and optionally deletes the archived rows from the database
+    _checkHistory()
+    self._acquire()
+    try:
+      return self._export(before,purge)
+    finally:
+      self._release()
+
+  def start(self,before=None,purge=False):
+    # As export, but runs in the background
+    _checkHistory()
+    self._acquire()
+    def run():
+      try:
+        self._export(before,purge)
+      except Exception:
+        logger.exception('Archive export failed')
+      finally:
+        self._release()
+    threading.Thread(target=run,daemon=True).start()
+
+  def _export(self,before,purge):
+    # Must be called with the locks held (see _acquire)
+    if before is None:
+      before = datetime.now(timezone.utc).astimezone().strftime('%Y-%m')
+    current = datetime.now(timezone.utc).astimezone().strftime('%Y-%m')
+    before = min(before[:7],current)
+    start = time.monotonic()
+    db = Database()
+    conn = db.get_connection()
+    result = { 'before' : before, 'purge' : purge, 'months' : {} }
+    try:
+      for table in TABLES:
+        oldest = conn.fetchone(f"select min(ts) as ts from {table}")
+        if oldest is None or oldest['ts'] is None:
+          continue
+        archived = set(self.months(table))
+        for month in _months(oldest['ts'][:7],before):
+          if month in archived:
+            if purge:
+              count = self._purgeArchived(conn,table,month)
+              if count:
+                result.setdefault('purged',{}).setdefault(table,{})[month] = count
+                logger.info(f'Purged {count} rows of {table} for {month} which were already archived')
+            continue
+          count = self._exportMonth(conn,table,month)
+          if count and purge:
+            conn.run_sql(f"delete from {table} where ts >= ? and ts < ?",(month,_nextMonth(month)))
+          if count:
+            result['months'].setdefault(table,{})[month] = count
+            logger.info(f'Archived {count} rows of {table} for {month}' + (' and purged them' if purge else ''))
+    finally:
+      conn.close()
+    result['seconds'] = time.monotonic() - start
+    result['finished'] = time.time()
+    self.lastExport = result
+    return result
+
+  def read(self,table,date_from,date_to,thermostat=None):
+    # Yields the archived rows as dicts with date_from <= ts <= date_to (compared as strings, as in the database)
+    columns = TABLES[table]
+    for month in self.months(table):
+      if month < date_from[:7] or month > date_to[:7]:
+        continue
+      with gzip.open(self.file(table,month),'rt',newline='') as f:
+        reader = csv.reader(f)
+        next(reader)              # header
+        for row in reader:
+          if not date_from <= row[0] <= date_to:
+            continue
+          if thermostat is not None and row[1] != str(thermostat):
+            continue
+          yield { column : (_number(v) if column in NUMERIC else v) for column,v in zip(columns,row) }
+
+  def status(self):
+    files = {}
+    for table in TABLES:
+      files[table] = { month : os.path.getsize(self.file(table,month)) for month in self.months(table) }
+    return { 'path' : self.path, 'files' : files, 'running' : self.running(), 'lastExport' : self.lastExport }
+
+Store = None
+StoreLock = threading.Lock()
+
+def getArchive():
+  global Store
+  with StoreLock:
+    if Store is None:
+      Store = Archive(os.getenv('BESIM_ARCHIVE','archive'))
+  return Store
+
+def withArchive(table,rows,date_from,date_to,thermostat=None):
+  # Combines the history from the database with the archived rows in the range
+  # Rows from months which are archived come from the archive, so they are not duplicated if they were not purged
+  _checkHistory()
+  archive = getArchive()
+  if date_from is None:
+    date_from = (datetime.now(timezone.utc).astimezone() - timedelta(days=14)).isoformat()
+  if date_to is None:
+    date_to = datetime.now(timezone.utc).astimezone().isoformat()
+  archived = set(archive.months(table))
+  columns = [ column for column in TABLES[table] if column != 'thermostat' ]
+  result = [ { k : row[k] for k in columns } for row in archive.read(table,date_from,date_to,thermostat) ]
+  result.extend(row for row in rows if row['ts'][:7] not in archived)
+  return result
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timezone
+
+from database import Database, Singleton
+from segmentstore import SegmentStore
+
+#
+# Compares the sqlite3 database and the segment store (see segmentstore.py)
+# under the same load, eg
+#    python benchmark_storage.py --rooms 8 --days 90 --queries 200
+#
+#  - ingest: logging the temperature of each room as the UDP server does, after backfilling the history
+#  - query: history of a random room over a random range of the backfilled history
+#
+
+def openDatabase(directory,backend):
+  Singleton._instances.pop(Database,None)   # Database is a singleton, start afresh for each backend
+  store = SegmentStore(os.path.join(directory,'segments')) if backend == 'segments' else None
+  database = Database(name=os.path.join(directory,'besim.db'),store=store)
+  database.check_migrations()
+  return database
+
+def backfill(database,rooms,days,interval):
+  # Writes days of history for each room, one sample every interval seconds
+  end = datetime.now(timezone.utc).timestamp()
+  start = end - days*86400
+  conn = database.get_connection()
+  with conn.transaction():
+    for ts in range(int(start),int(end),interval):
+      database.store.log_temperatures([ (room,20+random.random(),21.0,random.randint(0,1)) for room in range(rooms) ],ts=ts,conn=conn)
+  conn.close()
+  return start, end
+
+def ingest(database,rooms,samples):
+  conn = database.get_connection()
+  start = time.perf_counter()
+  for i in range(samples):
+    database.log_temperature(i % rooms,20+random.random(),21.0,random.randint(0,1),conn=conn)
+    conn.commit()
+  elapsed = time.perf_counter() - start
+  conn.close()
+  return elapsed
+
+def query(database,rooms,start,end,queries,rangeDays):
+  times = []
+  rows = 0
+  for i in range(queries):
+    date_from = random.uniform(start,end-rangeDays*86400)
+    date_to = date_from + rangeDays*86400
+    iso_from = datetime.fromtimestamp(date_from,timezone.utc).astimezone().isoformat()
+    iso_to = datetime.fromtimestamp(date_to,timezone.utc).astimezone().isoformat()
+    t = time.perf_counter()
+    rows += len(database.get_temperature(random.randrange(rooms),iso_from,iso_to))
+    times.append(time.perf_counter()-t)
+  return times, rows
+
+def diskUsage(directory):
+  return sum(os.path.getsize(os.path.join(path,name)) for path,dirs,names in os.walk(directory) for name in names)
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the temperature history storage backends')
+  parser.add_argument('--rooms',type=int,default=8)
+  parser.add_argument('--days',type=int,default=90,help='days of history to backfill before querying')
+  parser.add_argument('--interval',type=int,default=60,help='seconds between samples of each room')
+  parser.add_argument('--samples',type=int,default=10000,help='samples to log for the ingest benchmark')
+  parser.add_argument('--queries',type=int,default=200)
+  parser.add_argument('--range',type=float,default=7,help='days covered by each query')
+  parser.add_argument('--backends',default='sqlite,segments')
+  args = parser.parse_args()
+
+  for backend in args.backends.split(','):
+    directory = tempfile.mkdtemp(prefix=f'besim-{backend}-')
+    try:
+      random.seed(1)
+      database = openDatabase(directory,backend)
+      start, end = backfill(database,args.rooms,args.days,args.interval) # first, as the segments are append-only
+      elapsed = ingest(database,args.rooms,args.samples)
+      times, rows = query(database,args.rooms,start,end,args.queries,args.range)
+      times.sort()
+      print(f'{backend:>8}: ingest {args.samples/elapsed:10.0f} rows/s'
+            f'  query mean {statistics.fmean(times)*1000:8.2f}ms p95 {times[int(len(times)*0.95)]*1000:8.2f}ms'
+            f'  ({rows/len(times):.0f} rows)  disk {diskUsage(directory)/1e6:.1f}MB')
+      database.store.close()
+    finally:
+      shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  sys.exit(main())
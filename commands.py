@@ -0,0 +1,404 @@
+import time
+import heapq
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+#
+# Downlink commands which expect a response from the device.
+#
+# Each command is identified by a unique id (returned to REST clients), and is
+# matched to the response from the device using (deviceid, cseq).
+# For messages which do not use a cseq (eg PROGRAM) the cseq is replaced by a
+# tag which identifies the response, eg ('prog', room, day)
+#
+# Commands are retransmitted with exponential backoff until the device responds
+# or the command times out, so writes survive the odd lost UDP packet.
+#
+
+class LinkStats():
+  # Retransmission timeout, see RFC6298
+  # Updated from the UDP thread, the retransmitter and the threads waiting for commands, so under the lock
+  RTO_INITIAL = 1.0
+  RTO_MIN = 0.2
+  RTO_MAX = 4.0
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.srtt = None
+    self.rttvar = None
+    self.sent = 0
+    self.retransmits = 0
+    self.acks = 0
+    self.dupacks = 0
+    self.timeouts = 0
+
+  def transmitted(self,retransmit=False):
+    with self.lock:
+      self.sent += 1
+      if retransmit:
+        self.retransmits += 1
+
+  def acked(self,rtt=None):
+    # rtt is None if the RTT cannot be sampled from this ack
+    with self.lock:
+      self.acks += 1
+      if rtt is None:
+        return
+      if self.srtt is None:
+        self.srtt = rtt
+        self.rttvar = rtt / 2
+      else:
+        self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+        self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+  def dupacked(self):
+    with self.lock:
+      self.dupacks += 1
+
+  def timedout(self):
+    with self.lock:
+      self.timeouts += 1
+
+  def _rto(self):
+    if self.srtt is None:
+      return self.RTO_INITIAL
+    return min(self.RTO_MAX,max(self.RTO_MIN,self.srtt + 4 * self.rttvar))
+
+  def rto(self):
+    with self.lock:
+      return self._rto()
+
+  def toJson(self):
+    with self.lock:
+      return {
+        'srtt' : self.srtt,
+        'rttvar' : self.rttvar,
+        'rto' : self._rto(),
+        'sent' : self.sent,
+        'retransmits' : self.retransmits,
+        'acks' : self.acks,
+        'dupacks' : self.dupacks,
+        'timeouts' : self.timeouts,
+        'loss' : self.retransmits / self.sent if self.sent else None,
+      }
+
+class Command():
+  PENDING = 'pending'
+  OK = 'ok'
+  TIMEOUT = 'timeout'
+
+  def __init__(self,id,deviceid,cseq,timeout,stats,callback=None):
+    self.id = id
+    self.deviceid = deviceid
+    self.cseq = cseq
+    self.timeout = timeout
+    self.stats = stats
+    self.callback = callback
+    self.lock = threading.Lock()
+    self.ev = threading.Event()
+    self.val = None
+    self.state = self.PENDING
+    self.submitted = time.time()
+    self.completed = None
+    self.resend = None            # function to retransmit the request
+    self.attempts = 0
+    self.lastSent = None
+
+  def deadline(self):
+    return self.submitted + self.timeout
+
+  def _finish(self,state,val=None):
+    # Returns True if this call completed the command
+    with self.lock:
+      if self.state != self.PENDING:
+        return False
+      self.val = val
+      self.state = state
+      self.completed = time.time()
+    self.ev.set()
+    if self.callback is not None:
+      try:
+        self.callback(self)
+      except Exception:
+        logger.exception(f'Callback failed for command {self.id}')
+    return True
+
+  def complete(self,val):
+    if not self._finish(self.OK,val):
+      self.stats.dupacked()
+      return False
+    metrics.COMMAND_SECONDS.observe(self.completed - self.submitted,self.deviceid)
+    # Only sample the RTT if there is no ambiguity about which transmission was acked (Karn's algorithm)
+    self.stats.acked(self.completed - self.lastSent if self.attempts == 1 else None)
+    return True
+
+  def expire(self):
+    if not self._finish(self.TIMEOUT):
+      return False
+    if self.attempts > 0:
+      self.stats.timedout()
+      metrics.COMMAND_TIMEOUTS.inc(self.deviceid)
+    return True
+
+  def wait(self):
+    # Block until the response is received or the command times out
+    self.ev.wait(max(0,self.deadline()-time.time()))
+    if not self.ev.is_set():
+      self.expire()
+    return self.val
+
+  def toJson(self):
+    return {
+      'id' : self.id,
+      'deviceid' : self.deviceid,
+      'state' : self.state,
+      'val' : self.val,
+      'attempts' : self.attempts,
+      'submitted' : self.submitted,
+      'completed' : self.completed,
+    }
+
+class Retransmitter(threading.Thread):
+  # Timer thread which retransmits pending commands and expires them at their deadline
+
+  def __init__(self,maxAttempts):
+    threading.Thread.__init__(self,daemon=True)
+    self.maxAttempts = maxAttempts
+    self.cond = threading.Condition()
+    self.heap = []                # (due,id,Command,rto)
+
+  def schedule(self,cmd,rto):
+    with self.cond:
+      heapq.heappush(self.heap,(min(time.time()+rto,cmd.deadline()),cmd.id,cmd,rto))
+      self.cond.notify()
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.heap or self.heap[0][0] > time.time():
+          self.cond.wait(self.heap[0][0]-time.time() if self.heap else None)
+        due, id, cmd, rto = heapq.heappop(self.heap)
+
+      if cmd.state != Command.PENDING:
+        continue
+      if due >= cmd.deadline():
+        cmd.expire()
+        continue
+      if cmd.attempts >= self.maxAttempts:
+        # Give up retransmitting, but the response may still arrive before the deadline
+        self.schedule(cmd,cmd.deadline()-time.time())
+        continue
+
+      try:
+        cmd.resend()
+        cmd.attempts += 1
+        cmd.lastSent = time.time()
+        cmd.stats.transmitted(retransmit=True)
+        metrics.COMMAND_RETRANSMITS.inc(cmd.deviceid)
+        logger.info(f'Retransmitted command {cmd.id} to {cmd.deviceid} {cmd.cseq=} attempt={cmd.attempts}')
+      except Exception:
+        logger.exception(f'Failed to retransmit command {cmd.id}')
+      self.schedule(cmd,min(rto*2,LinkStats.RTO_MAX))
+
+class CommandTable():
+  MAX_COMMANDS = 1024
+  MAX_ATTEMPTS = 4
+  QUARANTINE = 2 * LinkStats.RTO_MAX  # seconds before the cseq of a completed command can be reused
+  RESULT_TTL = 600                    # seconds completed commands are kept for REST clients to read
+
+  def __init__(self,maxsize=MAX_COMMANDS):
+    self.maxsize = maxsize
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+    self.byKey = {}               # (deviceid,cseq) -> Command, the latest command sent with that cseq
+    self.byId = OrderedDict()     # id -> Command, oldest first
+    self.stats = {}               # deviceid -> LinkStats
+    self.retransmitter = None
+
+  def getStats(self,deviceid):
+    with self.lock:
+      return self.stats.setdefault(deviceid,LinkStats())
+
+  def add(self,deviceid,cseq,timeout,callback=None):
+    stats = self.getStats(deviceid)
+    with self.lock:
+      cmd = Command(next(self.ids),deviceid,cseq,timeout,stats,callback)
+      dangling = self.byKey.get((deviceid,cseq))
+      self.byKey[(deviceid,cseq)] = cmd
+      self.byId[cmd.id] = cmd
+      evicted = []
+      while len(self.byId) > self.maxsize:
+        _, old = self.byId.popitem(last=False)
+        if self.byKey.get((old.deviceid,old.cseq)) is old:
+          del self.byKey[(old.deviceid,old.cseq)]
+        evicted.append(old)
+    # The cseq has been reused, or the table is full, so nothing can complete these any more
+    if dangling is not None:
+      dangling.expire()
+    for old in evicted:
+      old.expire()
+    return cmd
+
+  def transmit(self,deviceid,cseq,send):
+    # Send a request, and if a response is expected retransmit it until the command completes
+    send()
+    cmd = self.find(deviceid,cseq)
+    if cmd is None or cmd.state != Command.PENDING:
+      return
+    cmd.resend = send
+    cmd.lastSent = time.time()
+    cmd.attempts = 1
+    cmd.stats.transmitted()
+    if self.MAX_ATTEMPTS > 1:
+      with self.lock:
+        if self.retransmitter is None:
+          self.retransmitter = Retransmitter(self.MAX_ATTEMPTS)
+          self.retransmitter.start()
+      self.retransmitter.schedule(cmd,cmd.stats.rto())
+
+  def busy(self,deviceid,cseq):
+    # True if the cseq cannot safely be reused yet, ie a response to the previous request may still arrive
+    cmd = self.find(deviceid,cseq)
+    if cmd is None:
+      return False
+    if cmd.state == Command.PENDING:
+      return True
+    return cmd.completed + self.QUARANTINE > time.time()
+
+  def find(self,deviceid,cseq):
+    with self.lock:
+      return self.byKey.get((deviceid,cseq))
+
+  def release(self,deviceid,cseq):
+    # The cseq is being reused for a request which does not expect a response
+    with self.lock:
+      cmd = self.byKey.pop((deviceid,cseq),None)
+    if cmd is not None:
+      cmd.expire()
+
+  def get(self,id):
+    with self.lock:
+      cmd = self.byId.get(id)
+    if cmd is not None and cmd.state == Command.PENDING and cmd.deadline() < time.time():
+      cmd.expire()
+    return cmd
+
+  def signal(self,deviceid,cseq,val):
+    # Returns True if a pending command was completed
+    cmd = self.find(deviceid,cseq)
+    if cmd is not None:
+      return cmd.complete(val)
+    return False
+
+  def purge(self,ttl=RESULT_TTL):
+    # Removes completed commands older than ttl, returns the number removed
+    limit = time.time() - ttl
+    with self.lock:
+      purged = []
+      for cmd in self.byId.values():
+        # Commands complete out of order, so check them all
+        if cmd.state != Command.PENDING and cmd.completed < limit:
+          purged.append(cmd)
+      for cmd in purged:
+        del self.byId[cmd.id]
+        if self.byKey.get((cmd.deviceid,cmd.cseq)) is cmd:
+          del self.byKey[(cmd.deviceid,cmd.cseq)]
+    return len(purged)
+
+  def forget(self,deviceid):
+    # The device has gone away, drop its link statistics and any commands for it
+    with self.lock:
+      self.stats.pop(deviceid,None)
+      cmds = [ cmd for cmd in self.byId.values() if cmd.deviceid == deviceid ]
+      for cmd in cmds:
+        del self.byId[cmd.id]
+        if self.byKey.get((cmd.deviceid,cmd.cseq)) is cmd:
+          del self.byKey[(cmd.deviceid,cmd.cseq)]
+    for cmd in cmds:
+      cmd.expire()
+
+  def pending(self,deviceid=None):
+    with self.lock:
+      return [ cmd for cmd in self.byId.values() if cmd.state == Command.PENDING and (deviceid is None or cmd.deviceid == deviceid) ]
+
+Commands = CommandTable()
+
+def getCommandTable():
+  return Commands
+
+#
+# Read requests to the device (eg DEVICE_TIME, SWVERSION)
+#
+# Concurrent callers asking for the same thing share a single request to the
+# device, and the result is cached for a short time. A write invalidates the
+# cached value, and a read in flight at the time is not cached either.
+#
+
+class Flight():
+  def __init__(self):
+    self.ev = threading.Event()
+    self.val = None
+    self.error = None
+    self.generation = 0
+
+class QueryCache():
+  TTL = 10                        # seconds
+  MAX_ENTRIES = 1024
+
+  def __init__(self,ttl=TTL,maxsize=MAX_ENTRIES):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.lock = threading.Lock()
+    self.inflight = {}            # key -> Flight
+    self.generations = {}         # key -> number of invalidations while a Flight is in progress
+    self.cache = OrderedDict()    # key -> (expiry,val), oldest first
+
+  def do(self,key,fn):
+    now = time.time()
+    with self.lock:
+      if key in self.cache:
+        expiry, val = self.cache[key]
+        if expiry > now:
+          return val
+        del self.cache[key]
+      flight = self.inflight.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.inflight[key] = Flight()
+        flight.generation = self.generations.get(key,0)
+
+    if not leader:
+      flight.ev.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.val
+
+    try:
+      flight.val = fn()
+    except Exception as e:
+      flight.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.inflight[key]
+        # Not cached if invalidated meanwhile (eg by a write), as the value may be from before it
+        stale = self.generations.pop(key,0) != flight.generation
+        if flight.error is None and flight.val is not None and not stale: # do not cache timeouts
+          self.cache[key] = (time.time()+self.ttl,flight.val)
+          self.cache.move_to_end(key)
+          while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+      flight.ev.set()
+    return flight.val
+
+  def invalidate(self,key):
+    with self.lock:
+      self.cache.pop(key,None)
+      if key in self.inflight:
+        self.generations[key] = self.generations.get(key,0) + 1
@@ -2,6 +2,9 @@ import logging
 from databaseConnection import DatabaseType,DatabaseConnection
 from datetime import datetime, timezone, timedelta
 
+from metrics import DB_SECONDS
+from storage import SqliteStore
+
 logger = logging.getLogger(__name__)
 
 class Singleton(type):
@@ -13,11 +16,18 @@ class Singleton(type):
 
 class Database(metaclass=Singleton):
 
-  VERSION = 1
+  VERSION = 2
+
+  # SQL to upgrade the database from each version to the next
+  MIGRATIONS = {
+    1 : [ "create index if not exists besim_temperature_thermostat_ts on besim_temperature(thermostat, ts)",
+          "create index if not exists besim_outside_temperature_ts on besim_outside_temperature(ts)" ],
+  }
 
-  def __init__(self,name,log=False):
+  def __init__(self,name,log=False,store=None):
     self.name = name
     self.log = log
+    self.store = store if store is not None else SqliteStore(self) # the temperature history (see storage.py)
 
   def create_tables(self,conn=None):
     if not conn:
@@ -29,6 +39,9 @@ class Database(metaclass=Singleton):
     conn.run_sql(sql,log=self.log)
     sql = "create table if not exists besim_temperature(ts DATETIME, thermostat TEXT, temp NUMERIC, settemp NUMERIC, heating NUMERIC)"
     conn.run_sql(sql,log=self.log)
+    for version in range(1,self.VERSION):
+      for sql in self.MIGRATIONS[version]:
+        conn.run_sql(sql,log=self.log)
     if closeit:
       conn.close(commit=True)
 
@@ -55,11 +68,18 @@ class Database(metaclass=Singleton):
 
       if user_version==0:
         logger.warning(f"Initialising Database to version {self.VERSION}")
-        self.create_tables(conn=conn)
-        self._set_user_version(self.VERSION,conn=conn)
+        with conn.transaction():
+          self.create_tables(conn=conn)
+          self._set_user_version(self.VERSION,conn=conn)
+      elif user_version<self.VERSION:
+        logger.warning(f"Upgrading Database from version {user_version} to {self.VERSION}")
+        for version in range(user_version,self.VERSION):
+          with conn.transaction(): # each step is applied completely or not at all
+            for sql in self.MIGRATIONS[version]:
+              conn.run_sql(sql,log=self.log)
+            self._set_user_version(version+1,conn=conn)
       elif user_version!=self.VERSION:
-        logger.warning(f"Database needs upgrading from version {user_version} to {self.VERSION}")
-        logger.error(f"Migration not yet implemented :(")
+        logger.error(f"Database version {user_version} is newer than {self.VERSION}")
         success = False
     else:
       logger.error("Failed to get database version")
@@ -76,79 +96,118 @@ class Database(metaclass=Singleton):
     return dbConnection
 
   def log_outside_temperature(self,temp,conn=None):
-    if not conn:
-      conn = self.get_connection()
-      closeit = True
-    else:
-      closeit = False
-    now = datetime.now(timezone.utc).astimezone().isoformat()
-    sql = "insert into besim_outside_temperature(ts, temp) values (?,?)"
-    values = (now,temp)
-    conn.run_sql(sql,values,log=self.log)
-    if closeit:
-      conn.close(commit=True)
+    with DB_SECONDS.time('log_outside_temperature'):
+      self.store.log_outside_temperature(temp,conn=conn)
 
   def log_temperature(self,thermostat,temp,settemp,heating,conn=None):
-    if not conn:
-      conn = self.get_connection()
-      closeit = True
-    else:
-      closeit = False
-    now = datetime.now(timezone.utc).astimezone().isoformat()
-    sql = "insert into besim_temperature(ts, thermostat, temp, settemp, heating) values (?,?,?,?,?)"
-    values = (now,thermostat,temp,settemp,heating)
-    conn.run_sql(sql,values,log=self.log)
-    if closeit:
-      conn.close(commit=True)
+    with DB_SECONDS.time('log_temperature'):
+      self.store.log_temperature(thermostat,temp,settemp,heating,conn=conn)
+
+  def log_temperatures(self,samples,conn=None):
+    # Logs (thermostat,temp,settemp,heating) for several rooms at once, with a single commit
+    with DB_SECONDS.time('log_temperature'):
+      self.store.log_temperatures(samples,conn=conn)
 
   def purge(self,daysToKeep,conn=None):
-    if not conn:
-      conn = self.get_connection()
-      closeit = True
-    else:
-      closeit = False
     now = datetime.now(timezone.utc).astimezone()
     limit = now - timedelta(days=daysToKeep)
-    sql = "delete from besim_outside_temperature where ts < '" + limit.isoformat() + "'"
-    conn.run_sql(sql,log=self.log)
-    sql = "delete from besim_temperature where ts < '" + limit.isoformat() + "'"
-    conn.run_sql(sql,log=self.log)
-    if closeit:
-      conn.close(commit=True)
+    with DB_SECONDS.time('purge'):
+      self.store.purge(limit,conn=conn)
 
   def get_outside_temperature(self,date_from=None,date_to=None,conn=None):
     if date_from is None:
       date_from = (datetime.now(timezone.utc).astimezone() - timedelta(days=14)).isoformat()
     if date_to is None:
       date_to = datetime.now(timezone.utc).astimezone().isoformat()
+    with DB_SECONDS.time('get_outside_temperature'):
+      return self.store.get_outside_temperature(date_from,date_to,conn=conn)
 
+  def get_temperature(self,thermostat,date_from=None,date_to=None,conn=None):
+    if date_from is None:
+      date_from = (datetime.now(timezone.utc).astimezone() - timedelta(days=14)).isoformat()
+    if date_to is None:
+      date_to = datetime.now(timezone.utc).astimezone().isoformat()
+    with DB_SECONDS.time('get_temperature'):
+      return self.store.get_temperature(thermostat,date_from,date_to,conn=conn)
+
+  def sqlHistory(self):
+    # True if the history is in the database, which the analytics and the archive need
+    return self.store.SQL
+
+  #
+  # Analytics, computed in the database so only the (small) result is returned
+  #
+
+  def get_daily_room_stats(self,thermostat,date_from,date_to,base,max_gap,conn=None):
+    # Per day (in the local time of the records) for the room:
+    #   seconds covered by samples, seconds heating, time weighted mean temp and settemp,
+    #   mean outside temperature and heating degree days against base
+    # Each sample lasts until the next one, but no longer than max_gap seconds (eg when the device was offline)
     if not conn:
       conn = self.get_connection()
       closeit = True
     else:
       closeit = False
-    sql = "select ts,temp from besim_outside_temperature where ts between ? and ?"
-    values = (date_from,date_to)
-    rc = conn.run_sql(sql,values,log=self.log)
+    sql = """
+      with samples as (
+        select ts, temp, settemp, heating,
+          min((julianday(lead(ts) over (order by ts)) - julianday(ts)) * 86400, ?) as secs
+        from besim_temperature where thermostat = ? and ts between ? and ?
+      ),
+      room as (
+        select substr(ts,1,10) as day,
+          sum(secs) as seconds,
+          sum(case when heating = 1 then secs else 0 end) as heating,
+          sum(temp * secs) / sum(secs) as temp,
+          sum(settemp * secs) / sum(secs) as settemp
+        from samples where secs is not null group by day
+      ),
+      outside as (
+        select substr(ts,1,10) as day, avg(temp) as temp
+        from besim_outside_temperature where ts between ? and ? group by day
+      )
+      select room.day, room.seconds, room.heating, room.temp, room.settemp,
+        outside.temp as outside, max(0, ? - outside.temp) as degreedays
+      from room left join outside on room.day = outside.day
+      order by room.day
+    """
+    values = (max_gap,thermostat,date_from,date_to,date_from,date_to,base)
+    with DB_SECONDS.time('get_daily_room_stats'):
+      rc = conn.run_sql(sql,values,log=self.log)
     if closeit:
       conn.close(commit=True)
     return rc
 
-  def get_temperature(self,thermostat,date_from=None,date_to=None,conn=None):
-    if date_from is None:
-      date_from = (datetime.now(timezone.utc).astimezone() - timedelta(days=14)).isoformat()
-    if date_to is None:
-      date_to = datetime.now(timezone.utc).astimezone().isoformat()
-
+  def get_setpoint_episodes(self,thermostat,date_from,date_to,conn=None):
+    # Each time the setpoint is raised above the room temperature, the time it takes to reach it
+    # reached is null if it was not reached before the setpoint changed again (or the end of the records)
+    # Samples are numbered by episode (a run with the same setpoint) using a running count of the changes
     if not conn:
       conn = self.get_connection()
       closeit = True
     else:
       closeit = False
-    sql = "select ts,temp,settemp,heating from besim_temperature where thermostat = ? and ts between ? and ?"
+    sql = """
+      with samples as (
+        select ts, temp, settemp, lag(settemp) over (order by ts) as prev
+        from besim_temperature where thermostat = ? and ts between ? and ?
+      ),
+      changes as (
+        select ts, temp, settemp,
+          case when prev is null or settemp != prev then prev end as previous,
+          case when prev is null or settemp != prev then temp end as starttemp,
+          sum(case when prev is null or settemp != prev then 1 else 0 end) over (order by ts) as episode
+        from samples
+      )
+      select min(ts) as start, max(settemp) as settemp, max(previous) as previous, max(starttemp) as temp,
+        min(case when temp >= settemp then ts end) as reached
+      from changes group by episode
+      having max(previous) is not null and max(settemp) > max(previous) and max(starttemp) < max(settemp)
+      order by start
+    """
     values = (thermostat,date_from,date_to)
-    rc = conn.run_sql(sql,values,log=self.log)
+    with DB_SECONDS.time('get_setpoint_episodes'):
+      rc = conn.run_sql(sql,values,log=self.log)
     if closeit:
       conn.close(commit=True)
     return rc
-
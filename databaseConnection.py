@@ -17,6 +17,7 @@ class DatabaseConnection:
     self.databaseType = databaseType
     self.databaseName = databaseName
     self.conn = None
+    self.depth = 0                # nesting of transaction()
 
   def connect(self):
     if self.databaseName is not None and self.conn is None:
@@ -25,6 +26,8 @@ class DatabaseConnection:
 
   def close(self,commit=False):
     if self.conn is not None:
+      if commit:
+        self.conn.commit()
       self.conn.close()
       self.conn = None
 
@@ -39,6 +42,31 @@ class DatabaseConnection:
     if self.getConn() is not None:
       self.getConn().rollback()
 
+  #
+  # Statements outside a transaction scope are committed straight away (for a
+  # query this only ends the read transaction, so writers are not blocked).
+  # Inside transaction() nothing is committed until the outermost scope ends,
+  # so a batch of writes pays for a single commit, and reads see one snapshot.
+  #
+
+  @contextlib.contextmanager
+  def transaction(self):
+    self.depth += 1
+    try:
+      yield self
+    except BaseException:
+      self.depth -= 1
+      if self.depth == 0:
+        self.rollback()
+      raise
+    self.depth -= 1
+    if self.depth == 0:
+      self.commit()
+
+  def _autocommit(self):
+    if self.depth == 0:
+      self.commit()
+
   def run_sql(self,sql,values=None,log=False) -> List:
     if values is None:
       values = ()
@@ -52,22 +80,62 @@ class DatabaseConnection:
         else:
           cols = [ x[0] for x in cursor.description ]
           result = [ dict(zip(cols,row)) for row in cursor.fetchall() ]
-      self.getConn().commit()
+      self._autocommit()
       if log:
         logger.info(result)
       return result
     else:
       return None
 
-  def fetchmany(self,sql,values=None,log=False) -> List:
-    return self.run_sql(sql,values,log)
+  def executemany(self,sql,values,log=False):
+    # Runs sql (an insert etc) for each tuple in values, returns the number of rows changed
+    if log:
+      logger.info(sql)
+    if self.getConn() is None:
+      return None
+    with contextlib.closing(self.getConn().cursor()) as cursor:
+      cursor.executemany(sql,values)
+      rowcount = cursor.rowcount
+    self._autocommit()
+    return rowcount
+
+  def fetchmany(self,sql,values=None,size=1000,log=False):
+    # Yields the rows returned by sql in lists of up to size tuples, so memory use does not depend on the size of the result
+    if values is None:
+      values = ()
+    if log:
+      logger.info(sql)
+    if self.getConn() is None:
+      return
+    with contextlib.closing(self.getConn().cursor()) as cursor:
+      cursor.execute(sql,values)
+      while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+          break
+        yield rows
+    self._autocommit()
 
   def fetchone(self,sql,values=None,log=False):
-    rc = self.run_sql(sql,values,log)
-    if rc is not None and len(rc)>0:
-      return rc[0]
-    else:
+    if values is None:
+      values = ()
+    if log:
+      logger.info(sql)
+    if self.getConn() is None:
       return None
+    with contextlib.closing(self.getConn().cursor()) as cursor:
+      cursor.execute(sql,values)
+      row = cursor.fetchone() if cursor.description is not None else None
+      result = dict(zip([ x[0] for x in cursor.description ],row)) if row is not None else None
+    self._autocommit()
+    if log:
+      logger.info(result)
+    return result
+
+  def iterate(self,sql,values=None,size=1000,log=False):
+    # Yields the rows (as tuples) returned by sql, fetching size rows at a time so memory use is constant
+    for rows in self.fetchmany(sql,values,size,log):
+      yield from rows
 
   def truncate_tables(self,tables: Union[str,List[str]],log=False) -> List:
     if not isinstance(tables,list):
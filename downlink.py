@@ -0,0 +1,94 @@
+import time
+import heapq
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+#
+# Per-device queue of downlink messages
+#
+# The embedded device may not handle lots of messages in a short time, so
+# messages to the same device are spaced out by at least SPACING seconds.
+# Messages are sent from the scheduler thread, so the UDP receive thread never
+# has to sleep to pace the downlink.
+#
+
+class DownlinkScheduler(threading.Thread):
+  SPACING = 1.0                   # seconds between messages to the same device
+
+  def __init__(self,spacing=SPACING):
+    threading.Thread.__init__(self,daemon=True)
+    self.spacing = spacing
+    self.stop = False
+    self.cond = threading.Condition()
+    self.queues = {}              # deviceid -> deque of (key,fn,args)
+    self.keys = {}                # deviceid -> set of keys in the queue
+    self.lastSent = {}            # deviceid -> time the last message was sent
+    self.heap = []                # (due,deviceid) for each device with a non-empty queue
+
+  def _due(self,deviceid):
+    return max(time.monotonic(),self.lastSent.get(deviceid,0)+self.spacing)
+
+  def touch(self,deviceid):
+    # Record that a message has been sent directly to the device (ie not from the queue)
+    with self.cond:
+      self.lastSent[deviceid] = time.monotonic()
+
+  def enqueue(self,deviceid,fn,*args,key=None):
+    # Queue fn(*args) to be called when the device is next allowed a message
+    # If key is set and a message with the same key is already queued then this one is dropped
+    with self.cond:
+      keys = self.keys.setdefault(deviceid,set())
+      if key is not None:
+        if key in keys:
+          return False
+        keys.add(key)
+      queue = self.queues.setdefault(deviceid,deque())
+      queue.append((key,fn,args))
+      if len(queue)==1:
+        heapq.heappush(self.heap,(self._due(deviceid),deviceid))
+        self.cond.notify()
+    return True
+
+  def pending(self,deviceid):
+    with self.cond:
+      return len(self.queues.get(deviceid,()))
+
+  def forget(self,deviceid):
+    # The device has gone away, drop anything queued for it
+    with self.cond:
+      self.queues.pop(deviceid,None)
+      self.keys.pop(deviceid,None)
+      self.lastSent.pop(deviceid,None)
+      self.heap = [ entry for entry in self.heap if entry[1] != deviceid ]
+      heapq.heapify(self.heap)
+
+  def shutdown(self):
+    with self.cond:
+      self.stop = True
+      self.cond.notify()
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.stop and (not self.heap or self.heap[0][0] > time.monotonic()):
+          self.cond.wait(self.heap[0][0]-time.monotonic() if self.heap else None)
+        if self.stop:
+          return
+
+        due, deviceid = heapq.heappop(self.heap)
+        queue = self.queues[deviceid]
+        key, fn, args = queue.popleft()
+        self.keys[deviceid].discard(key)
+        self.lastSent[deviceid] = time.monotonic()
+        if queue:
+          heapq.heappush(self.heap,(self._due(deviceid),deviceid))
+        else:
+          del self.queues[deviceid]
+
+      try:
+        fn(*args)
+      except Exception:
+        logger.exception(f'Failed to send downlink message to {deviceid}')
@@ -0,0 +1,240 @@
+import os
+import time
+import secrets
+import threading
+import logging
+from multiprocessing.connection import Listener, Client
+
+from status import getDeviceStatus, getState, setState
+from views import getViews
+
+logger = logging.getLogger(__name__)
+
+#
+# Local IPC between the UDP engine process and the REST worker processes
+#
+# The engine process runs the UdpServer and an EngineServer. REST workers use
+# a RemoteUdpServer in place of the UdpServer to submit commands, and a
+# StatusMirror to keep a local copy of the status.
+#
+# Each request is a (method, args, kwargs) tuple, and each reply is either
+# ('ok', result) or ('error', message).
+#
+# Requests are pickled, so anyone who can connect and authenticate can run
+# code in the engine. The unix socket is created in a directory only the owner
+# can access, and unless BESIM_IPC_AUTHKEY is set the engine generates a random
+# key at startup, which the workers read from a file next to the socket.
+# A TCP address is refused unless BESIM_IPC_AUTHKEY is set.
+#
+
+DEFAULT_ADDRESS = '/tmp/besim/besim.sock'
+
+def getAddress():
+  # BESIM_IPC_ADDRESS is either a unix socket path or host:port
+  address = os.getenv('BESIM_IPC_ADDRESS',DEFAULT_ADDRESS)
+  if ':' in address:
+    host, port = address.rsplit(':',1)
+    return (host,int(port))
+  return address
+
+def _keyPath(address):
+  return address + '.key'
+
+def prepareDirectory(address):
+  # Creates the directory of the unix socket, which must only be accessible by this user
+  directory = os.path.dirname(os.path.abspath(address))
+  os.makedirs(directory,mode=0o700,exist_ok=True)
+  st = os.stat(directory)
+  if st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise RuntimeError(f'IPC directory {directory} must be owned by this user with mode 0700')
+
+def getAuthKey(address,create=False):
+  # Returns BESIM_IPC_AUTHKEY, or the key generated by the engine (a new one if create is set)
+  key = os.getenv('BESIM_IPC_AUTHKEY')
+  if key:
+    return key.encode()
+  if not isinstance(address,str):
+    raise RuntimeError('BESIM_IPC_AUTHKEY must be set to use IPC over TCP')
+  path = _keyPath(address)
+  if create:
+    key = secrets.token_bytes(32)
+    fd = os.open(path+'.tmp',os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600)
+    with os.fdopen(fd,'wb') as f:
+      f.write(key)
+    os.replace(path+'.tmp',path)
+    return key
+  with open(path,'rb') as f:
+    return f.read()
+
+class EngineServer(threading.Thread):
+  # Methods of the UdpServer which take (addr,device,deviceid,...)
+  # The engine looks up addr and device itself, so the worker only sends deviceid
+  DEVICE_METHODS = ( 'send_SET', 'send_SETs', 'send_PROGRAM', 'send_PROGRAMs', 'send_DEVICE_TIME', 'send_OUTSIDE_TEMP', 'send_FAKE_BOOST' )
+  # Other methods of the UdpServer the workers can call
+  METHODS = ( 'query', 'findCommand', 'getCommand', 'getLinkStats', 'setDeviceLocation', 'getMetrics',
+              'startProfile', 'getProfile', 'getProfileData', 'getLiveRooms', 'getEvents',
+              'scheduleSet', 'getScheduled', 'cancelScheduled' )
+
+  def __init__(self,udpServer,address=None,authkey=None):
+    threading.Thread.__init__(self,daemon=True)
+    self.udpServer = udpServer
+    self.address = address if address is not None else getAddress()
+    if isinstance(self.address,str):
+      prepareDirectory(self.address)
+    self.authkey = authkey if authkey is not None else getAuthKey(self.address,create=True)
+
+  def run(self):
+    if isinstance(self.address,str) and os.path.exists(self.address):
+      os.unlink(self.address)
+    with Listener(self.address,authkey=self.authkey) as listener:
+      if isinstance(self.address,str):
+        os.chmod(self.address,0o600)
+      logger.info(f'IPC server is listening on {self.address}')
+      while True:
+        try:
+          conn = listener.accept()
+        except Exception:
+          logger.exception('Failed to accept IPC connection')
+          continue
+        threading.Thread(target=self.serve,args=(conn,),daemon=True).start()
+
+  def dispatch(self,method,args,kwargs):
+    if method == 'getState':
+      return getState()
+    elif method == 'getWeather':
+      from weather import getWeatherUpdate # the engine imports weather once the UDP server is running
+      return getWeatherUpdate(*args,**kwargs)
+    elif method in self.DEVICE_METHODS:
+      deviceid = args[0]
+      device = getDeviceStatus(deviceid)
+      return getattr(self.udpServer,method)(device['addr'],device,*args,**kwargs)
+    elif method in self.METHODS:
+      return getattr(self.udpServer,method)(*args,**kwargs)
+    else:
+      raise ValueError(f'Unknown method {method}')
+
+  def serve(self,conn):
+    with conn:
+      while True:
+        try:
+          method, args, kwargs = conn.recv()
+        except (EOFError,OSError):
+          return
+        try:
+          reply = ('ok',self.dispatch(method,args,kwargs))
+        except Exception as e:
+          logger.exception(f'IPC request {method} failed')
+          reply = ('error',f'{type(e).__name__}: {e}')
+        conn.send(reply)
+
+class RemoteUdpServer():
+  # Stands in for the UdpServer in a REST worker process, forwarding requests to the engine
+
+  def __init__(self,address=None,authkey=None):
+    self.address = address if address is not None else getAddress()
+    self.authkey = authkey          # if None, read when connecting, as the engine generates a new key when it restarts
+    if self.authkey is None and not isinstance(self.address,str):
+      getAuthKey(self.address)      # refuse TCP without BESIM_IPC_AUTHKEY straight away
+    self.local = threading.local() # connections cannot be shared between threads
+
+  def call(self,method,*args,**kwargs):
+    for attempt in range(2):
+      conn = getattr(self.local,'conn',None)
+      if conn is None:
+        conn = self.local.conn = Client(self.address,authkey=self.authkey if self.authkey is not None else getAuthKey(self.address))
+      try:
+        conn.send((method,args,kwargs))
+        status, result = conn.recv()
+        break
+      except (EOFError,OSError):
+        # Engine may have restarted, reconnect once
+        self.local.conn = None
+        if attempt:
+          raise
+    if status != 'ok':
+      raise RuntimeError(result)
+    return result
+
+  def getWeather(self,*args,**kwargs):
+    return self.call('getWeather',*args,**kwargs)
+
+  def send_SET(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_SET',deviceid,*args,**kwargs)
+
+  def send_SETs(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_SETs',deviceid,*args,**kwargs)
+
+  def send_PROGRAM(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_PROGRAM',deviceid,*args,**kwargs)
+
+  def send_PROGRAMs(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_PROGRAMs',deviceid,*args,**kwargs)
+
+  def send_DEVICE_TIME(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_DEVICE_TIME',deviceid,*args,**kwargs)
+
+  def send_OUTSIDE_TEMP(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_OUTSIDE_TEMP',deviceid,*args,**kwargs)
+
+  def send_FAKE_BOOST(self,addr,device,deviceid,*args,**kwargs):
+    return self.call('send_FAKE_BOOST',deviceid,*args,**kwargs)
+
+  def query(self,*args,**kwargs):
+    return self.call('query',*args,**kwargs)
+
+  def findCommand(self,*args,**kwargs):
+    return self.call('findCommand',*args,**kwargs)
+
+  def getCommand(self,*args,**kwargs):
+    return self.call('getCommand',*args,**kwargs)
+
+  def getLinkStats(self,*args,**kwargs):
+    return self.call('getLinkStats',*args,**kwargs)
+
+  def setDeviceLocation(self,*args,**kwargs):
+    return self.call('setDeviceLocation',*args,**kwargs)
+
+  def getMetrics(self,*args,**kwargs):
+    return self.call('getMetrics',*args,**kwargs)
+
+  def startProfile(self,*args,**kwargs):
+    return self.call('startProfile',*args,**kwargs)
+
+  def getProfile(self,*args,**kwargs):
+    return self.call('getProfile',*args,**kwargs)
+
+  def getProfileData(self,*args,**kwargs):
+    return self.call('getProfileData',*args,**kwargs)
+
+  def getLiveRooms(self,*args,**kwargs):
+    return self.call('getLiveRooms',*args,**kwargs)
+
+  def getEvents(self,*args,**kwargs):
+    return self.call('getEvents',*args,**kwargs)
+
+  def scheduleSet(self,*args,**kwargs):
+    return self.call('scheduleSet',*args,**kwargs)
+
+  def getScheduled(self,*args,**kwargs):
+    return self.call('getScheduled',*args,**kwargs)
+
+  def cancelScheduled(self,*args,**kwargs):
+    return self.call('cancelScheduled',*args,**kwargs)
+
+class StatusMirror():
+  # Keeps the status in a REST worker process up to date with the engine
+  INTERVAL = 1.0            # seconds between refreshes
+
+  def __init__(self,remote,interval=INTERVAL):
+    self.remote = remote
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.lastRefresh = 0
+
+  def refresh(self):
+    with self.lock:
+      if self.lastRefresh + self.interval > time.monotonic():
+        return
+      setState(self.remote.call('getState'))
+      getViews().invalidateAll()
+      self.lastRefresh = time.monotonic()
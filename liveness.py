@@ -0,0 +1,153 @@
+import time
+import heapq
+import itertools
+import threading
+import logging
+from collections import deque
+
+from status import getStatus, getStatusLock, getDeviceStatus, getRoomStatus
+from views import invalidateDevice, invalidateRoom
+
+logger = logging.getLogger(__name__)
+
+#
+# Tracks which devices and rooms are online
+#
+# The UdpServer calls seen() for each device and room in a STATUS message. A
+# device or room which has not been seen for TIMEOUT seconds goes offline.
+# Each online device/room has a single entry in a heap ordered by when it
+# would time out, so going offline is detected without scanning the status.
+#
+# Transitions set 'online' in the device/room status, and are recorded as
+# events which can be read from the REST API (see getEvents) or passed to
+# listeners.
+#
+
+class LivenessTracker(threading.Thread):
+  TIMEOUT = 600                   # seconds
+  MAX_EVENTS = 1024
+
+  def __init__(self,timeout=TIMEOUT):
+    threading.Thread.__init__(self,daemon=True)
+    self.timeout = timeout
+    self.cond = threading.Condition()
+    self.lastseen = {}            # (deviceid,room) -> time last seen, room is None for the device itself
+    self.heap = []                # (due,token,(deviceid,room)), one entry per online device/room
+    self.tokens = {}              # (deviceid,room) -> token of its entry in the heap
+    self.nextToken = itertools.count()
+    self.live = {}                # deviceid -> set of online rooms
+    self.events = deque(maxlen=self.MAX_EVENTS)
+    self.eventSeq = itertools.count(1)
+    self.listeners = []
+    self.stop = False
+
+  def addListener(self,fn):
+    # fn(event) is called from the tracker thread or the UDP thread on each transition
+    self.listeners.append(fn)
+
+  def seen(self,deviceid,room=None,ts=None):
+    if ts is None:
+      ts = time.time()
+    key = (deviceid,room)
+    with self.cond:
+      online = key in self.lastseen
+      self.lastseen[key] = max(ts,self.lastseen.get(key,0))
+      if online:
+        return
+      self.tokens[key] = next(self.nextToken)
+      heapq.heappush(self.heap,(self.lastseen[key]+self.timeout,self.tokens[key],key))
+      if room is not None:
+        self.live.setdefault(deviceid,set()).add(room)
+      self.cond.notify()
+    self._transition(key,True)
+
+  def seed(self):
+    # Start tracking the devices and rooms in the status, eg after it has been restored from disk
+    now = time.time()
+    with getStatusLock():
+      entries = []
+      for deviceid, deviceStatus in getStatus()['devices'].items():
+        entries.append((deviceid,None,deviceStatus))
+        entries.extend((deviceid,room,roomStatus) for room,roomStatus in deviceStatus['rooms'].items())
+      for deviceid, room, entry in entries:
+        if entry.get('lastseen',0) + self.timeout <= now:
+          entry['online'] = False
+    for deviceid, room, entry in entries:
+      if entry.get('lastseen',0) + self.timeout > now:
+        self.seen(deviceid,room,entry['lastseen'])
+
+  def forget(self,deviceid):
+    # The device has been removed from the status, drop it without an event
+    with self.cond:
+      for key in [ key for key in self.lastseen if key[0]==deviceid ]:
+        del self.lastseen[key]
+        del self.tokens[key]      # its entry in the heap is skipped when it is popped
+      self.live.pop(deviceid,None)
+
+  def liveRooms(self,deviceid):
+    with self.cond:
+      return sorted(self.live.get(deviceid,()))
+
+  def liveDevices(self):
+    with self.cond:
+      return sorted(deviceid for deviceid,room in self.lastseen if room is None)
+
+  def getEvents(self,since=0):
+    # Returns the events with a sequence number after since, oldest first
+    with self.cond:
+      return [ event for event in self.events if event['seq'] > since ]
+
+  def _transition(self,key,online):
+    deviceid, room = key
+    with getStatusLock():
+      if deviceid in getStatus()['devices']:
+        if room is None:
+          getDeviceStatus(deviceid)['online'] = online
+        else:
+          getRoomStatus(deviceid,room)['online'] = online
+    if room is None:
+      invalidateDevice(deviceid)
+    else:
+      invalidateRoom(deviceid,room)
+
+    event = { 'ts' : int(time.time()), 'event' : 'online' if online else 'offline', 'deviceid' : deviceid, 'room' : room }
+    with self.cond:
+      event['seq'] = next(self.eventSeq)
+      self.events.append(event)
+    logger.info(f'{deviceid=} {room=} is {event["event"]}')
+    for fn in self.listeners:
+      try:
+        fn(event)
+      except Exception:
+        logger.exception('Liveness listener failed')
+
+  def shutdown(self):
+    with self.cond:
+      self.stop = True
+      self.cond.notify()
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.stop and (not self.heap or self.heap[0][0] > time.time()):
+          self.cond.wait(self.heap[0][0]-time.time() if self.heap else None)
+        if self.stop:
+          return
+        due, token, key = heapq.heappop(self.heap)
+        if self.tokens.get(key) != token:
+          continue                # forgotten
+        lastseen = self.lastseen[key]
+        if lastseen + self.timeout > time.time():
+          # Seen since this entry was pushed
+          heapq.heappush(self.heap,(lastseen+self.timeout,token,key))
+          continue
+        del self.lastseen[key]
+        del self.tokens[key]
+        deviceid, room = key
+        if room is not None:
+          rooms = self.live.get(deviceid)
+          if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+              del self.live[deviceid]
+      self._transition(key,False)
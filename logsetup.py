@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+
+import metrics
+
+#
+# Logging setup for BeSIM
+#
+# Records are put on a queue and formatted and written by a background thread,
+# so slow log output never delays the UDP thread. Log with %-style arguments
+# rather than f-strings on the UDP thread, so the formatting is left to that thread
+# (and only done if the record is logged), and only pass arguments which are not
+# changed afterwards.
+#
+# Messages logged from the same place (file and line) more than BESIM_LOG_RATE
+# times a minute are suppressed, and the number suppressed is logged by the
+# background thread once the minute has passed (or added to the next message
+# from there, if that comes first). Errors are never suppressed.
+#
+# The log level is set with BESIM_LOG_LEVEL (default INFO).
+#
+
+FORMAT = '[%(asctime)s %(filename)s->%(funcName)s():%(lineno)s] %(levelname)s: %(message)s'
+
+class RateLimitFilter(logging.Filter):
+  INTERVAL = 60                 # seconds
+
+  def __init__(self,rate,interval=INTERVAL):
+    logging.Filter.__init__(self)
+    self.rate = rate
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.windows = {}             # (pathname,lineno) -> [start of window,messages logged,messages suppressed,last suppressed record]
+
+  def filter(self,record):
+    if self.rate <= 0 or record.levelno >= logging.ERROR:
+      return True
+    key = (record.pathname,record.lineno)
+    with self.lock:
+      window = self.windows.get(key)
+      if window is None or record.created - window[0] >= self.interval:
+        suppressed = window[2] if window is not None else 0
+        self.windows[key] = [record.created,1,0,None]
+      elif window[1] < self.rate:
+        window[1] += 1
+        suppressed = 0
+      else:
+        window[2] += 1
+        window[3] = (record.name,record.levelno,record.pathname,record.lineno,record.funcName)
+        metrics.LOG_SUPPRESSED.inc()
+        return False
+    if suppressed:
+      record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+      record.args = None
+    return True
+
+  def expired(self,now=None):
+    # Removes the windows which have ended, and returns a record reporting the messages suppressed in each
+    now = time.time() if now is None else now
+    records = []
+    with self.lock:
+      for key, window in list(self.windows.items()):
+        if now - window[0] < self.interval:
+          continue
+        del self.windows[key]
+        if window[2]:
+          name, levelno, pathname, lineno, funcName = window[3]
+          records.append(logging.LogRecord(name,levelno,pathname,lineno,'%d similar messages suppressed',(window[2],),None,funcName))
+    return records
+
+class AsyncHandler(logging.handlers.QueueHandler):
+  # Hands records to the QueueListener thread, which formats and writes them
+  MAX_QUEUE = 10000
+
+  def __init__(self):
+    logging.handlers.QueueHandler.__init__(self,queue.Queue(self.MAX_QUEUE))
+
+  def prepare(self,record):
+    # The queue is in-process, so the record is passed as it is and the listener formats it
+    return record
+
+  def enqueue(self,record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      metrics.LOG_DROPPED.inc()
+
+class AsyncListener(logging.handlers.QueueListener):
+  # Writes the records from the queue, and reports the messages suppressed by the rate limit
+  FLUSH_INTERVAL = 5              # seconds
+
+  def __init__(self,queue,rateLimit,*handlers):
+    logging.handlers.QueueListener.__init__(self,queue,*handlers,respect_handler_level=True)
+    self.rateLimit = rateLimit
+    self.nextFlush = time.monotonic() + self.FLUSH_INTERVAL
+
+  def dequeue(self,block):
+    while True:
+      now = time.monotonic()
+      if now >= self.nextFlush:
+        self.nextFlush = now + self.FLUSH_INTERVAL
+        for record in self.rateLimit.expired():
+          self.handle(record)
+      try:
+        return self.queue.get(block,self.nextFlush-now)
+      except queue.Empty:
+        if not block:
+          raise
+
+def setupLogging(level=None):
+  # Configures the root logger, and returns the QueueListener writing the log
+  if level is None:
+    level = os.getenv('BESIM_LOG_LEVEL','INFO').upper()
+  try:
+    rate = int(os.getenv('BESIM_LOG_RATE','10'))
+  except ValueError:
+    rate = 10
+
+  output = logging.StreamHandler(sys.stderr)
+  output.setFormatter(logging.Formatter(FORMAT))
+
+  rateLimit = RateLimitFilter(rate)
+  handler = AsyncHandler()
+  handler.addFilter(rateLimit)
+
+  root = logging.getLogger()
+  for h in list(root.handlers):
+    root.removeHandler(h)
+  root.addHandler(handler)
+  root.setLevel(level)
+
+  listener = AsyncListener(handler.queue,rateLimit,output)
+  listener.start()
+  atexit.register(listener.stop)  # flush the queue on exit
+  return listener
+
+class StartupTimer():
+  # Times the phases of startup, and logs them once startup is complete
+  def __init__(self):
+    self.start = self.last = time.monotonic()
+    self.phases = []              # (name,seconds)
+
+  def mark(self,name):
+    # Ends the phase called name
+    now = time.monotonic()
+    self.phases.append((name,now-self.last))
+    self.last = now
+
+  def report(self):
+    phases = ', '.join(f'{name} {seconds*1000:.0f}ms' for name,seconds in self.phases)
+    logging.getLogger(__name__).info(f'Started in {(self.last-self.start)*1000:.0f}ms: {phases}')
@@ -0,0 +1,155 @@
+import time
+import bisect
+import threading
+import contextlib
+
+#
+# Minimal metrics registry, exposed in the Prometheus text format at /metrics
+#
+# Each metric keeps one series per combination of label values. To bound the
+# memory used by per-device labels, once a metric has MAX_SERIES series any new
+# combination of label values is counted under 'other'.
+#
+
+MAX_SERIES = 64
+
+def _escape(v):
+  return v.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+class Metric():
+  TYPE = None
+
+  def __init__(self,name,help,labels=(),maxSeries=MAX_SERIES):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.maxSeries = maxSeries
+    self.lock = threading.Lock()
+    self.series = {}              # tuple of label values -> value
+
+  def _key(self,labelValues):
+    # Must be called with the lock held
+    key = tuple(str(v) for v in labelValues)
+    if len(key) != len(self.labels):
+      raise ValueError(f'{self.name} expects labels {self.labels}')
+    if key not in self.series and len(self.series) >= self.maxSeries:
+      key = ('other',) * len(self.labels)
+    return key
+
+  def _labelString(self,key,extra=()):
+    pairs = [ f'{l}="{_escape(v)}"' for l,v in zip(self.labels,key) ] + [ f'{l}="{v}"' for l,v in extra ]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+  def render(self):
+    lines = [ f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}' ]
+    with self.lock:
+      for key,value in sorted(self.series.items()):
+        lines.extend(self._renderSeries(key,value))
+    return lines
+
+  def _renderSeries(self,key,value):
+    return [ f'{self.name}{self._labelString(key)} {value}' ]
+
+class Counter(Metric):
+  TYPE = 'counter'
+
+  def inc(self,*labelValues,value=1):
+    with self.lock:
+      key = self._key(labelValues)
+      self.series[key] = self.series.get(key,0) + value
+
+class Gauge(Metric):
+  TYPE = 'gauge'
+
+  def set(self,value,*labelValues):
+    with self.lock:
+      self.series[self._key(labelValues)] = value
+
+class Histogram(Metric):
+  TYPE = 'histogram'
+  BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 )
+
+  def __init__(self,name,help,labels=(),buckets=BUCKETS,maxSeries=MAX_SERIES):
+    Metric.__init__(self,name,help,labels,maxSeries)
+    self.buckets = tuple(buckets)
+
+  def observe(self,value,*labelValues):
+    with self.lock:
+      key = self._key(labelValues)
+      series = self.series.get(key)
+      if series is None:
+        series = self.series[key] = { 'counts' : [0] * (len(self.buckets)+1), 'sum' : 0.0, 'count' : 0 }
+      series['counts'][bisect.bisect_left(self.buckets,value)] += 1
+      series['sum'] += value
+      series['count'] += 1
+
+  @contextlib.contextmanager
+  def time(self,*labelValues):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter()-start,*labelValues)
+
+  def _renderSeries(self,key,series):
+    lines = []
+    cumulative = 0
+    for bound,count in zip(self.buckets + ( '+Inf', ),series['counts']):
+      cumulative += count
+      lines.append(f'{self.name}_bucket{self._labelString(key,( ("le",bound), ))} {cumulative}')
+    lines.append(f'{self.name}_sum{self._labelString(key)} {series["sum"]}')
+    lines.append(f'{self.name}_count{self._labelString(key)} {series["count"]}')
+    return lines
+
+class Registry():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.metrics = {}
+
+  def _register(self,cls,name,*args,**kwargs):
+    with self.lock:
+      if name not in self.metrics:
+        self.metrics[name] = cls(name,*args,**kwargs)
+      return self.metrics[name]
+
+  def counter(self,name,help,labels=()):
+    return self._register(Counter,name,help,labels)
+
+  def gauge(self,name,help,labels=()):
+    return self._register(Gauge,name,help,labels)
+
+  def histogram(self,name,help,labels=(),buckets=Histogram.BUCKETS):
+    return self._register(Histogram,name,help,labels,buckets)
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+Metrics = Registry()
+
+def getRegistry():
+  return Metrics
+
+#
+# Metrics used by BeSIM
+#
+
+PACKETS_RECEIVED = Metrics.counter('besim_packets_received_total','UDP packets received')
+BYTES_RECEIVED = Metrics.counter('besim_bytes_received_total','UDP bytes received')
+DECODE_ERRORS = Metrics.counter('besim_decode_errors_total','UDP packets which could not be decoded')
+HANDLER_ERRORS = Metrics.counter('besim_handler_errors_total','Exceptions while handling a message',('msgtype',))
+HANDLER_SECONDS = Metrics.histogram('besim_handler_seconds','Time to handle an uplink message',('msgtype',))
+MESSAGES_SENT = Metrics.counter('besim_messages_sent_total','Downlink messages sent',('msgtype',))
+COMMAND_SECONDS = Metrics.histogram('besim_command_seconds','Time from sending a command to the response from the device',('deviceid',))
+COMMAND_RETRANSMITS = Metrics.counter('besim_command_retransmits_total','Commands retransmitted',('deviceid',))
+COMMAND_TIMEOUTS = Metrics.counter('besim_command_timeouts_total','Commands which timed out',('deviceid',))
+DB_SECONDS = Metrics.histogram('besim_db_seconds','Time taken by database operations',('operation',))
+DEVICES = Metrics.gauge('besim_devices','Devices in the status')
+PEERS = Metrics.gauge('besim_peers','Peer addresses in the status')
+COMMANDS_PENDING = Metrics.gauge('besim_commands_pending','Commands waiting for a response from the device')
+LOG_SUPPRESSED = Metrics.counter('besim_log_suppressed_total','Log messages suppressed by the rate limit')
+LOG_DROPPED = Metrics.counter('besim_log_dropped_total','Log messages dropped because the log queue was full')
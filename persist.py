@@ -0,0 +1,129 @@
+import os
+import gzip
+import json
+import time
+import threading
+import logging
+
+from status import getStatus, getStatusLock
+
+logger = logging.getLogger(__name__)
+
+#
+# Saves the status (see status.py) to disk, so after a restart the last known
+# state of the devices, rooms and programs is available straight away and the
+# programs do not all need to be fetched from the devices again.
+#
+# The state is saved periodically and on shutdown as gzipped JSON, with each
+# day of a program stored as a hex string.
+#
+# Programs older than MAX_PROGRAM_AGE are not restored, so they are fetched
+# from the device again in case they were changed on the thermostat meanwhile.
+#
+# The changes scheduled with the UDP server (see UdpServer.scheduleSet) are
+# saved too, and rescheduled when the state is restored.
+#
+
+VERSION = 1
+
+def _encodeRoom(roomStatus):
+  room = { k : v for k,v in roomStatus.items() if k != 'days' }
+  room['days'] = { str(day) : bytes(prog).hex() for day,prog in roomStatus['days'].items() }
+  return room
+
+def _decodeRoom(room,restorePrograms):
+  roomStatus = { k : v for k,v in room.items() if k != 'days' }
+  roomStatus['days'] = { int(day) : list(bytes.fromhex(prog)) for day,prog in room['days'].items() } if restorePrograms else {}
+  return roomStatus
+
+def dumpState(udpServer=None):
+  # Returns the status, and the changes scheduled with udpServer, as a JSON serializable dict
+  with getStatusLock():
+    devices = []
+    for deviceid, deviceStatus in getStatus()['devices'].items():
+      device = { k : v for k,v in deviceStatus.items() if k not in ( 'rooms', 'lastcseq' ) }
+      device['rooms'] = { str(room) : _encodeRoom(roomStatus) for room,roomStatus in deviceStatus['rooms'].items() }
+      devices.append(device)
+    peers = []
+    for addr, peerStatus in getStatus()['peers'].items():
+      peer = dict(peerStatus,addr=addr)
+      peer['devices'] = sorted(peerStatus['devices'])
+      peers.append(peer)
+  scheduled = udpServer.dumpScheduled() if udpServer is not None else []
+  return { 'version' : VERSION, 'ts' : time.time(), 'devices' : devices, 'peers' : peers, 'scheduled' : scheduled }
+
+def restoreState(state,maxProgramAge):
+  # Replaces the status with one returned by dumpState()
+  restorePrograms = state['ts'] + maxProgramAge > time.time()
+  devices = {}
+  for device in state['devices']:
+    deviceStatus = { k : v for k,v in device.items() if k != 'rooms' }
+    if 'addr' in deviceStatus:
+      deviceStatus['addr'] = tuple(deviceStatus['addr'])
+    deviceStatus['rooms'] = { int(room) : _decodeRoom(roomStatus,restorePrograms) for room,roomStatus in device['rooms'].items() }
+    devices[deviceStatus['deviceid']] = deviceStatus
+  peers = {}
+  for peer in state['peers']:
+    peerStatus = { k : v for k,v in peer.items() if k != 'addr' }
+    peerStatus['devices'] = set(peer['devices'])
+    peers[tuple(peer['addr'])] = peerStatus
+  with getStatusLock():
+    getStatus()['devices'] = devices
+    getStatus()['peers'] = peers
+  return restorePrograms
+
+class StateStore(threading.Thread):
+  INTERVAL = 60                   # seconds between saves
+  MAX_PROGRAM_AGE = 86400         # seconds
+
+  def __init__(self,path,udpServer=None,interval=INTERVAL,maxProgramAge=MAX_PROGRAM_AGE):
+    threading.Thread.__init__(self,daemon=True)
+    self.path = path
+    self.udpServer = udpServer    # to save and restore its scheduled changes
+    self.interval = interval
+    self.maxProgramAge = maxProgramAge
+    self.lock = threading.Lock()  # serializes saves
+    self.stop = threading.Event()
+
+  def load(self):
+    # Restores the status from the last save, returns True if it was restored
+    if not os.path.exists(self.path):
+      return False
+    start = time.monotonic()
+    try:
+      with gzip.open(self.path,'rt') as f:
+        state = json.load(f)
+      if state.get('version') != VERSION:
+        logger.warning(f'Ignoring state {self.path} with version {state.get("version")}')
+        return False
+      restorePrograms = restoreState(state,self.maxProgramAge)
+      if self.udpServer is not None:
+        self.udpServer.restoreScheduled(state.get('scheduled',[]))
+    except (OSError,ValueError,KeyError,TypeError):
+      logger.exception(f'Failed to restore state from {self.path}')
+      return False
+    logger.info(f'Restored {len(state["devices"])} devices from {self.path} in {time.monotonic()-start:.3f}s' + ('' if restorePrograms else ', programs are too old and will be fetched again'))
+    return True
+
+  def save(self):
+    state = dumpState(self.udpServer)
+    with self.lock:
+      try:
+        tmp = self.path + '.tmp'
+        with gzip.open(tmp,'wt',compresslevel=6) as f:
+          json.dump(state,f,separators=(',',':'))
+        os.replace(tmp,self.path)
+      except OSError:
+        logger.exception(f'Failed to save state to {self.path}')
+
+  def shutdown(self):
+    self.stop.set()
+    self.save()
+
+  def run(self):
+    while not self.stop.wait(self.interval):
+      self.save()
+
+def getStatePath():
+  # BESIM_STATE is the file used to persist the status, or empty to not persist it
+  return os.getenv('BESIM_STATE','besim_state.json.gz') or None
@@ -0,0 +1,192 @@
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+import contextlib
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+#
+# On-demand profiling of the UDP message handlers and the REST handlers
+#
+# A profiling session runs for a fixed number of seconds, and either:
+#  - 'cprofile' : runs cProfile around each handler, or
+#  - 'sampling' : periodically samples the stacks of the threads which are in a handler,
+#                 which has a much lower overhead
+# Both also record the wall time of each handler by MsgId (udp) or endpoint (rest).
+#
+# The results can be downloaded as pstats (cprofile) or collapsed stacks (sampling),
+# the latter can be turned into a flame graph with eg flamegraph.pl or speedscope.
+#
+
+TARGETS = ( 'udp', 'rest' )
+KINDS = ( 'cprofile', 'sampling' )
+
+class Session():
+  INTERVAL = 0.005              # seconds between samples
+  MAX_STACKS = 10000            # distinct collapsed stacks kept
+
+  def __init__(self,kind,seconds,targets):
+    self.kind = kind
+    self.targets = frozenset(targets)
+    self.started = time.time()
+    self.ends = self.started + seconds
+    self.lock = threading.Lock()
+    self.breakdown = {}           # (target,label) -> [count,total,max]
+    # cprofile
+    self.profile = cProfile.Profile() if kind == 'cprofile' else None
+    self.profileLock = threading.Lock() # only one thread can be profiled at a time
+    self.profiled = 0
+    self.skipped = 0
+    # sampling
+    self.active = {}              # thread id -> label of the handler it is running
+    self.stacks = Counter()       # collapsed stack -> number of samples
+    self.samples = 0
+
+  def running(self):
+    return time.time() < self.ends
+
+  @contextlib.contextmanager
+  def section(self,target,label):
+    tid = threading.get_ident()
+    profiling = False
+    if self.profile is not None:
+      profiling = self.profileLock.acquire(blocking=False)
+      if profiling:
+        try:
+          self.profile.enable()
+        except ValueError:
+          # Another profiler is active (eg a debugger)
+          self.profileLock.release()
+          profiling = False
+    else:
+      self.active[tid] = f'{target}:{label}'
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      if profiling:
+        self.profile.disable()
+        self.profileLock.release()
+      self.active.pop(tid,None)
+      with self.lock:
+        if self.profile is not None:
+          if profiling:
+            self.profiled += 1
+          else:
+            self.skipped += 1
+        entry = self.breakdown.setdefault((target,label),[0,0.0,0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2],elapsed)
+
+  def sample(self):
+    # Runs in the sampling thread until the session ends
+    while self.running():
+      frames = sys._current_frames()
+      for tid,label in list(self.active.items()):
+        frame = frames.get(tid)
+        if frame is None:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append(f'{code.co_filename.rsplit("/",1)[-1]}:{code.co_name}')
+          frame = frame.f_back
+        stack.append(label)
+        key = ';'.join(reversed(stack))
+        with self.lock:
+          if key in self.stacks or len(self.stacks) < self.MAX_STACKS:
+            self.stacks[key] += 1
+          self.samples += 1
+      del frames
+      time.sleep(self.INTERVAL)
+
+  def toJson(self):
+    with self.lock:
+      breakdown = {}
+      for (target,label),(count,total,longest) in sorted(self.breakdown.items(),key=lambda i: -i[1][1]):
+        breakdown.setdefault(target,{})[label] = { 'count' : count, 'total' : total, 'mean' : total/count, 'max' : longest }
+      js = {
+        'kind' : self.kind,
+        'targets' : sorted(self.targets),
+        'started' : self.started,
+        'ends' : self.ends,
+        'running' : self.running(),
+        'breakdown' : breakdown,
+      }
+      if self.profile is not None:
+        js['profiled'] = self.profiled
+        js['skipped'] = self.skipped
+      else:
+        js['samples'] = self.samples
+    return js
+
+  def pstats(self):
+    # Returns the profile in the format written by pstats.Stats.dump_stats()
+    with self.profileLock:
+      try:
+        stats = pstats.Stats(self.profile).stats
+      except TypeError:
+        stats = {}                # nothing was profiled
+    return marshal.dumps(stats)
+
+  def collapsed(self):
+    # Returns the samples as collapsed stacks, one "frame;frame;... count" per line
+    with self.lock:
+      return ''.join(f'{stack} {count}\n' for stack,count in self.stacks.most_common())
+
+class Profiler():
+  MAX_SECONDS = 600
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.session = None           # the current or last session
+
+  def start(self,kind,seconds,targets=TARGETS):
+    if kind not in KINDS:
+      raise ValueError(f'Unknown profiler {kind}')
+    if not targets or any(target not in TARGETS for target in targets):
+      raise ValueError(f'Targets must be some of {TARGETS}')
+    if not 0 < seconds <= self.MAX_SECONDS:
+      raise ValueError(f'Duration must be between 0 and {self.MAX_SECONDS} seconds')
+    with self.lock:
+      if self.session is not None and self.session.running():
+        raise RuntimeError('A profiling session is already running')
+      self.session = Session(kind,seconds,targets)
+      if kind == 'sampling':
+        threading.Thread(target=self.session.sample,daemon=True).start()
+    logger.info(f'Started {kind} profiling of {",".join(targets)} for {seconds}s')
+    return self.session.toJson()
+
+  def section(self,target,label):
+    # Context manager around a handler, which does nothing unless a session is running for the target
+    session = self.session
+    if session is None or target not in session.targets or not session.running():
+      return contextlib.nullcontext()
+    return session.section(target,label)
+
+  def status(self):
+    session = self.session
+    return session.toJson() if session is not None else None
+
+  def data(self,format):
+    # Returns the results of the last session as bytes, or None if there are none in that format
+    session = self.session
+    if session is None:
+      return None
+    if format == 'pstats' and session.kind == 'cprofile':
+      return session.pstats()
+    if format == 'collapsed' and session.kind == 'sampling':
+      return session.collapsed().encode()
+    return None
+
+Profiling = Profiler()
+
+def getProfiler():
+  return Profiling
@@ -1,68 +1,100 @@
-from flask import Flask, request
+from flask import Flask, request, g
 from flask_restful import reqparse, abort, Api, Resource
 from flask_cors import CORS
-import json
 import time
 import logging
 import os
-import requests
-from cachetools import cached, TTLCache
-from threading import RLock
 
 from webargs import fields,validate
 from webargs.flaskparser import use_kwargs,use_args
 
-from udpserver import MsgId
-from status import getStatus,getDeviceStatus,getRoomStatus
+from udpserver import UdpServer, MsgId, COMMAND_TIMEOUT
+from status import getStatus,getDeviceStatus,getRoomStatus,getSnapshot,getStatusLock,copyDeviceStatus,copyRoomStatus
+from views import getViews
 from database import Database
+from weather import getWeather, Forecast
+from profiling import getProfiler, KINDS, TARGETS
+from analytics import roomAnalytics, BASE_TEMPERATURE
+from archive import getArchive, withArchive
 
 logger = logging.getLogger(__name__)
 
-class SetEncoder(json.JSONEncoder):
-  def default(self,o):
-    if isinstance(o,set):
-      return list(o)
-    return json.JSONEncoder.default(self,o)
-
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
 
+#
+# Room parameters which can be set on the thermostat and the MsgId used to set them
+#
+WRITEABLE_PARAMS = {
+  't1' : MsgId.SET_T1,
+  't2' : MsgId.SET_T2,
+  't3' : MsgId.SET_T3,
+  'tempcurve' : MsgId.SET_CURVE,
+  'minsetp' : MsgId.SET_MIN_HEAT_SETP,
+  'maxsetp' : MsgId.SET_MAX_HEAT_SETP,
+  'units' : MsgId.SET_UNITS,
+  'winter' : MsgId.SET_SEASON,
+  'sensorinfluence' : MsgId.SET_SENSOR_INFLUENCE,
+  'advance' : MsgId.SET_ADVANCE,
+  'mode' : MsgId.SET_MODE,
+}
+
 def getUdpServer():
   return app.config['udpServer']
 
-@cached(cache=TTLCache(maxsize=1, ttl=3600), lock=RLock())
-def getWeather():
-  # Uses met.no to get the weather at the servers' latitude, longitude
-  # See https://api.met.no/doc/TermsOfService and https://api.met.no/doc/License
-  url = 'https://api.met.no/weatherapi/locationforecast/2.0/complete'
-
-  # Get the lat/long from environment
-  latitude = os.getenv('LATITUDE',None)
-  longitude = os.getenv('LONGITUDE',None)
-
-  if latitude is None or longitude is None:
-    return { }, 500
+def checkParamValue(param,val):
+  # Aborts unless val is an int (not a bool) which fits in the payload of the SET message for param
+  if type(val) is not int:
+    abort(400, message=f'Invalid value for {param}')
+  limit = 1 << 8*UdpServer.set_messages_payload_size(WRITEABLE_PARAMS[param])
+  if not 0 <= val < limit:
+    abort(400, message=f'Value for {param} must be between 0 and {limit-1}')
+
+@app.before_request
+def startProfileSection():
+  g.profileSection = getProfiler().section('rest',request.endpoint)
+  g.profileSection.__enter__()
+
+@app.teardown_request
+def endProfileSection(exc):
+  section = g.pop('profileSection',None)
+  if section is not None:
+    section.__exit__(None,None,None)
+
+def jsonResponse(body):
+  # Returns pre-serialized JSON bytes as the response
+  return app.response_class(body, mimetype='application/json')
 
+#
+# Commands can be submitted asynchronously by adding ?async=true to the request
+# The response is then HTTP 202 with the command id, and the outcome is available from /api/v1.0/commands/<id>
+#
+ASYNC_ARGS = { "async" : fields.Bool(load_default=False) }
+
+def commandSubmitted(deviceid,cseq):
+  cmd = getUdpServer().findCommand(deviceid,cseq)
+  return cmd, 202, { 'Location' : api.url_for(CommandResource, commandid=cmd['id']) }
+
+def readRoomStatus(deviceid,roomid):
+  # Returns the room status, with the latest values from the shared memory status table if there is one
+  roomStatus = getRoomStatus(deviceid,roomid)
+  statusTable = app.config.get('statusTable')
+  if statusTable is not None:
+    latest = statusTable.read(deviceid,roomid)
+    if latest is not None:
+      roomStatus = dict(roomStatus,**latest)
+  return roomStatus
+
+def getDeviceLocation(deviceid):
+  # Returns the location configured for the device, or None to use the servers' location
   try:
-    latitude = float(latitude)
-    longitude = float(longitude)
-  except ValueError:
-    return { }, 500
-
-  params = { 'lat':latitude, 'lon':longitude }
-  headers = { 'User-Agent': 'BeSim/0.1 github.com/jimmyH/BeSIM' }
-
-  r = requests.get(url,params=params,headers=headers)
-  if r.status_code==200:
-    js = r.json()
-
-    temp = js['properties']['timeseries'][0]['data']['instant']['details']['air_temperature']
-    Database().log_outside_temperature(temp)
-
-    return js, 200
-  else:
-    return { }, r.status_code
+    deviceid = int(deviceid)
+  except (TypeError,ValueError):
+    return None
+  if deviceid not in getStatus()['devices']:
+    return None
+  return getDeviceStatus(deviceid).get('location')
 
 #
 # Endpoints to replicate Besmart/Cloudwarm behaviour
@@ -82,11 +114,16 @@ def getVersion():
 def getWebTemperature():
   logger.debug(f'{request.args}')
   deviceId = request.args.get('deviceId')
-  weather, status_code  = getWeather()
-  if status_code != 200:
+  location = getDeviceLocation(deviceId)
+  if location is not None:
+    weather, status_code  = getWeather(location['latitude'],location['longitude'])
+  else:
+    weather, status_code  = getWeather()
+  temp = weather.current('air_temperature') if status_code == 200 else None
+  if temp is None:
     return "E_1"
   else:
-    return str(round(weather['properties']['timeseries'][0]['data']['instant']['details']['air_temperature']))
+    return str(round(temp))
 
 # www.cloudwarm.com
 #json_data={"wifi_box_id":"165XXXXXXX","start_time":"1672552802","sys_run_time":"9173915","continued_time":"3576","type":"2","value":"0"}'
@@ -104,13 +141,22 @@ def postBoilerRecords():
 def index():
   return "Web server is running"
 
+# Prometheus metrics from the UDP server (see metrics.py)
+@app.route('/metrics')
+def getMetrics():
+  return app.response_class(getUdpServer().getMetrics(),mimetype='text/plain; version=0.0.4')
+
 #
 # REST API
 #
 
+def peersView():
+  with getStatusLock():
+    return { f'{addr[0]}:{addr[1]}' : { k : (sorted(v) if isinstance(v,set) else v) for k,v in peer.items() } for addr,peer in getStatus()['peers'].items() }
+
 class Peers(Resource):
   def get(self):
-    return json.dumps(getStatus()['peers'],cls=SetEncoder) # @todo need to make flask_restful use the custom encoder
+    return jsonResponse(getViews().render(('peers',),peersView))
 
 class Devices(Resource):
   def get(self):
@@ -118,20 +164,53 @@ class Devices(Resource):
 
 class Device(Resource):
   def get(self, deviceid):
-    return getDeviceStatus(deviceid)
+    return jsonResponse(getViews().render(('device',deviceid),lambda: copyDeviceStatus(getDeviceStatus(deviceid))))
 
 class Rooms(Resource):
   def get(self, deviceid):
-    rooms = []
-    # We only return rooms we have seen in the last 10 minutes
-    for k,v in getDeviceStatus(deviceid)['rooms'].items():
-      if 'lastseen' in v and v['lastseen'] > time.time()-600:
-        rooms.append(k)
-    return rooms
+    # We only return rooms we have seen in the last 10 minutes (see liveness.py)
+    return getUdpServer().getLiveRooms(deviceid)
 
 class Room(Resource):
   def get(self, deviceid, roomid):
-    return getRoomStatus(deviceid,roomid)
+    if app.config.get('statusTable') is not None:
+      return readRoomStatus(deviceid,roomid) # changes are not seen by the view cache
+    return jsonResponse(getViews().render(('room',deviceid,roomid),lambda: copyRoomStatus(getRoomStatus(deviceid,roomid))))
+
+  def patch(self, deviceid, roomid):
+    # Update several parameters of the room at once, eg { "mode" : 0, "t3" : 195 }
+    data = request.json
+    if not isinstance(data,dict) or len(data)==0:
+      abort(400, message='Expected an object of parameter values')
+    for param,val in data.items():
+      if param not in WRITEABLE_PARAMS:
+        abort(400, message=f'Unknown parameter {param}')
+      checkParamValue(param,val)
+
+    params = list(data.keys())
+    addr = getDeviceStatus(deviceid)['addr']
+    new_vals = getUdpServer().send_SETs(addr,getDeviceStatus(deviceid),deviceid,roomid,[ (WRITEABLE_PARAMS[param],data[param]) for param in params ],wait=COMMAND_TIMEOUT)
+
+    results = {}
+    for param,new_val in zip(params,new_vals):
+      results[param] = 'OK' if new_val==data[param] else 'ERROR'
+    if 'ERROR' in results.values():
+      return { 'message' : 'ERROR', 'results' : results }, 500
+    else:
+      return { 'message' : 'OK', 'results' : results }, 200
+
+class Snapshot(Resource):
+  @use_args(
+    {
+      "fields" : fields.DelimitedList(fields.Str()),
+    },
+    location = "query")
+  def get(self, query):
+    # All devices with their rooms and OpenTherm parameters in a single response
+    selected = query.get('fields',None)
+    if selected is not None:
+      selected = set(selected)
+    return getSnapshot(selected)
 
 class ReadonlyParamResource(Resource):
   def __init__(self, **kwargs):
@@ -139,7 +218,7 @@ class ReadonlyParamResource(Resource):
 
   def get(self, deviceid, roomid=None):
     if roomid is not None:
-      return getRoomStatus(deviceid,roomid)[self.param]
+      return readRoomStatus(deviceid,roomid)[self.param]
     else:
       return getDeviceStatus(deviceid)[self.param]
 
@@ -150,13 +229,17 @@ class WriteableParamResource(Resource):
     self.msgId = kwargs['msgId']
 
   def get(self, deviceid, roomid):
-    return getRoomStatus(deviceid,roomid)[self.param]
+    return readRoomStatus(deviceid,roomid)[self.param]
 
-  def put(self, deviceid, roomid):
+  @use_args(ASYNC_ARGS, location = "query")
+  def put(self, query, deviceid, roomid):
     data = request.json
     val = data
     addr = getDeviceStatus(deviceid)['addr']
-    new_val = getUdpServer().send_SET(addr,getDeviceStatus(deviceid),deviceid,roomid,self.msgId,val,response=0,write=1,wait=1)
+    if query['async']:
+      cseq = getUdpServer().send_SET(addr,getDeviceStatus(deviceid),deviceid,roomid,self.msgId,val,response=0,write=1,wait=COMMAND_TIMEOUT,block=False)
+      return commandSubmitted(deviceid,cseq)
+    new_val = getUdpServer().send_SET(addr,getDeviceStatus(deviceid),deviceid,roomid,self.msgId,val,response=0,write=1,wait=COMMAND_TIMEOUT)
     if new_val!=val:
       return { 'message' : 'ERROR' }, 500
     else:
@@ -164,8 +247,7 @@ class WriteableParamResource(Resource):
 
 class FakeBoostResource(Resource):
   def get(self, deviceid, roomid):
-    roomStatus = getRoomStatus(deviceid,roomid)
-    return roomStatus['fakeboost']
+    return readRoomStatus(deviceid,roomid)['fakeboost']
 
   def put(self, deviceid, roomid):
     data = request.json
@@ -177,112 +259,344 @@ class FakeBoostResource(Resource):
     else:
       return { 'message' : 'OK' }, 200
 
+class Schedule(Resource):
+  def get(self, deviceid, roomid):
+    return getUdpServer().getScheduled(deviceid,roomid)
+
+  @use_args(
+    {
+      "param" : fields.Str(required=True,validate=validate.OneOf(list(WRITEABLE_PARAMS))),
+      "value" : fields.Int(required=True),
+      "at" : fields.Float(),                        # seconds since the epoch
+      "delay" : fields.Float(validate=validate.Range(min=0)),   # or seconds from now
+    },
+    location = "json")
+  def post(self, change, deviceid, roomid):
+    # Set a parameter of the room later, eg { "param" : "t3", "value" : 195, "delay" : 3600 }
+    if ('at' in change) == ('delay' in change):
+      abort(400, message='Expected one of at or delay')
+    when = change['at'] if 'at' in change else time.time() + change['delay']
+    param = change['param']
+    checkParamValue(param,change['value'])
+    job = getUdpServer().scheduleSet(deviceid,roomid,param,WRITEABLE_PARAMS[param],change['value'],when)
+    if job is None:
+      abort(404, message=f'Unknown room {roomid} of device {deviceid}, or the device has not reported yet')
+    return job, 201
+
+class ScheduledChange(Resource):
+  def delete(self, deviceid, roomid, param):
+    if not getUdpServer().cancelScheduled(deviceid,roomid,param):
+      abort(404, message=f'No change scheduled for {param}')
+    return { 'message' : 'OK' }, 200
+
 class Days(Resource):
   def get(self, deviceid, roomid):
     return list(getRoomStatus(deviceid,roomid)['days'].keys())
 
+def validProgram(prog):
+  return isinstance(prog,list) and len(prog)==24 and all(type(p) is int and 0<=p<=0xff for p in prog)
+
+def checkProgram(day,prog):
+  # Aborts unless day is 0-6 and prog is the program for a day
+  if not 0<=day<=6:
+    abort(400, message=f'Invalid day {day}')
+  if not validProgram(prog):
+    abort(400, message=f'Invalid program for day {day}, expected 24 values 0-255')
+
 class Day(Resource):
   def get(self, deviceid, roomid, dayid):
     return getRoomStatus(deviceid,roomid)['days'][dayid]
 
-  def put(self, deviceid, roomid, dayid):
+  @use_args(ASYNC_ARGS, location = "query")
+  def put(self, query, deviceid, roomid, dayid):
     data = request.json
     val = data
+    checkProgram(dayid,val)
     addr = getDeviceStatus(deviceid)['addr']
-    new_val = getUdpServer().send_PROGRAM(addr,getDeviceStatus(deviceid),deviceid,roomid,dayid,val,response=0,write=1,wait=1)
-    if new_val!=val:
+    if query['async']:
+      tag = getUdpServer().send_PROGRAM(addr,getDeviceStatus(deviceid),deviceid,roomid,dayid,val,response=0,write=1,wait=COMMAND_TIMEOUT,block=False)
+      return commandSubmitted(deviceid,tag)
+    # Not sent if the program is unchanged
+    new_vals = getUdpServer().send_PROGRAMs(addr,getDeviceStatus(deviceid),deviceid,roomid,{ dayid : val },wait=COMMAND_TIMEOUT)
+    if dayid in new_vals and new_vals[dayid]!=val:
       return { 'message' : 'ERROR' }, 500
     else:
       return { 'message' : 'OK' }, 200
 
+class Program(Resource):
+  def get(self, deviceid, roomid):
+    # The cached program for each day, { "<day>" : [ ... ], ... }
+    return copyRoomStatus(getRoomStatus(deviceid,roomid),( 'days', ))['days']
+
+  def put(self, deviceid, roomid):
+    # Write the program for several days at once, eg the whole week
+    # Accepts a list of 7 days (day 0 first), or { "<day>" : [ ... ], ... }
+    # Only the days which differ from the cached program are sent to the thermostat
+    data = request.json
+    if isinstance(data,list) and len(data)==7:
+      days = dict(enumerate(data))
+    elif isinstance(data,dict) and len(data)>0:
+      try:
+        days = { int(day) : prog for day,prog in data.items() }
+      except ValueError:
+        abort(400, message='Days must be numbers 0-6')
+    else:
+      abort(400, message='Expected a list of 7 days or an object of days')
+    for day,prog in days.items():
+      checkProgram(day,prog)
+
+    addr = getDeviceStatus(deviceid)['addr']
+    new_vals = getUdpServer().send_PROGRAMs(addr,getDeviceStatus(deviceid),deviceid,roomid,days,wait=COMMAND_TIMEOUT)
+
+    results = {}
+    for day,prog in sorted(days.items()):
+      if day not in new_vals:
+        results[day] = 'UNCHANGED'
+      else:
+        results[day] = 'OK' if new_vals[day]==prog else 'ERROR'
+    if 'ERROR' in results.values():
+      return { 'message' : 'ERROR', 'results' : results }, 500
+    else:
+      return { 'message' : 'OK', 'results' : results }, 200
+
 class TimeResource(Resource):
-  def get(self, deviceid):
+  @use_args(ASYNC_ARGS, location = "query")
+  def get(self, query, deviceid):
     val = 0
     addr = getDeviceStatus(deviceid)['addr']
-    return getUdpServer().send_DEVICE_TIME(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=0,wait=1)
+    if query['async']:
+      cseq = getUdpServer().send_DEVICE_TIME(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=0,wait=COMMAND_TIMEOUT,block=False)
+      return commandSubmitted(deviceid,cseq)
+    return getUdpServer().query(deviceid,MsgId.DEVICE_TIME)
 
-  def put(self, deviceid):
+  @use_args(ASYNC_ARGS, location = "query")
+  def put(self, query, deviceid):
     data = request.json
     val = data
     addr = getDeviceStatus(deviceid)['addr']
-    new_val = getUdpServer().send_DEVICE_TIME(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=1,wait=1)
+    if query['async']:
+      cseq = getUdpServer().send_DEVICE_TIME(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=1,wait=COMMAND_TIMEOUT,block=False)
+      return commandSubmitted(deviceid,cseq)
+    new_val = getUdpServer().send_DEVICE_TIME(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=1,wait=COMMAND_TIMEOUT)
     if new_val!=val:
       return { 'message' : 'ERROR' }, 500
     else:
       return { 'message' : 'OK' }, 200
 
+class VersionResource(Resource):
+  def get(self, deviceid):
+    return getUdpServer().query(deviceid,MsgId.SWVERSION)
+
+class Events(Resource):
+  @use_args(
+    {
+      "since" : fields.Int(load_default=0),
+    },
+    location = "query")
+  def get(self, query):
+    # Devices and rooms going online/offline, after the event with sequence number since
+    return getUdpServer().getEvents(query['since'])
+
+class CommandResource(Resource):
+  def get(self, commandid):
+    cmd = getUdpServer().getCommand(commandid)
+    if cmd is None:
+      abort(404, message=f'Unknown command {commandid}')
+    return cmd
+
+class LinkStatsResource(Resource):
+  def get(self, deviceid):
+    # Round trip time and loss statistics for commands sent to the device
+    return getUdpServer().getLinkStats(deviceid)
+
+#
+# Admin endpoints to profile the UDP and REST handlers on demand (see profiling.py)
+#
+PROFILE_FORMATS = {
+  'pstats' : ('application/octet-stream','besim.pstats'),
+  'collapsed' : ('text/plain','besim.collapsed'),
+}
+
+class ProfileResource(Resource):
+  def get(self):
+    return getUdpServer().getProfile()
+
+  @use_args(
+    {
+      "kind" : fields.Str(load_default='sampling',validate=validate.OneOf(KINDS)),
+      "seconds" : fields.Float(load_default=30,validate=validate.Range(min=0,min_inclusive=False,max=600)),
+      "targets" : fields.DelimitedList(fields.Str(validate=validate.OneOf(TARGETS)),load_default=list(TARGETS)),
+    },
+    location = "query")
+  def post(self, query):
+    try:
+      return getUdpServer().startProfile(query['kind'],query['seconds'],query['targets']), 202
+    except RuntimeError as e:
+      abort(409, message=str(e))
+
+class ProfileDataResource(Resource):
+  def get(self, format):
+    if format not in PROFILE_FORMATS:
+      abort(404, message=f'Unknown format {format}')
+    body = getUdpServer().getProfileData(format)
+    if body is None:
+      abort(404, message=f'No {format} profile available')
+    mimetype, filename = PROFILE_FORMATS[format]
+    return app.response_class(body, mimetype=mimetype, headers={ 'Content-Disposition' : f'attachment; filename={filename}' })
+
 class OutsideTempResource(Resource):
   def put(self, deviceid):
     data = request.json
     val = data
     addr = getDeviceStatus(deviceid)['addr']
-    new_val = getUdpServer().send_OUTSIDE_TEMP(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=1,wait=1)
+    new_val = getUdpServer().send_OUTSIDE_TEMP(addr,getDeviceStatus(deviceid),deviceid,val,response=0,write=1,wait=COMMAND_TIMEOUT)
     if new_val!=val:
       return { 'message' : 'ERROR' }, 500
     else:
       return { 'message' : 'OK' }, 200
 
+class LocationResource(Resource):
+  def get(self, deviceid):
+    return getDeviceStatus(deviceid).get('location')
+
+  @use_args(
+    {
+      "latitude" : fields.Float(required=True,validate=validate.Range(min=-90,max=90)),
+      "longitude" : fields.Float(required=True,validate=validate.Range(min=-180,max=180)),
+    },
+    location = "json")
+  def put(self, location, deviceid):
+    # The location is used to get the weather for the device
+    getUdpServer().setDeviceLocation(deviceid,{ 'latitude' : location['latitude'], 'longitude' : location['longitude'] })
+    return { 'message' : 'OK' }, 200
+
 class Weather(Resource):
-  def get(self):
-    return getWeather()
+  @use_args(
+    {
+      "latitude" : fields.Float(validate=validate.Range(min=-90,max=90)),
+      "longitude" : fields.Float(validate=validate.Range(min=-180,max=180)),
+      "hours" : fields.Int(validate=validate.Range(min=1)),
+      "fields" : fields.DelimitedList(fields.Str(validate=validate.OneOf(list(Forecast.FIELDS)))),
+    },
+    location = "query")
+  def get(self, query):
+    weather, status_code = getWeather(query.get('latitude',None),query.get('longitude',None))
+    if status_code != 200:
+      return { }, status_code
+    body = weather.render(query.get('hours',None),query.get('fields',None))
+    return app.response_class(body, mimetype='application/json')
 
 class WeatherHistory(Resource):
   @use_args(
     {
       "from" : fields.Str(),
       "to" : fields.Str(),
+      "archive" : fields.Bool(load_default=False),
     },
     location = "query")
   def get(self, query):
     getWeather()
-    return Database().get_outside_temperature(query.get('from',None),query.get('to',None))
+    rows = Database().get_outside_temperature(query.get('from',None),query.get('to',None))
+    if query['archive']:
+      try:
+        rows = withArchive('besim_outside_temperature',rows,query.get('from',None),query.get('to',None))
+      except NotImplementedError as e:
+        return { 'message' : str(e) }, 501
+    return rows
 
 class TemperatureHistory(Resource):
   @use_args(
     {
       "from" : fields.Str(),
       "to" : fields.Str(),
+      "archive" : fields.Bool(load_default=False),
     },
     location = "query")
   def get(self, query, deviceid, roomid):
-    return Database().get_temperature(roomid,query.get('from',None),query.get('to',None))
+    rows = Database().get_temperature(roomid,query.get('from',None),query.get('to',None))
+    if query['archive']:
+      try:
+        rows = withArchive('besim_temperature',rows,query.get('from',None),query.get('to',None),thermostat=roomid)
+      except NotImplementedError as e:
+        return { 'message' : str(e) }, 501
+    return rows
+
+#
+# Admin endpoint to export complete months of the history to the archive (see archive.py)
+#
+class ArchiveResource(Resource):
+  def get(self):
+    return getArchive().status()
+
+  @use_args(
+    {
+      "before" : fields.Str(validate=validate.Regexp(r'^\d{4}-\d{2}$')),
+      "purge" : fields.Bool(load_default=False),
+    },
+    location = "query")
+  def post(self, query):
+    try:
+      getArchive().start(query.get('before',None),query['purge'])
+    except NotImplementedError as e:
+      return { 'message' : str(e) }, 501
+    except RuntimeError as e:
+      abort(409, message=str(e))
+    return getArchive().status(), 202
+
+class RoomAnalytics(Resource):
+  @use_args(
+    {
+      "from" : fields.Str(),
+      "to" : fields.Str(),
+      "base" : fields.Float(load_default=BASE_TEMPERATURE),
+    },
+    location = "query")
+  def get(self, query, deviceid, roomid):
+    # Duty cycle, degree days and time to setpoint for the room (see analytics.py)
+    try:
+      return roomAnalytics(roomid,query.get('from',None),query.get('to',None),query['base'])
+    except NotImplementedError as e:
+      return { 'message' : str(e) }, 501
 
 api.add_resource(Devices,'/api/v1.0/devices', endpoint = 'devices')
 api.add_resource(Device,'/api/v1.0/devices/<int:deviceid>', endpoint = 'device')
 
+api.add_resource(Snapshot,'/api/v1.0/snapshot', endpoint = 'snapshot')
+
 api.add_resource(Rooms,'/api/v1.0/devices/<int:deviceid>/rooms', endpoint = 'rooms')
 api.add_resource(Room,'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>', endpoint = 'room')
 
 api.add_resource(TimeResource,'/api/v1.0/devices/<int:deviceid>/time', endpoint = 'time')
+api.add_resource(LocationResource,'/api/v1.0/devices/<int:deviceid>/location', endpoint = 'location')
+api.add_resource(VersionResource,'/api/v1.0/devices/<int:deviceid>/version', endpoint = 'version')
+api.add_resource(CommandResource,'/api/v1.0/commands/<int:commandid>', endpoint = 'command')
+api.add_resource(Events,'/api/v1.0/events', endpoint = 'events')
+api.add_resource(LinkStatsResource,'/api/v1.0/devices/<int:deviceid>/link', endpoint = 'link')
+api.add_resource(ProfileResource,'/api/v1.0/admin/profile', endpoint = 'profile')
+api.add_resource(ProfileDataResource,'/api/v1.0/admin/profile/<string:format>', endpoint = 'profiledata')
+api.add_resource(ArchiveResource,'/api/v1.0/admin/archive', endpoint = 'archive')
 api.add_resource(OutsideTempResource,'/api/v1.0/devices/<int:deviceid>/outsidetemp', endpoint = 'outsidetemp')
 
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/t1', endpoint = 't1', resource_class_kwargs = { 'param' : 't1', 'msgId' : MsgId.SET_T1 })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/t2', endpoint = 't2', resource_class_kwargs = { 'param' : 't2', 'msgId' : MsgId.SET_T2 })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/t3', endpoint = 't3', resource_class_kwargs = { 'param' : 't3', 'msgId' : MsgId.SET_T3 })
-
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/tempcurve', endpoint = 'tempcurve', resource_class_kwargs = { 'param' : 'tempcurve', 'msgId' : MsgId.SET_CURVE })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/minsetp', endpoint = 'minsetp', resource_class_kwargs = { 'param' : 'minsetp', 'msgId' : MsgId.SET_MIN_HEAT_SETP })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/maxsetp', endpoint = 'maxsetp', resource_class_kwargs = { 'param' : 'maxsetp', 'msgId' : MsgId.SET_MAX_HEAT_SETP })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/units', endpoint = 'units', resource_class_kwargs = { 'param' : 'units', 'msgId' : MsgId.SET_UNITS })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/winter', endpoint = 'winter', resource_class_kwargs = { 'param' : 'winter', 'msgId' : MsgId.SET_SEASON })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/sensorinfluence', endpoint = 'sensorinfluence', resource_class_kwargs = { 'param' : 'sensorinfluence', 'msgId' : MsgId.SET_SENSOR_INFLUENCE })
-
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/advance', endpoint = 'advance', resource_class_kwargs = { 'param' : 'advance', 'msgId' : MsgId.SET_ADVANCE })
-api.add_resource(WriteableParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/mode', endpoint = 'mode', resource_class_kwargs = { 'param' : 'mode', 'msgId' : MsgId.SET_MODE })
+for param,msgId in WRITEABLE_PARAMS.items():
+  api.add_resource(WriteableParamResource, f'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/{param}', endpoint = param, resource_class_kwargs = { 'param' : param, 'msgId' : msgId })
 
 api.add_resource(ReadonlyParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/boost', endpoint = 'boost', resource_class_kwargs = { 'param' : 'boost' }) # Thermostat does not support setting boost
 api.add_resource(FakeBoostResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/fakeboost', endpoint = 'fakeboost') # Use fake boost to simulate boost behaviour
+api.add_resource(Schedule, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/schedule', endpoint = 'schedule')
+api.add_resource(ScheduledChange, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/schedule/<string:param>', endpoint = 'scheduledchange')
 
 api.add_resource(ReadonlyParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/temp', endpoint = 'temp', resource_class_kwargs = { 'param' : 'temp' })
 api.add_resource(ReadonlyParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/settemp', endpoint = 'settemp', resource_class_kwargs = { 'param' : 'settemp' })
 api.add_resource(ReadonlyParamResource, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/cmdissued', endpoint = 'cmdissued', resource_class_kwargs = { 'param' : 'cmdissued' })
 
 api.add_resource(TemperatureHistory, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/history', endpoint = 'temperaturehistory')
+api.add_resource(RoomAnalytics, '/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/analytics', endpoint = 'analytics')
 
 api.add_resource(Peers,'/api/v1.0/peers', endpoint = 'peers')
 
 api.add_resource(Days,'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/days', endpoint = 'days')
 api.add_resource(Day,'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/days/<int:dayid>', endpoint = 'day')
+api.add_resource(Program,'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/program', endpoint = 'program')
 
 #api.add_resource(Weather,'/api/v1.0/weather/<float(signed=True):latitude>/<float(signed=True):longitude>', endpoint='weather')
 api.add_resource(Weather,'/api/v1.0/weather', endpoint='weather')
@@ -316,7 +630,7 @@ class TestResource(Resource):
 
     val = 0
     addr = getDeviceStatus(deviceid)['addr']
-    return getUdpServer().send_SET(addr,getDeviceStatus(deviceid),deviceid,roomid,msgId,val,response=0,write=0,wait=1,numBytes=numBytes)
+    return getUdpServer().send_SET(addr,getDeviceStatus(deviceid),deviceid,roomid,msgId,val,response=0,write=0,wait=COMMAND_TIMEOUT,numBytes=numBytes)
 
 #api.add_resource(TestResource,'/api/v1.0/devices/<int:deviceid>/rooms/<int:roomid>/test', endpoint = 'test')
 
@@ -0,0 +1,182 @@
+import time
+import heapq
+import itertools
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+#
+# Timer for deferred and periodic actions, eg ending a fake boost, scheduled
+# setpoint changes and purging old records.
+#
+# Each job has a key, and there is at most one job with a given key: scheduling
+# a job with the key of an existing job replaces it (or is ignored, see
+# replace), and a job can be cancelled by its key.
+# Jobs run on a small pool of worker threads, since most of them block waiting
+# for the device. A job is never run again while it is still running, if it
+# becomes due meanwhile it runs once the previous run finishes.
+#
+# A one-off job which fails is kept (but not run again) for FAILED_TTL, so it is
+# still listed with its error, eg for a scheduled change the device did not
+# accept. Scheduling or cancelling its key removes it.
+#
+
+class Job():
+  def __init__(self,key,due,fn,args,interval,description):
+    self.key = key
+    self.due = due
+    self.fn = fn
+    self.args = args
+    self.interval = interval      # seconds between runs for a periodic job, else None
+    self.description = description
+    self.token = None             # identifies the current entry for this job in the heap
+    self.runs = 0
+    self.lastRun = None
+    self.lastError = None
+    self.failed = False
+
+  def toJson(self):
+    return {
+      'key' : list(self.key) if isinstance(self.key,tuple) else self.key,
+      'due' : self.due,
+      'interval' : self.interval,
+      'description' : self.description,
+      'runs' : self.runs,
+      'lastRun' : self.lastRun,
+      'lastError' : self.lastError,
+      'failed' : self.failed,
+    }
+
+class Scheduler(threading.Thread):
+  WORKERS = 4
+  FAILED_TTL = 86400              # seconds failed one-off jobs are kept
+
+  def __init__(self,workers=WORKERS):
+    threading.Thread.__init__(self,daemon=True)
+    self.cond = threading.Condition()
+    self.heap = []                # (due,token,key)
+    self.tokens = itertools.count()
+    self.jobs = {}                # key -> Job
+    self.failed = {}              # key -> Job, one-off jobs which failed
+    self.running = set()          # keys of jobs which are running
+    self.rerun = set()            # keys of jobs which became due while running
+    self.pool = ThreadPoolExecutor(max_workers=workers,thread_name_prefix='scheduler')
+    self.stop = False
+
+  def _push(self,job):
+    # Must be called with the lock held
+    job.token = next(self.tokens)
+    heapq.heappush(self.heap,(job.due,job.token,job.key))
+    self.cond.notify()
+
+  def _expireFailed(self):
+    # Must be called with the lock held
+    limit = time.time() - self.FAILED_TTL
+    for key in [ key for key,job in self.failed.items() if job.lastRun < limit ]:
+      del self.failed[key]
+
+  def schedule(self,key,when,fn,*args,interval=None,replace=True,description=None):
+    # Run fn(*args) at time when (seconds since the epoch), and then every interval seconds if set
+    # Returns False if a job with the key exists and replace is False
+    with self.cond:
+      if key in self.jobs and not replace:
+        return False
+      self.failed.pop(key,None)
+      job = self.jobs[key] = Job(key,when,fn,args,interval,description)
+      self._push(job)
+    return True
+
+  def every(self,key,interval,fn,*args,delay=None,description=None):
+    # Run fn(*args) every interval seconds, first after delay (default interval) seconds
+    return self.schedule(key,time.time()+(interval if delay is None else delay),fn,*args,interval=interval,description=description)
+
+  def cancel(self,key):
+    # Returns True if the job was scheduled (a run already in progress is not interrupted)
+    with self.cond:
+      self.rerun.discard(key)
+      failed = self.failed.pop(key,None)
+      return self.jobs.pop(key,None) is not None or failed is not None
+
+  def get(self,key):
+    with self.cond:
+      self._expireFailed()
+      job = self.jobs.get(key,self.failed.get(key))
+      return job.toJson() if job is not None else None
+
+  def list(self,match=None):
+    # Returns the jobs, and the failed one-off jobs, optionally only those for which match(key) is True
+    with self.cond:
+      self._expireFailed()
+      jobs = list(self.jobs.values()) + list(self.failed.values())
+      return [ job.toJson() for job in sorted(jobs,key=lambda job: job.due) if match is None or match(job.key) ]
+
+  def pending(self,match=None):
+    # Returns (key,due,args) of the jobs, optionally only those for which match(key) is True, eg to persist them
+    with self.cond:
+      return [ (job.key,job.due,job.args) for job in self.jobs.values() if match is None or match(job.key) ]
+
+  def shutdown(self):
+    with self.cond:
+      self.stop = True
+      self.cond.notify()
+    self.pool.shutdown(wait=False)
+
+  def _run(self,job):
+    try:
+      job.fn(*job.args)
+      job.lastError = None
+    except Exception as e:
+      logger.exception(f'Scheduled job {job.key} failed')
+      job.lastError = f'{type(e).__name__}: {e}'
+    with self.cond:
+      job.runs += 1
+      job.lastRun = time.time()
+      self.running.discard(job.key)
+      current = self.jobs.get(job.key)
+      if job.key in self.rerun:
+        # This job, or the one which replaced it, became due while it was running
+        self.rerun.discard(job.key)
+        if current is not None:
+          current.due = time.time()
+          self._push(current)
+      elif current is not job:
+        return                    # cancelled or replaced while running
+      elif job.interval is not None:
+        job.due = time.time() + job.interval
+        self._push(job)
+      else:
+        del self.jobs[job.key]
+        if job.lastError is not None:
+          job.failed = True
+          self.failed[job.key] = job
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.stop and (not self.heap or self.heap[0][0] > time.time()):
+          self.cond.wait(self.heap[0][0]-time.time() if self.heap else None)
+        if self.stop:
+          return
+        due, token, key = heapq.heappop(self.heap)
+        job = self.jobs.get(key)
+        if job is None or job.token != token:
+          continue                # cancelled or rescheduled
+        if key in self.running:
+          self.rerun.add(key)
+          continue
+        self.running.add(key)
+      self.pool.submit(self._run,job)
+
+Timers = None
+TimersLock = threading.Lock()
+
+def getScheduler():
+  # Creates (and starts) the scheduler
+  global Timers
+  with TimersLock:
+    if Timers is None:
+      Timers = Scheduler()
+      Timers.start()
+  return Timers
@@ -0,0 +1,206 @@
+import os
+import mmap
+import math
+import time
+import struct
+import threading
+import logging
+from datetime import datetime, timezone, timedelta
+
+from storage import HistoryStore
+
+logger = logging.getLogger(__name__)
+
+#
+# Append-only time-series store for the temperature history, an alternative
+# to the sqlite3 tables (see storage.py, set BESIM_SEGMENTS to use it)
+#
+# Each series (the outside temperature, and each room) is a directory of
+# segment files, one per month (UTC), eg
+#    segments/room-3/2024-01.seg
+# A segment is a header followed by fixed size records in timestamp order.
+# The writer appends records, and readers memory map the segment so a range
+# query is a binary search for each end plus a slice of the mapping, which is
+# only decoded into rows for the response.
+#
+# Purging deletes whole segments, so up to a month more than asked is kept.
+#
+
+HEADER = struct.Struct('<4sHH')       # magic, version, record size
+MAGIC = b'BSEG'
+VERSION = 1
+
+TS = struct.Struct('<d')              # every record starts with its timestamp (seconds since the epoch)
+TEMPERATURE = struct.Struct('<dddb7x') # ts, temp, settemp, heating (-1 if unknown)
+OUTSIDE_TEMPERATURE = struct.Struct('<dd') # ts, temp
+
+def _timestamp(ts):
+  return datetime.fromisoformat(ts).timestamp()
+
+def _isoformat(ts,zones):
+  # As datetime.fromtimestamp(ts,timezone.utc).astimezone().isoformat(), the format the database uses,
+  # but caching the local UTC offset in zones per 15 minutes (offsets only change on a quarter hour)
+  quarter = int(ts // 900)
+  tz = zones.get(quarter)
+  if tz is None:
+    tz = zones[quarter] = timezone(timedelta(seconds=time.localtime(quarter*900).tm_gmtoff))
+  return datetime.fromtimestamp(ts,tz).isoformat()
+
+def _month(ts):
+  return datetime.fromtimestamp(ts,timezone.utc).strftime('%Y-%m')
+
+def _float(v):
+  return None if math.isnan(v) else v
+
+def _bisect(view,size,ts,right=False):
+  # Index of the first record with a timestamp >= ts (> ts if right)
+  lo, hi = 0, len(view) // size
+  while lo < hi:
+    mid = (lo+hi) // 2
+    t = TS.unpack_from(view,mid*size)[0]
+    if t < ts or (right and t == ts):
+      lo = mid+1
+    else:
+      hi = mid
+  return lo
+
+class Segment():
+  def __init__(self,path,record):
+    self.path = path
+    self.record = record
+    self.fd = None                # for appending, opened on the first append
+    self.mm = None
+    self.last = None              # timestamp of the last record appended
+
+  def append(self,values):
+    if self.fd is None:
+      self.fd = os.open(self.path,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o644)
+      size = os.fstat(self.fd).st_size
+      if size == 0:
+        os.write(self.fd,HEADER.pack(MAGIC,VERSION,self.record.size))
+      else:
+        view = self.view()
+        if len(view):
+          self.last = TS.unpack_from(view,len(view)-self.record.size)[0]
+    # Keep the records in order if the clock goes backwards
+    ts = values[0] if self.last is None else max(values[0],self.last)
+    self.last = ts
+    os.write(self.fd,self.record.pack(ts,*values[1:])) # a single write, so readers never see part of a record
+
+  def view(self):
+    # Returns a memoryview of the complete records in the segment
+    try:
+      size = os.path.getsize(self.path)
+    except FileNotFoundError:
+      return memoryview(b'')
+    count = (size - HEADER.size) // self.record.size if size > HEADER.size else 0
+    end = HEADER.size + count * self.record.size
+    if count and (self.mm is None or len(self.mm) < end):
+      # Remap to include the records appended since (the old mapping is released once no views use it)
+      with open(self.path,'rb') as f:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+      magic, version, recordSize = HEADER.unpack_from(mm,0)
+      if magic != MAGIC or version != VERSION or recordSize != self.record.size:
+        raise ValueError(f'{self.path} is not a version {VERSION} segment')
+      self.mm = mm
+    if not count:
+      return memoryview(b'')
+    return memoryview(self.mm)[HEADER.size:end]
+
+  def range(self,ts_from,ts_to):
+    # Returns a memoryview of the records with ts_from <= ts <= ts_to
+    view = self.view()
+    size = self.record.size
+    lo = _bisect(view,size,ts_from)
+    hi = _bisect(view,size,ts_to,right=True)
+    return view[lo*size:max(lo,hi)*size]
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+    self.mm = None
+
+class SegmentStore(HistoryStore):
+  def __init__(self,path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.segments = {}            # (series,month) -> Segment
+    os.makedirs(path,exist_ok=True)
+
+  def _segment(self,series,month,record):
+    # Must be called with the lock held
+    segment = self.segments.get((series,month))
+    if segment is None:
+      directory = os.path.join(self.path,series)
+      os.makedirs(directory,exist_ok=True)
+      segment = self.segments[(series,month)] = Segment(os.path.join(directory,f'{month}.seg'),record)
+    return segment
+
+  def _months(self,series):
+    directory = os.path.join(self.path,series)
+    if not os.path.isdir(directory):
+      return []
+    return sorted(name[:7] for name in os.listdir(directory) if name.endswith('.seg'))
+
+  def _append(self,series,record,values):
+    with self.lock:
+      self._segment(series,_month(values[0]),record).append(values)
+
+  def _range(self,series,record,date_from,date_to):
+    # Yields the records in the range as tuples
+    ts_from, ts_to = _timestamp(date_from), _timestamp(date_to)
+    if ts_from > ts_to:
+      return
+    month_from, month_to = _month(ts_from), _month(ts_to)
+    for month in self._months(series):
+      if month < month_from or month > month_to:
+        continue
+      with self.lock:
+        view = self._segment(series,month,record).range(ts_from,ts_to)
+      yield from record.iter_unpack(view)
+
+  def log_outside_temperature(self,temp,ts=None,conn=None):
+    ts = datetime.now(timezone.utc).timestamp() if ts is None else ts
+    self._append('outside',OUTSIDE_TEMPERATURE,(ts,math.nan if temp is None else temp))
+
+  def log_temperatures(self,samples,ts=None,conn=None):
+    ts = datetime.now(timezone.utc).timestamp() if ts is None else ts
+    for thermostat, temp, settemp, heating in samples:
+      self._append(f'room-{thermostat}',TEMPERATURE,(ts,math.nan if temp is None else temp,math.nan if settemp is None else settemp,-1 if heating is None else heating))
+
+  def get_outside_temperature(self,date_from,date_to,conn=None):
+    zones = {}
+    return [ { 'ts' : _isoformat(ts,zones), 'temp' : _float(temp) } for ts,temp in self._range('outside',OUTSIDE_TEMPERATURE,date_from,date_to) ]
+
+  def get_temperature(self,thermostat,date_from,date_to,conn=None):
+    zones = {}
+    return [ { 'ts' : _isoformat(ts,zones), 'temp' : _float(temp), 'settemp' : _float(settemp), 'heating' : None if heating < 0 else heating }
+             for ts,temp,settemp,heating in self._range(f'room-{thermostat}',TEMPERATURE,date_from,date_to) ]
+
+  def purge(self,limit,conn=None):
+    # Deletes the segments for months before the month of limit (a datetime)
+    month = limit.astimezone(timezone.utc).strftime('%Y-%m')
+    count = 0
+    with self.lock:
+      for series in os.listdir(self.path):
+        for old in self._months(series):
+          if old >= month:
+            continue
+          segment = self.segments.pop((series,old),None)
+          if segment is not None:
+            segment.close()
+          os.unlink(os.path.join(self.path,series,f'{old}.seg'))
+          count += 1
+    if count:
+      logger.info(f'Purged {count} segments before {month} from {self.path}')
+
+  def close(self):
+    with self.lock:
+      for segment in self.segments.values():
+        segment.close()
+      self.segments = {}
+
+def getSegmentPath():
+  # The segment store is only used if BESIM_SEGMENTS is set to its directory, otherwise the history is kept in the database
+  return os.getenv('BESIM_SEGMENTS',None)
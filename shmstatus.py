@@ -0,0 +1,177 @@
+import os
+import mmap
+import struct
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+#
+# Fixed layout room status table in shared memory
+#
+# The UDP server (the only writer) stores the room status decoded from each
+# STATUS message, and REST worker processes read it without any locking or IPC.
+#
+# Each slot is protected by a seqlock: the writer increments the sequence
+# number before (making it odd) and after (making it even) updating a slot,
+# and a reader retries if the sequence number was odd or changed while it was
+# reading.
+#
+# Slots are allocated by hashing (deviceid, room) with linear probing.
+# A removed slot is marked with a deviceid of TOMBSTONE rather than cleared, so
+# the probing for other rooms still finds them, and is reused by the next room added.
+#
+
+HEADER = struct.Struct('<4sII')       # magic, version, number of slots
+MAGIC = b'BSIM'
+VERSION = 1
+
+SEQ = struct.Struct('<I')
+TOMBSTONE = 0xffffffff
+# deviceid, room, lastseen, fakeboost, heating, temp, settemp, t3, t2, t1, maxsetp, minsetp,
+# mode, tempcurve, heatingsetp, sensorinfluence, units, advance, boost, cmdissued, winter
+RECORD = struct.Struct('<IIIdb7h9B')
+SLOT_SIZE = 64
+assert SEQ.size + RECORD.size <= SLOT_SIZE
+
+FIELDS = ( 'lastseen', 'fakeboost', 'heating', 'temp', 'settemp', 't3', 't2', 't1', 'maxsetp', 'minsetp',
+           'mode', 'tempcurve', 'heatingsetp', 'sensorinfluence', 'units', 'advance', 'boost', 'cmdissued', 'winter' )
+
+class StatusTable():
+  SLOTS = 256
+  RETRIES = 100
+
+  def __init__(self,path,mm,slots,writable):
+    self.path = path
+    self.mm = mm
+    self.slots = slots
+    self.writable = writable
+    self.index = {}               # (deviceid,room) -> slot, a cache of the probing below
+
+  @classmethod
+  def create(cls,path,slots=SLOTS):
+    size = HEADER.size + slots * SLOT_SIZE
+    fd = os.open(path,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0o644)
+    try:
+      os.ftruncate(fd,size)
+      mm = mmap.mmap(fd,size)
+    finally:
+      os.close(fd)
+    HEADER.pack_into(mm,0,MAGIC,VERSION,slots)
+    logger.info(f'Created status table {path} with {slots} slots')
+    return cls(path,mm,slots,True)
+
+  @classmethod
+  def open(cls,path):
+    fd = os.open(path,os.O_RDONLY)
+    try:
+      mm = mmap.mmap(fd,0,access=mmap.ACCESS_READ)
+    finally:
+      os.close(fd)
+    magic, version, slots = HEADER.unpack_from(mm,0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError(f'Invalid status table {path}')
+    return cls(path,mm,slots,False)
+
+  def _offset(self,slot):
+    return HEADER.size + slot * SLOT_SIZE
+
+  def _find(self,deviceid,room,allocate=False):
+    # Returns the slot for (deviceid,room) or None
+    slot = self.index.get((deviceid,room))
+    if slot is not None:
+      return slot
+    start = (deviceid * 31 + room) % self.slots
+    free = None                   # first removed slot, reused if (deviceid,room) is not in the table
+    for n in range(self.slots):
+      slot = (start + n) % self.slots
+      offset = self._offset(slot)
+      seq, = SEQ.unpack_from(self.mm,offset)
+      d, r = struct.unpack_from('<II',self.mm,offset+SEQ.size)
+      if seq != 0 and d == deviceid and r == room:
+        self.index[(deviceid,room)] = slot
+        return slot
+      if seq != 0 and d == TOMBSTONE:
+        if free is None:
+          free = slot
+        continue
+      if seq == 0:
+        # Unused slot, so (deviceid,room) is not in the table
+        break
+    else:
+      slot = None
+    if not allocate:
+      return None
+    slot = free if free is not None else slot
+    if slot is None:
+      logger.error(f'Status table is full, cannot add {deviceid=} {room=}')
+      return None
+    self.index[(deviceid,room)] = slot
+    return slot
+
+  def _pack(self,slot,*record):
+    offset = self._offset(slot)
+    seq, = SEQ.unpack_from(self.mm,offset)
+    SEQ.pack_into(self.mm,offset,seq+1)   # odd, update in progress
+    RECORD.pack_into(self.mm,offset+SEQ.size,*record)
+    SEQ.pack_into(self.mm,offset,seq+2 if seq < 0xfffffffd else 2)   # even, update complete
+
+  def write(self,deviceid,room,roomStatus):
+    slot = self._find(deviceid,room,allocate=True)
+    if slot is None:
+      return
+    values = []
+    for field in FIELDS:
+      v = roomStatus.get(field)
+      if v is None:
+        v = -1 if field == 'heating' else 0
+      values.append(v)
+    self._pack(slot,deviceid,room,*values)
+
+  def remove(self,deviceid,room):
+    # Frees the slot of (deviceid,room), eg when the device is evicted from the status
+    slot = self._find(deviceid,room)
+    if slot is None:
+      return
+    del self.index[(deviceid,room)]
+    self._pack(slot,TOMBSTONE,TOMBSTONE,*([0]*len(FIELDS)))
+
+  def read(self,deviceid,room):
+    # Returns a dict of the room status, or None if the room is not in the table
+    for attempt in range(2):
+      slot = self._find(deviceid,room)
+      if slot is None:
+        return None
+      record = self._unpack(slot)
+      if record is None:
+        logger.warning(f'Failed to read status table for {deviceid=} {room=}')
+        return None
+      if record[0] == deviceid and record[1] == room:
+        roomStatus = dict(zip(FIELDS,record[2:]))
+        if roomStatus['heating'] == -1:
+          roomStatus['heating'] = None
+        return roomStatus
+      # The slot has been removed or reused, or the table recreated, since we found it
+      self.index.pop((deviceid,room),None)
+    return None
+
+  def _unpack(self,slot):
+    # Returns a consistent copy of the record in the slot, or None
+    offset = self._offset(slot)
+    for n in range(self.RETRIES):
+      seq1, = SEQ.unpack_from(self.mm,offset)
+      if seq1 & 1:
+        time.sleep(0)
+        continue
+      record = RECORD.unpack_from(self.mm,offset+SEQ.size)
+      seq2, = SEQ.unpack_from(self.mm,offset)
+      if seq1 == seq2:
+        return record
+    return None
+
+  def close(self):
+    self.mm.close()
+
+def getStatusTablePath():
+  # The status table is only used if BESIM_SHM_STATUS is set, eg /dev/shm/besim_status
+  return os.getenv('BESIM_SHM_STATUS',None)
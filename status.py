@@ -1,29 +1,131 @@
 import time
+import threading
 
 #
 # This is where we store the status of any connected peers/devices
 #
 Status = { 'peers' : {}, 'devices' : {} }
 
+#
+# Lock held by writers (UdpServer) while updating Status, and by readers
+# that need a consistent view of more than one entry (see getSnapshot)
+#
+StatusLock = threading.RLock()
+
 def getStatus():
   return Status
 
+def getStatusLock():
+  return StatusLock
+
 def getPeerStatus(addr):
   if addr not in Status['peers']:
-    Status['peers'][addr] = { 'devices' : set() }
+    with StatusLock:
+      Status['peers'].setdefault(addr,{ 'devices' : set() })
   return Status['peers'][addr]
 
+def setDeviceAddr(deviceid,addr):
+  # Records the address a message from the device came from
+  # If the device has moved (eg its NAT mapping changed) it is removed from the peer it was at before
+  with StatusLock:
+    deviceStatus = getDeviceStatus(deviceid)
+    old = deviceStatus.get('addr')
+    if old is not None and old != addr:
+      oldPeer = Status['peers'].get(old)
+      if oldPeer is not None:
+        oldPeer['devices'].discard(deviceid)
+        if not oldPeer['devices']:
+          del Status['peers'][old]
+    peerStatus = getPeerStatus(addr)
+    peerStatus['devices'].add(deviceid)
+    peerStatus['lastseen'] = int(time.time())
+    deviceStatus['addr'] = addr
+    deviceStatus['lastactive'] = int(time.time())
+  return deviceStatus
+
 def getDeviceStatus(deviceid):
   if deviceid not in Status['devices']:
     # cseq is control plane sequence number, 0..0xfd
-    # results is a dict holding the results from a request
-    # 'results' = { <sequence number of request sent> : { 'ev' : <threading.Event>, 'val' : <result of requested operation> }, ... }
-    Status['devices'][deviceid]={ 'rooms' : {}, 'cseq' : 0x0, 'results' : {} }
+    # The results from a request are held in the command table (see commands.py)
+    with StatusLock:
+      Status['devices'].setdefault(deviceid,{ 'deviceid' : deviceid, 'rooms' : {}, 'cseq' : 0x0 })
   return Status['devices'][deviceid]
 
 def getRoomStatus(deviceid,room):
   deviceStatus = getDeviceStatus(deviceid)
 
   if room not in deviceStatus['rooms']:
-    deviceStatus['rooms'][room] = { 'days' : {} }
+    with StatusLock:
+      deviceStatus['rooms'].setdefault(room,{ 'days' : {} })
   return deviceStatus['rooms'][room]
+
+#
+# Internal entries in the device status which are not part of the state of the device
+#
+PRIVATE_DEVICE_KEYS = ( 'rooms', 'cseq', 'lastcseq', 'lastactive' )
+
+def _select(d,fields,exclude=()):
+  return { k : v for k,v in d.items() if k not in exclude and (fields is None or k in fields) }
+
+def copyRoomStatus(roomStatus,fields=None):
+  with StatusLock:
+    roomCopy = _select(roomStatus,fields,( 'days', ))
+    if fields is None or 'days' in fields:
+      roomCopy['days'] = { day : list(prog) for day,prog in roomStatus['days'].items() }
+  return roomCopy
+
+def copyDeviceStatus(deviceStatus,fields=None):
+  # Returns a copy of the device and its rooms, without the internal entries
+  with StatusLock:
+    device = _select(deviceStatus,fields,PRIVATE_DEVICE_KEYS)
+    device['rooms'] = { room : copyRoomStatus(roomStatus,fields) for room,roomStatus in deviceStatus['rooms'].items() }
+  return device
+
+def getSnapshot(fields=None):
+  # Returns a consistent copy of all devices with their rooms
+  # If fields is set then only those device/room fields are returned
+  with StatusLock:
+    devices = { deviceid : copyDeviceStatus(deviceStatus,fields) for deviceid, deviceStatus in Status['devices'].items() }
+  return { 'ts' : int(time.time()), 'devices' : devices }
+
+def getState():
+  # Returns a copy of the peers and devices, eg for mirroring the status in another process
+  snapshot = getSnapshot()
+  with StatusLock:
+    peers = { addr : { k : (set(v) if isinstance(v,set) else v) for k,v in peer.items() } for addr,peer in Status['peers'].items() }
+  return { 'peers' : peers, 'devices' : snapshot['devices'] }
+
+def setState(state):
+  # Replaces the status with a copy from another process (see getState)
+  with StatusLock:
+    Status['peers'] = state['peers']
+    Status['devices'] = state['devices']
+
+#
+# Peers and devices which have not been heard from for a while are removed,
+# so the status does not grow without limit as NAT mappings change or devices go away.
+# Beyond maxPeers/maxDevices the least recently seen entries are removed.
+#
+PEER_TTL = 3600                   # seconds
+DEVICE_TTL = 30*86400             # seconds
+MAX_PEERS = 1024
+MAX_DEVICES = 1024
+
+def evictStale(peerTTL=PEER_TTL,deviceTTL=DEVICE_TTL,maxPeers=MAX_PEERS,maxDevices=MAX_DEVICES):
+  # Returns (evicted peer addresses, evicted devices as { deviceid : deviceStatus })
+  now = time.time()
+  with StatusLock:
+    # Devices only created by a lookup (eg from the REST API) have never been active
+    lastActive = { deviceid : deviceStatus.get('lastactive',deviceStatus.get('lastseen',0)) for deviceid,deviceStatus in Status['devices'].items() }
+    byAge = sorted(lastActive,key=lastActive.get)
+    stale = set(byAge[:max(0,len(byAge)-maxDevices)]) | { deviceid for deviceid,ts in lastActive.items() if ts + deviceTTL < now }
+    devices = { deviceid : Status['devices'].pop(deviceid) for deviceid in stale }
+
+    for peer in Status['peers'].values():
+      peer['devices'] -= stale
+    lastSeen = { addr : peer.get('lastseen',0) for addr,peer in Status['peers'].items() }
+    byAge = sorted(lastSeen,key=lastSeen.get)
+    peers = set(byAge[:max(0,len(byAge)-maxPeers)]) | { addr for addr,ts in lastSeen.items() if ts + peerTTL < now }
+    for addr in peers:
+      del Status['peers'][addr]
+  return peers, devices
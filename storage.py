@@ -0,0 +1,94 @@
+import contextlib
+from datetime import datetime, timezone
+
+#
+# Storage backends for the temperature history (see Database)
+#
+# A backend implements HistoryStore. Database delegates the history methods
+# (log_*, get_* and purge) to its backend, and keeps the migrations and the
+# analytics, which are SQL run against the database.
+#
+# conn is a connection from Database.get_connection(), so the UDP thread can
+# reuse its own connection. Backends which are not in the database ignore it.
+# ts is seconds since the epoch, the current time if None.
+# Rows are returned as dicts, with ts in local time ISO format.
+#
+
+class HistoryStore():
+  SQL = False                     # True if the history is in the database tables, so the analytics and archive can use it
+
+  def log_outside_temperature(self,temp,ts=None,conn=None):
+    raise NotImplementedError
+
+  def log_temperatures(self,samples,ts=None,conn=None):
+    # Logs (thermostat,temp,settemp,heating) for several rooms at once
+    raise NotImplementedError
+
+  def log_temperature(self,thermostat,temp,settemp,heating,ts=None,conn=None):
+    self.log_temperatures([ (thermostat,temp,settemp,heating) ],ts=ts,conn=conn)
+
+  def get_outside_temperature(self,date_from,date_to,conn=None):
+    raise NotImplementedError
+
+  def get_temperature(self,thermostat,date_from,date_to,conn=None):
+    raise NotImplementedError
+
+  def purge(self,limit,conn=None):
+    # Deletes the history before limit (a datetime)
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+def _isoformat(ts):
+  now = datetime.now(timezone.utc) if ts is None else datetime.fromtimestamp(ts,timezone.utc)
+  return now.astimezone().isoformat()
+
+class SqliteStore(HistoryStore):
+  # The besim_temperature and besim_outside_temperature tables
+  SQL = True
+
+  def __init__(self,database):
+    self.database = database
+
+  @contextlib.contextmanager
+  def connection(self,conn):
+    # Uses conn, or a new connection which is committed and closed afterwards
+    if conn:
+      yield conn
+      return
+    conn = self.database.get_connection()
+    try:
+      yield conn
+      conn.commit()
+    finally:
+      conn.close()
+
+  def log_outside_temperature(self,temp,ts=None,conn=None):
+    sql = "insert into besim_outside_temperature(ts, temp) values (?,?)"
+    with self.connection(conn) as conn:
+      conn.run_sql(sql,(_isoformat(ts),temp),log=self.database.log)
+
+  def log_temperatures(self,samples,ts=None,conn=None):
+    now = _isoformat(ts)
+    sql = "insert into besim_temperature(ts, thermostat, temp, settemp, heating) values (?,?,?,?,?)"
+    values = [ (now,thermostat,temp,settemp,heating) for thermostat,temp,settemp,heating in samples ]
+    with self.connection(conn) as conn:
+      conn.executemany(sql,values,log=self.database.log)
+
+  def get_outside_temperature(self,date_from,date_to,conn=None):
+    sql = "select ts,temp from besim_outside_temperature where ts between ? and ?"
+    with self.connection(conn) as conn:
+      return conn.run_sql(sql,(date_from,date_to),log=self.database.log)
+
+  def get_temperature(self,thermostat,date_from,date_to,conn=None):
+    sql = "select ts,temp,settemp,heating from besim_temperature where thermostat = ? and ts between ? and ?"
+    with self.connection(conn) as conn:
+      return conn.run_sql(sql,(thermostat,date_from,date_to),log=self.database.log)
+
+  def purge(self,limit,conn=None):
+    with self.connection(conn) as conn, conn.transaction():
+      sql = "delete from besim_outside_temperature where ts < ?"
+      conn.run_sql(sql,(limit.isoformat(),),log=self.database.log)
+      sql = "delete from besim_temperature where ts < ?"
+      conn.run_sql(sql,(limit.isoformat(),),log=self.database.log)
@@ -0,0 +1,116 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segmentstore import SegmentStore, Segment, TEMPERATURE, TS, _bisect
+
+#
+# Edge cases of the segment store (see segmentstore.py)
+# Run with: python -m pytest tests   (or python -m unittest discover tests)
+#
+
+BASE = datetime(2024,1,10,tzinfo=timezone.utc).timestamp()
+
+def iso(ts):
+  return datetime.fromtimestamp(ts,timezone.utc).isoformat()
+
+def timestamps(view):
+  return [ TS.unpack_from(view,i)[0] for i in range(0,len(view),TEMPERATURE.size) ]
+
+class SegmentTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='besim-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def segment(self,times):
+    segment = Segment(os.path.join(self.path,'test.seg'),TEMPERATURE)
+    for ts in times:
+      segment.append((ts,20.0,21.0,1))
+    return segment
+
+  def test_bisect_empty(self):
+    self.assertEqual(_bisect(memoryview(b''),TEMPERATURE.size,BASE),0)
+    self.assertEqual(_bisect(memoryview(b''),TEMPERATURE.size,BASE,right=True),0)
+
+  def test_bisect_boundaries(self):
+    view = self.segment([ BASE, BASE+10, BASE+10, BASE+20 ]).view()
+    size = TEMPERATURE.size
+    self.assertEqual(_bisect(view,size,BASE-1),0)
+    self.assertEqual(_bisect(view,size,BASE),0)
+    self.assertEqual(_bisect(view,size,BASE,right=True),1)
+    self.assertEqual(_bisect(view,size,BASE+10),1)
+    self.assertEqual(_bisect(view,size,BASE+10,right=True),3)
+    self.assertEqual(_bisect(view,size,BASE+20,right=True),4)
+    self.assertEqual(_bisect(view,size,BASE+21),4)
+
+  def test_range_is_inclusive(self):
+    segment = self.segment([ BASE, BASE+10, BASE+20, BASE+30 ])
+    self.assertEqual(timestamps(segment.range(BASE+10,BASE+20)),[ BASE+10, BASE+20 ])
+    self.assertEqual(timestamps(segment.range(BASE-5,BASE+5)),[ BASE ])
+    self.assertEqual(timestamps(segment.range(BASE+31,BASE+40)),[])
+    self.assertEqual(timestamps(segment.range(BASE+11,BASE+19)),[])
+
+  def test_clock_going_backwards_keeps_order(self):
+    segment = self.segment([ BASE+10, BASE ])
+    self.assertEqual(timestamps(segment.view()),[ BASE+10, BASE+10 ])
+
+  def test_remap_after_append(self):
+    segment = self.segment([ BASE ])
+    first = segment.view()
+    self.assertEqual(len(first),TEMPERATURE.size)
+    segment.append((BASE+10,20.0,21.0,0))
+    self.assertEqual(timestamps(segment.range(BASE,BASE+10)),[ BASE, BASE+10 ])
+    self.assertEqual(timestamps(first),[ BASE ])   # an older view is still valid
+
+  def test_reader_sees_appends_of_writer(self):
+    # eg a REST worker reading while the engine writes
+    writer = SegmentStore(self.path)
+    reader = SegmentStore(self.path)
+    writer.log_temperature(3,20.0,21.0,1,ts=BASE)
+    self.assertEqual(len(reader.get_temperature(3,iso(BASE),iso(BASE+60))),1)
+    writer.log_temperature(3,20.5,21.0,0,ts=BASE+30)
+    self.assertEqual([ row['temp'] for row in reader.get_temperature(3,iso(BASE),iso(BASE+60)) ],[ 20.0, 20.5 ])
+
+  def test_unknown_values(self):
+    store = SegmentStore(self.path)
+    store.log_temperature(3,None,None,None,ts=BASE)
+    store.log_outside_temperature(None,ts=BASE)
+    row, = store.get_temperature(3,iso(BASE),iso(BASE))
+    self.assertEqual((row['temp'],row['settemp'],row['heating']),(None,None,None))
+    self.assertEqual(store.get_outside_temperature(iso(BASE),iso(BASE))[0]['temp'],None)
+
+  def test_range_across_months(self):
+    store = SegmentStore(self.path)
+    february = datetime(2024,2,1,tzinfo=timezone.utc).timestamp()
+    for ts in ( BASE, february-1, february, february+86400 ):
+      store.log_temperature(3,20.0,21.0,1,ts=ts)
+    self.assertEqual(len(store.get_temperature(3,iso(february-1),iso(february))),2)
+    self.assertEqual(len(store.get_temperature(3,iso(BASE),iso(february+86400))),4)
+
+  def test_purge_while_reader_holds_view(self):
+    store = SegmentStore(self.path)
+    store.log_temperature(3,20.0,21.0,1,ts=BASE)
+    with store.lock:
+      view = store._segment('room-3','2024-01',TEMPERATURE).range(BASE,BASE)
+    store.purge(datetime(2024,2,1,tzinfo=timezone.utc))
+    self.assertFalse(os.path.exists(os.path.join(self.path,'room-3','2024-01.seg')))
+    self.assertEqual(timestamps(view),[ BASE ])     # the mapping outlives the file
+    self.assertEqual(store.get_temperature(3,iso(BASE),iso(BASE)),[])
+    store.log_temperature(3,20.0,21.0,1,ts=BASE)    # a new segment is started
+    self.assertEqual(len(store.get_temperature(3,iso(BASE),iso(BASE))),1)
+
+  def test_purge_keeps_current_month(self):
+    store = SegmentStore(self.path)
+    store.log_temperature(3,20.0,21.0,1,ts=BASE)
+    store.purge(datetime(2024,1,20,tzinfo=timezone.utc))
+    self.assertEqual(len(store.get_temperature(3,iso(BASE),iso(BASE))),1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,14 +8,23 @@ import logging
 import hexdump
 import traceback
 
-from status import getPeerStatus, getRoomStatus, getDeviceStatus, getStatus
+from status import getPeerStatus, getRoomStatus, getDeviceStatus, getStatus, getStatusLock, setDeviceAddr, evictStale
 from database import Database
+from commands import getCommandTable, QueryCache
+from downlink import DownlinkScheduler
+from views import invalidateDevice, invalidateRoom, invalidatePeers, discardDevice
+import metrics
+from profiling import getProfiler
+from liveness import LivenessTracker
+from scheduler import getScheduler
 
 logger = logging.getLogger(__name__)
 
 FAKEBOOST_TEMPERATURE_RISE=6     # degC * 10
 FAKEBOOST_DURATION=1800          # seconds
 
+COMMAND_TIMEOUT=5                # seconds to wait for a response from the device, including retransmissions
+
 class Unpacker():
   def __init__(self,buffer,offset=0):
     self.buffer = buffer
@@ -224,36 +233,56 @@ MAGIC_FOOTER=0xdf2d
 UNUSED_CSEQ = 0xff
 MAX_CSEQ = 0xfd
 
-def NextCSeq(device,wait=0):
-  current_cseq = device['cseq']
-  cseq = current_cseq + 1
-  if cseq>MAX_CSEQ:
-    cseq = 0
-  device['cseq'] = cseq
+CSeqLock = threading.Lock()
 
-  device['results'].pop(current_cseq,None) # delete any dangling entries
-  if wait:
-    device['results'][current_cseq] = { 'wait' : wait, 'ev' : threading.Event(), 'val' : None }
+def NextCSeq(device,wait=0):
+  # Skips any cseq which may still get a response to an earlier request,
+  # so a late or duplicate response cannot be matched to the wrong request after wrap-around
+  commands = getCommandTable()
+  with CSeqLock:
+    current_cseq = device['cseq']
+    for n in range(MAX_CSEQ+1):
+      if not commands.busy(device['deviceid'],current_cseq):
+        break
+      current_cseq = current_cseq + 1 if current_cseq<MAX_CSEQ else 0
+    cseq = current_cseq + 1
+    if cseq>MAX_CSEQ:
+      cseq = 0
+    device['cseq'] = cseq
+    device['lastcseq'] = current_cseq
+
+    if wait:
+      commands.add(device['deviceid'],current_cseq,wait)
+    else:
+      commands.release(device['deviceid'],current_cseq) # delete any dangling entries
 
   return current_cseq
 
+def ProgTag(room,day):
+  # PROGRAM messages do not use a cseq (it is always UNUSED_CSEQ), so the response is identified by the room/day
+  # instead, and told apart from a PROGRAM initiated by the device by its response flag
+  return ('prog',room,day)
+
 def LastCSeq(device):
-  cseq = device['cseq']
-  if cseq == MAX_CSEQ:
-    return 0
-  return cseq - 1
+  return device.get('lastcseq')
+
+def ExpectedCSeq(device,cseq):
+  # True if cseq is that of the last request, or of an earlier one which may still be answered,
+  # since several requests can be outstanding at once (eg send_SETs)
+  return cseq == LastCSeq(device) or getCommandTable().busy(device['deviceid'],cseq)
 
 def WaitCSeq(device,cseq):
-  if cseq in device['results']:
-    results = device['results'][cseq]
-    results['ev'].wait(results['wait'])
-    del device['results'][cseq]
-    return results['val']
+  cmd = getCommandTable().find(device['deviceid'],cseq)
+  if cmd is not None:
+    return cmd.wait()
+
+def WaitCSeqs(device,cseqs):
+  # Wait for several outstanding requests
+  # Returns { cseq : <result>, ... }
+  return { cseq : WaitCSeq(device,cseq) for cseq in cseqs }
 
 def SignalCSeq(device,cseq,val):
-  if cseq in device['results']:
-    device['results'][cseq]['val'] = val
-    device['results'][cseq]['ev'].set()
+  getCommandTable().signal(device['deviceid'],cseq,val)
 
 #
 # The protocol sends all messages in a UDP datagram with the following framing:
@@ -402,27 +431,185 @@ class Wrapper():
 
 class UdpServer(threading.Thread):
   MAX_DATA = 4096
+  HOUSEKEEPING_INTERVAL = 600     # seconds between removing stale peers, devices and command results
 
-  def __init__(self,addr):
-    threading.Thread.__init__(self)
+  def __init__(self,addr,statusTable=None):
+    threading.Thread.__init__(self,daemon=True) # so a failed shutdown never keeps the process alive
     self.addr = addr
+    self.statusTable = statusTable # optional shared memory copy of the room status (see shmstatus.py)
     self.stop = False
     self.db = Database()
+    self.downlink = DownlinkScheduler()
+    self.queries = QueryCache()
+    self.liveness = LivenessTracker()
+    self.sock = None
+
+  def bind(self):
+    # Binding before the server starts queues the messages which arrive meanwhile, rather than refusing them
+    if self.sock is None:
+      self.sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.sock.bind(self.addr)
 
   def run(self):
     logger.info('UDP server is running')
+    self.downlink.start()
+    self.liveness.seed()
+    self.liveness.start()
+    getScheduler().every('housekeeping',self.HOUSEKEEPING_INTERVAL,self.housekeeping,description='Remove stale peers, devices and command results')
     self.dbConn = self.db.get_connection()
-    self.sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    self.sock.bind(self.addr)
+    self.bind()
     while(not self.stop):
       data, addr = self.sock.recvfrom(self.MAX_DATA)
-      logger.info(f'From {addr} {len(data)} bytes : {hexdump.dump(data)}')
+      if self.stop:
+        break                     # woken by shutdown()
+      metrics.PACKETS_RECEIVED.inc()
+      metrics.BYTES_RECEIVED.inc(value=len(data))
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'From {addr} {len(data)} bytes : {hexdump.dump(data)}')
+      msgType = MsgId(data[8]).name if len(data) > 8 else MsgId.UNKNOWN_ID.name # for the metrics, before the message is decoded
       try:
-        self.handleMsg(data,addr)
+        with metrics.HANDLER_SECONDS.time(msgType), getProfiler().section('udp',msgType):
+          self.handleMsg(data,addr)
       except Exception:
+        metrics.HANDLER_ERRORS.inc(msgType)
         logger.error(traceback.format_exc())
         time.sleep(1)
+    self.sock.close()
+    logger.info('UDP server has stopped')
+
+  def shutdown(self):
+    # Stops the server, shutting down the socket wakes the thread blocked in recvfrom
+    self.stop = True
+    if self.sock is not None:
+      try:
+        self.sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass                      # not connected, but recvfrom is woken anyway
+
+  def housekeeping(self):
+    # Removes stale entries so memory use stays flat over a long uptime
+    peers, devices = evictStale()
+    for deviceid, deviceStatus in devices.items():
+      getCommandTable().forget(deviceid)
+      self.liveness.forget(deviceid)
+      self.downlink.forget(deviceid)
+      discardDevice(deviceid,deviceStatus['rooms'])
+      if self.statusTable is not None:
+        for room in deviceStatus['rooms']:
+          self.statusTable.remove(deviceid,room)
+    purged = getCommandTable().purge()
+    if peers or devices:
+      invalidatePeers()
+      logger.info(f'Removed {len(peers)} stale peers and devices {sorted(devices)}')
+    logger.debug(f'Purged {purged} command results')
+
+  def writeStatus(self,deviceid,room,roomStatus):
+    # Publishes a change of the room status to the shared memory status table and the view cache
+    if self.statusTable is not None:
+      self.statusTable.write(deviceid,room,roomStatus)
+    invalidateRoom(deviceid,room)
+
+  def sendto(self,buf,addr,msgType):
+    metrics.MESSAGES_SENT.inc(MsgId(msgType).name)
+    self.sock.sendto(buf,addr)
+
+  def transmit(self,deviceid,cseq,buf,addr,msgType,expectResponse=True):
+    # Send a request, retransmitting it until the device responds if a response is expected (see CommandTable)
+    # A response to the device (expectResponse False) is only sent once, and never attached to a pending command
+    # which happens to have the same cseq or tag, eg a PROGRAM write for the same room/day
+    if not expectResponse:
+      self.sendto(buf,addr,msgType)
+      return
+    getCommandTable().transmit(deviceid,cseq,lambda: self.sendto(buf,addr,msgType))
+
+  def getMetrics(self):
+    # Returns the metrics in the Prometheus text format
+    metrics.DEVICES.set(len(getStatus()['devices']))
+    metrics.PEERS.set(len(getStatus()['peers']))
+    metrics.COMMANDS_PENDING.set(len(getCommandTable().pending()))
+    return metrics.getRegistry().render()
+
+  def query(self,deviceid,msgType,room=None,wait=COMMAND_TIMEOUT):
+    # Read a value from the device
+    # Concurrent callers share one request and the result is cached for a short time (see QueryCache)
+    device = getDeviceStatus(deviceid)
+    addr = device['addr']
+    if msgType==MsgId.DEVICE_TIME:
+      fn = lambda: self.send_DEVICE_TIME(addr,device,deviceid,0,response=0,write=0,wait=wait)
+    elif msgType==MsgId.SWVERSION:
+      fn = lambda: self.send_SWVERSION(addr,device,deviceid,response=0,wait=wait)
+    elif msgType==MsgId.GET_PROG:
+      fn = lambda: self.send_GET_PROG(addr,device,deviceid,room,response=0,wait=wait)
+    else:
+      raise ValueError(f'Unsupported query {msgType}')
+    return self.queries.do((deviceid,msgType,room),fn)
+
+  def findCommand(self,deviceid,cseq):
+    cmd = getCommandTable().find(deviceid,cseq)
+    return cmd.toJson() if cmd is not None else None
+
+  def getCommand(self,id):
+    cmd = getCommandTable().get(id)
+    return cmd.toJson() if cmd is not None else None
+
+  def getLinkStats(self,deviceid):
+    return getCommandTable().getStats(deviceid).toJson()
+
+  def startProfile(self,kind,seconds,targets):
+    # See profiling.py, the REST handlers are only profiled if they run in this process
+    return getProfiler().start(kind,seconds,targets)
+
+  def getProfile(self):
+    return getProfiler().status()
+
+  def getProfileData(self,format):
+    return getProfiler().data(format)
+
+  def getLiveRooms(self,deviceid):
+    return self.liveness.liveRooms(deviceid)
+
+  def getEvents(self,since=0):
+    return self.liveness.getEvents(since)
+
+  def scheduledSet(self,deviceid,room,msgType,value):
+    device = getDeviceStatus(deviceid)
+    rc = self.send_SET(device['addr'],device,deviceid,room,msgType,value,response=0,write=1,wait=COMMAND_TIMEOUT)
+    if rc!=value:
+      raise RuntimeError(f'Device returned {rc}')
+
+  def scheduleSet(self,deviceid,room,param,msgType,value,when):
+    # Set a parameter of the room at time when, replacing any change already scheduled for the parameter
+    # Returns None if the room is unknown or the address of the device is not known yet, so it could not be sent
+    deviceStatus = getStatus()['devices'].get(deviceid)
+    if deviceStatus is None or 'addr' not in deviceStatus or room not in deviceStatus['rooms']:
+      return None
+    key = ('set',deviceid,room,param)
+    getScheduler().schedule(key,when,self.scheduledSet,deviceid,room,msgType,value,description=f'Set {param} to {value}')
+    return getScheduler().get(key)
+
+  def getScheduled(self,deviceid,room):
+    # Changes scheduled for the room, including the end of a fake boost
+    return getScheduler().list(lambda key: isinstance(key,tuple) and key[0] in ('set','fakeboost') and key[1:3]==(deviceid,room))
+
+  def cancelScheduled(self,deviceid,room,param):
+    return getScheduler().cancel(('set',deviceid,room,param))
+
+  def dumpScheduled(self):
+    # The scheduled changes, to be saved with the state (see persist.py)
+    return [ { 'deviceid' : deviceid, 'room' : room, 'param' : key[3], 'msgType' : int(msgType), 'value' : value, 'at' : due }
+             for key,due,(deviceid,room,msgType,value) in getScheduler().pending(lambda key: isinstance(key,tuple) and key[0]=='set') ]
+
+  def restoreScheduled(self,changes):
+    # Schedules the changes returned by dumpScheduled(), those which are overdue are made straight away
+    for change in changes:
+      if self.scheduleSet(change['deviceid'],change['room'],change['param'],change['msgType'],change['value'],change['at']) is None:
+        logger.warning(f'Dropped the change of {change["param"]} scheduled for unknown room {change["deviceid"]}/{change["room"]}')
+
+  def setDeviceLocation(self,deviceid,location):
+    with getStatusLock():
+      getDeviceStatus(deviceid)['location'] = location
+    invalidateDevice(deviceid)
 
   def send_PING(self,addr,deviceid,response=0):
     cseq = UNUSED_CSEQ
@@ -432,11 +619,12 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHIH',cseq,unk1,unk2,deviceid,unk3)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.PING,response,write=1)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.sendto(buf,addr,wrapper.msgType)
 
   def send_GET_PROG(self,addr,device,deviceid,room,response=0,wait=0):
     cseq = NextCSeq(device,wait)
@@ -446,11 +634,12 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHIII',cseq,unk1,unk2,deviceid, room, unk3)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.GET_PROG,response,write=0)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
     return WaitCSeq(device,cseq)
 
   def send_SWVERSION(self,addr,device,deviceid,response=0,wait=0):
@@ -460,26 +649,52 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHI',cseq,unk1,unk2,deviceid)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.SWVERSION,response,write=0)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
     return WaitCSeq(device,cseq)
 
-  def send_PROGRAM(self,addr,device,deviceid,room,day,prog,response=0,write=0,wait=0):
+  def send_PROGRAM(self,addr,device,deviceid,room,day,prog,response=0,write=0,wait=0,block=True):
+    # If block is False then the request is sent and the tag identifying the response is returned without waiting
     cseq = UNUSED_CSEQ
+    tag = ProgTag(room,day)
+    if wait:
+      getCommandTable().add(deviceid,tag,wait)
     unk1 = 0x0 # Always zero in DL
     unk2 = 0x0
     payload = struct.pack('<BBHIIH24B',cseq,unk1,unk2,deviceid,room,day,*prog)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.PROGRAM,response,write=write)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
-    return WaitCSeq(device,cseq)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,tag,buf,addr,wrapper.msgType,expectResponse=response==0)
+    if not wait:
+      return None
+    if not block:
+      return tag
+    return WaitCSeq(device,tag)
+
+  def send_PROGRAMs(self,addr,device,deviceid,room,days,wait=COMMAND_TIMEOUT):
+    # Write the program for several days of a room, eg a whole week
+    # days is { day : prog }, and only the days which differ from the cached program are sent
+    # The requests are paced by the downlink scheduler, and then the responses are waited for together
+    # Returns { day : <program returned by the device (None on timeout)> } for the days which were sent
+    with getStatusLock():
+      cached = dict(getRoomStatus(deviceid,room)['days'])
+    changed = [ day for day in sorted(days) if cached.get(day)!=list(days[day]) ]
+    commands = getCommandTable()
+    for n,day in enumerate(changed):
+      # Later days wait in the downlink queue before they are sent, so allow for that in their timeout
+      commands.add(deviceid,ProgTag(room,day),wait+n*self.downlink.spacing)
+      self.downlink.enqueue(deviceid,self.send_PROGRAM,addr,device,deviceid,room,day,days[day],0,1)
+    vals = WaitCSeqs(device,[ ProgTag(room,day) for day in changed ])
+    return { day : vals[ProgTag(room,day)] for day in changed }
 
   def send_STATUS(self,addr,deviceid,lastseen,response=0):
     cseq = UNUSED_CSEQ
@@ -488,14 +703,16 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHII',cseq,unk1,unk2,deviceid,lastseen)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.STATUS,response,write=1)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.sendto(buf,addr,wrapper.msgType)
 
-  def send_SET(self,addr,device,deviceid,room,msgType,value,response=0,write=0,wait=0,numBytes=None):
-    logger.info(f'send_SET addr={addr} deviceid={deviceid} room={room} msgType={msgType} value={value}')
+  def send_SET(self,addr,device,deviceid,room,msgType,value,response=0,write=0,wait=0,numBytes=None,block=True):
+    # If block is False then the request is sent and the cseq is returned without waiting for the response
+    logger.info('send_SET addr=%s deviceid=%s room=%s msgType=%s value=%s',addr,deviceid,room,msgType,value)
     cseq = NextCSeq(device,wait)
     flags = 0x0 # Always zero in DL
     unk2 = 0x0
@@ -516,13 +733,25 @@ class UdpServer(threading.Thread):
 
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(msgType,response,write=write)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
+    if not block:
+      return cseq
     return WaitCSeq(device,cseq)
 
+  def send_SETs(self,addr,device,deviceid,room,values,wait=COMMAND_TIMEOUT):
+    # Pipeline several SET requests to the same room, each with its own cseq,
+    # and then wait for all the responses together
+    # values is a list of (msgType,value)
+    # Returns a list with the value returned by the device for each request (None on timeout)
+    cseqs = [ self.send_SET(addr,device,deviceid,room,msgType,value,response=0,write=1,wait=wait,block=False) for msgType,value in values ]
+    vals = WaitCSeqs(device,cseqs)
+    return [ vals[cseq] for cseq in cseqs ]
+
   def send_REFRESH(self,addr,device,deviceid,response=0,wait=0):
     cseq = NextCSeq(device,wait)
     unk1 = 0x0 # Always zero in DL
@@ -530,11 +759,12 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHI',cseq,unk1,unk2,deviceid)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.REFRESH,response,write=0)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
     return WaitCSeq(device,cseq)
 
   def send_OUTSIDE_TEMP(self,addr,device,deviceid,val,response=0,write=0,wait=0):
@@ -545,14 +775,18 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHIB',cseq,unk1,unk2,deviceid,unk3)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.OUTSIDE_TEMP,response,write=write)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
     return WaitCSeq(device,cseq)
 
-  def send_DEVICE_TIME(self,addr,device,deviceid,val,response=0,write=0,wait=0):
+  def send_DEVICE_TIME(self,addr,device,deviceid,val,response=0,write=0,wait=0,block=True):
+    # If block is False then the request is sent and the cseq is returned without waiting for the response
+    if write:
+      self.queries.invalidate((deviceid,MsgId.DEVICE_TIME,None))
     cseq = NextCSeq(device,wait)
     unk1 = 0x0 # Always zero in DL
     unk2 = 0x0
@@ -561,11 +795,14 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHIII',cseq,unk1,unk2,deviceid,unk3,unk4)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.DEVICE_TIME,response,write=write)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.transmit(deviceid,cseq,buf,addr,wrapper.msgType,expectResponse=response==0)
+    if not block:
+      return cseq
     return WaitCSeq(device,cseq)
 
   def send_PROG_END(self,addr,deviceid,room,response=0):
@@ -576,11 +813,12 @@ class UdpServer(threading.Thread):
     payload = struct.pack('<BBHIIH',cseq,unk1,unk2,deviceid,room,unk3)
     wrapper = Wrapper(payload=payload)
     payload = wrapper.encodeDL(MsgId.PROG_END,response,write=0)
-    logger.info(f'Sending {wrapper}')
+    logger.info('Sending %s',wrapper)
     frame = Frame(payload=payload)
     buf = frame.encode()
-    logger.info(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
-    self.sock.sendto(buf,addr)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f'To {addr} {len(buf)} bytes : {hexdump.dump(buf)}')
+    self.sendto(buf,addr,wrapper.msgType)
 
   def send_FAKE_BOOST(self,addr,device,deviceid,room,val):
     # I cannot see a way to control BOOST mode remotely. Instead we implement a fake boost mode
@@ -590,25 +828,34 @@ class UdpServer(threading.Thread):
     if 'fakeboost' in roomStatus:
       if val == 0 and roomStatus['fakeboost']!=0 and roomStatus['mode']==HeatingMode.PARTY and roomStatus['settemp']>=roomStatus['t1']:
         new_t3 = roomStatus['t3'] - FAKEBOOST_TEMPERATURE_RISE
-        rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_T3,new_t3,response=0,write=1,wait=1)
+        rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_T3,new_t3,response=0,write=1,wait=COMMAND_TIMEOUT)
         if rc==new_t3:
-          rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_MODE,HeatingMode.AUTO,response=0,write=1,wait=1)
+          rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_MODE,HeatingMode.AUTO,response=0,write=1,wait=COMMAND_TIMEOUT)
           if rc==0:
             roomStatus['fakeboost'] = 0
+            self.writeStatus(deviceid,room,roomStatus)
+            getScheduler().cancel(('fakeboost',deviceid,room))
           return rc
       elif val == 1 and roomStatus['fakeboost']==0 and roomStatus['mode']==HeatingMode.AUTO and roomStatus['boost']==0 and roomStatus['advance']==0 and roomStatus['settemp']>=roomStatus['t1']:
         new_t3 = roomStatus['t3'] + FAKEBOOST_TEMPERATURE_RISE
-        rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_T3,new_t3,response=0,write=1,wait=1)
+        rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_T3,new_t3,response=0,write=1,wait=COMMAND_TIMEOUT)
         if rc==new_t3:
-          rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_MODE,HeatingMode.PARTY,response=0,write=1,wait=1)
+          rc = self.send_SET(addr,device,deviceid,room,MsgId.SET_MODE,HeatingMode.PARTY,response=0,write=1,wait=COMMAND_TIMEOUT)
           if rc==3:
             roomStatus['fakeboost'] = time.time() + FAKEBOOST_DURATION
+            self.writeStatus(deviceid,room,roomStatus)
+            getScheduler().schedule(('fakeboost',deviceid,room),roomStatus['fakeboost'],self.endFakeBoost,deviceid,room,description='End fake boost')
             return 1
           else:
             return 0
     return 0
 
-  def set_messages_payload_size(self,msgType):
+  def endFakeBoost(self,deviceid,room):
+    device = getDeviceStatus(deviceid)
+    self.send_FAKE_BOOST(device['addr'],device,deviceid,room,0)
+
+  @staticmethod
+  def set_messages_payload_size(msgType):
     if msgType==MsgId.SET_T3 or msgType==MsgId.SET_T2 or msgType==MsgId.SET_T1 or msgType==MsgId.SET_MIN_HEAT_SETP or msgType==MsgId.SET_MAX_HEAT_SETP:
       return 2
     elif msgType==MsgId.SET_UNITS or msgType==MsgId.SET_SEASON or msgType==MsgId.SET_SENSOR_INFLUENCE or msgType==MsgId.SET_CURVE or msgType==MsgId.SET_ADVANCE or msgType==MsgId.SET_MODE:
@@ -620,11 +867,17 @@ class UdpServer(threading.Thread):
 
     frame = Frame()
     payload = frame.decode(data)
+    if payload is None:
+      metrics.DECODE_ERRORS.inc()
+      return
     seq = frame.seq
     length=len(payload)
 
-    peerStatus = getPeerStatus(addr)
-    peerStatus['seq'] = seq # @todo handle sequence number
+    with getStatusLock():
+      peerStatus = getPeerStatus(addr)
+      peerStatus['seq'] = seq # @todo handle sequence number
+      peerStatus['lastseen'] = int(time.time())
+    invalidatePeers()
 
     # Now handle the payload
 
@@ -632,19 +885,18 @@ class UdpServer(threading.Thread):
     payload = wrapper.decodeUL(payload)
 
     msgLen = len(payload)
-    logger.info(f'{seq=} {wrapper} {length=} {msgLen=}')
+    logger.info('seq=%s %s length=%s msgLen=%s',seq,wrapper,length,msgLen)
 
     unpack = Unpacker(payload)
 
     if wrapper.msgType==MsgId.STATUS:
       cseq, unk1, unk2, deviceid = unpack('<BBHI')
-      logger.info(f'{cseq=:x} {unk1=:x} {unk2=:x} {deviceid=}')
+      logger.info('cseq=%x unk1=%x unk2=%x deviceid=%s',cseq,unk1,unk2,deviceid)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
       rooms_to_get_prog = set() # Set of rooms for which we need to get the current program
+      samples = [] # (room,temp,settemp,heating) to log in the database
 
       for n in range(8):        # Supports up to 8 thermostats
         room, byte1, byte2, temp, settemp, t3, t2, t1, maxsetp, minsetp = unpack('<IBBhhhhhhh')
@@ -661,7 +913,8 @@ class UdpServer(threading.Thread):
 
         # Assume that if room is zero, 0xffffffff or byte1 is zero, then no thermostat is connected for that room
         if room!=0 and room!=0xffffffff and byte1!=0:
-          logger.info(f'{room=:x} {byte1=:x} {mode=} {temp=} {settemp=} {t3=} {t2=} {t1=} {maxsetp=} {minsetp=} {sensorinfluence=} {units=} {advance=} {boost=} {cmdissued=} {winter=} {tempcurve=} {heatingsetp=}')
+          logger.info('room=%x byte1=%x mode=%s temp=%s settemp=%s t3=%s t2=%s t1=%s maxsetp=%s minsetp=%s sensorinfluence=%s units=%s advance=%s boost=%s cmdissued=%s winter=%s tempcurve=%s heatingsetp=%s',
+                      room,byte1,mode,temp,settemp,t3,t2,t1,maxsetp,minsetp,sensorinfluence,units,advance,boost,cmdissued,winter,tempcurve,heatingsetp)
           if byte1==0x8f:
             heating = 1
           elif byte1==0x83:
@@ -670,46 +923,48 @@ class UdpServer(threading.Thread):
             logger.warn(f'Unexpected {byte1=:x}')
             heating = None
 
-          roomStatus = getRoomStatus(deviceid,room)
-
-          roomStatus['heating'] = heating
-          roomStatus['temp'] = temp
-          roomStatus['settemp'] = settemp
-          roomStatus['t3'] = t3
-          roomStatus['t2'] = t2
-          roomStatus['t1'] = t1
-          roomStatus['maxsetp'] = maxsetp
-          roomStatus['minsetp'] = maxsetp
-          roomStatus['mode'] = mode
-          roomStatus['tempcurve'] = tempcurve
-          roomStatus['heatingsetp'] = heatingsetp
-          roomStatus['sensorinfluence'] = sensorinfluence
-          roomStatus['units'] = units
-          roomStatus['advance'] = advance
-          roomStatus['boost'] = boost
-          roomStatus['cmdissued'] = cmdissued
-          roomStatus['winter'] = winter
-
-          roomStatus['lastseen'] = int(time.time())
-
-          if self.db is not None:
-            # @todo log other parameters..
-            self.db.log_temperature(room,temp/10.0,settemp/10.0,heating,conn=self.dbConn)
-            self.dbConn.commit()
+          with getStatusLock():
+            roomStatus = getRoomStatus(deviceid,room)
+
+            roomStatus['heating'] = heating
+            roomStatus['temp'] = temp
+            roomStatus['settemp'] = settemp
+            roomStatus['t3'] = t3
+            roomStatus['t2'] = t2
+            roomStatus['t1'] = t1
+            roomStatus['maxsetp'] = maxsetp
+            roomStatus['minsetp'] = maxsetp
+            roomStatus['mode'] = mode
+            roomStatus['tempcurve'] = tempcurve
+            roomStatus['heatingsetp'] = heatingsetp
+            roomStatus['sensorinfluence'] = sensorinfluence
+            roomStatus['units'] = units
+            roomStatus['advance'] = advance
+            roomStatus['boost'] = boost
+            roomStatus['cmdissued'] = cmdissued
+            roomStatus['winter'] = winter
+
+            roomStatus['lastseen'] = int(time.time())
+          self.liveness.seen(deviceid,room,roomStatus['lastseen'])
+
+          if 'fakeboost' not in roomStatus:
+            roomStatus['fakeboost'] = 0
+          self.writeStatus(deviceid,room,roomStatus)
+
+          # @todo log other parameters..
+          samples.append((room,temp/10.0,settemp/10.0,heating))
 
           if len(roomStatus['days'])!=7 or wrapper.cloudsynclost:
             rooms_to_get_prog.add(room)
 
           # Handle fake boost timer
-          if 'fakeboost' in roomStatus:
-            if roomStatus['fakeboost']!=0 and roomStatus['fakeboost']<time.time():
-              # Call send_FAKE_BOOST but this needs to be done from a new thread
-              # because it is blocking.
-              #self.send_FAKE_BOOST(addr,deviceStatus,deviceid,room,0)
-              thread = threading.Thread(target=self.send_FAKE_BOOST, args=(addr,deviceStatus,deviceid,room,0))
-              thread.start()
-          else:
-            roomStatus['fakeboost'] = 0
+          if roomStatus['fakeboost']!=0 and roomStatus['fakeboost']<time.time():
+            # The end of the fake boost is normally scheduled when it starts, but it may
+            # have been missed (eg after a restart) or failed, so schedule it now unless it is already running
+            getScheduler().schedule(('fakeboost',deviceid,room),time.time(),self.endFakeBoost,deviceid,room,replace=False,description='End fake boost')
+
+      if self.db is not None and samples:
+        self.db.log_temperatures(samples,conn=self.dbConn) # one commit for all the rooms
 
       # OpenTherm parameters
       # From the manual we expect the following to be present somewhere:
@@ -731,26 +986,29 @@ class UdpServer(threading.Thread):
       boilerHeating = (otFlags1>>5) & 0x1
       dhwMode = (otFlags1>>6) & 0x1
 
-      deviceStatus['boilerOn'] = boilerHeating
-      deviceStatus['dhwMode'] = dhwMode
-
       otUnk1, otUnk2, tFLO, otUnk4, tdH, tESt, otUnk7, otUnk8, otUnk9, otUnk10 = unpack('<hhhhhhhhhh')
 
-      deviceStatus['tFLO'] = tFLO
-      deviceStatus['tdH'] = tdH
-      deviceStatus['tESt'] = tESt
-
       # Other params
 
       wifisignal, unk16, unk17, unk18, unk19, unk20 = unpack('<BBHHHH')
 
-      deviceStatus['wifisignal'] = wifisignal
-      deviceStatus['lastseen'] = int(time.time())
+      with getStatusLock():
+        deviceStatus['boilerOn'] = boilerHeating
+        deviceStatus['dhwMode'] = dhwMode
+
+        deviceStatus['tFLO'] = tFLO
+        deviceStatus['tdH'] = tdH
+        deviceStatus['tESt'] = tESt
+
+        deviceStatus['wifisignal'] = wifisignal
+        deviceStatus['lastseen'] = int(time.time())
+      invalidateDevice(deviceid)
+      self.liveness.seen(deviceid,None,deviceStatus['lastseen'])
 
-      logger.info(getStatus())
 
       # Send a DL STATUS message
       self.send_STATUS(addr,deviceid,deviceStatus['lastseen'],response=1)
+      self.downlink.touch(deviceid)
 
       if wrapper.cloudsynclost:
         #time.sleep(1) # embedded device may not handle lots of messages in a short time
@@ -762,20 +1020,18 @@ class UdpServer(threading.Thread):
         pass
 
       # Fetch updated program for any rooms in rooms_to_get_prog set
+      # These are paced by the downlink scheduler since the embedded device may not handle lots of messages in a short time
       for room in rooms_to_get_prog:
-        time.sleep(1) # embedded device may not handle lots of messages in a short time
-        self.send_GET_PROG(addr,deviceStatus,deviceid,room,response=0)
+        self.downlink.enqueue(deviceid,self.send_GET_PROG,addr,deviceStatus,deviceid,room,key=(MsgId.GET_PROG,room))
 
     elif wrapper.msgType==MsgId.GET_PROG:
       cseq, unk1, unk2, deviceid, room, unk3 = unpack('<BBHIII')
 
-      logger.info(f'{deviceid=} {room=}')
+      logger.info('deviceid=%s room=%s',deviceid,room)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
-      if cseq != LastCSeq(deviceStatus):
+      if not ExpectedCSeq(deviceStatus,cseq):
         logger.warn(f'Unexpected {cseq=:x}')
 
       if unk1 != 0x2:
@@ -793,11 +1049,9 @@ class UdpServer(threading.Thread):
     elif wrapper.msgType==MsgId.PING:
       cseq, unk1, unk2, deviceid, unk3 = unpack('<BBHIH')
 
-      logger.info(f'{deviceid=}')
+      logger.info('deviceid=%s',deviceid)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
       if cseq != UNUSED_CSEQ:
         logger.warn(f'Unexpected {cseq=}')
@@ -818,13 +1072,11 @@ class UdpServer(threading.Thread):
     elif wrapper.msgType==MsgId.REFRESH:
       cseq, unk1, unk2, deviceid = unpack('<BBHI')
       # Padding at end ??
-      logger.info(f'{deviceid=}')
+      logger.info('deviceid=%s',deviceid)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
-      if cseq != LastCSeq(deviceStatus):
+      if not ExpectedCSeq(deviceStatus,cseq):
         logger.warn(f'Unexpected {cseq}')
 
       if unk1 != 0x2:
@@ -841,13 +1093,11 @@ class UdpServer(threading.Thread):
       # 0 = no dst 1 = dst ?
       # The rest of the payload appears to be garbage?
       cseq, unk1, unk2, deviceid, val, unk3, unk4, unk5 = unpack('<BBHIBBHI')
-      logger.info(f'{deviceid=} {val=}')
+      logger.info('deviceid=%s val=%s',deviceid,val)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
-      if cseq != LastCSeq(deviceStatus):
+      if not ExpectedCSeq(deviceStatus,cseq):
         logger.warn(f'Unexpected {cseq=}')
 
       if unk1 != 0x2:
@@ -871,13 +1121,11 @@ class UdpServer(threading.Thread):
     elif wrapper.msgType==MsgId.OUTSIDE_TEMP:
       cseq, unk1, unk2, deviceid, val = unpack('<BBHIB')
 
-      logger.info(f'{deviceid=} {val=}')
+      logger.info('deviceid=%s val=%s',deviceid,val)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
-      if cseq != LastCSeq(deviceStatus):
+      if not ExpectedCSeq(deviceStatus,cseq):
         logger.warn(f'Unexpected {cseq=}')
 
       if unk1 != 0x2:
@@ -895,11 +1143,9 @@ class UdpServer(threading.Thread):
 
     elif wrapper.msgType==MsgId.PROG_END:
       cseq, unk1, unk2, deviceid, room, unk3 = unpack('<BBHIIH')
-      logger.info(f'{deviceid=} {room=} {unk3=:x}')
+      logger.info('deviceid=%s room=%s unk3=%x',deviceid,room,unk3)
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
       if cseq != UNUSED_CSEQ:
         logger.warn(f'Unexpected {cseq=}')
@@ -919,14 +1165,13 @@ class UdpServer(threading.Thread):
 
     elif wrapper.msgType==MsgId.SWVERSION:
       cseq, unk1, unk2, deviceid, version = unpack('<BBHI13s')
-      logger.info(f'{deviceid=} {version=}')
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      logger.info('deviceid=%s version=%r',deviceid,version)
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
       deviceStatus['version'] = str(version)
+      invalidateDevice(deviceid)
 
-      if cseq != LastCSeq(deviceStatus):
+      if not ExpectedCSeq(deviceStatus,cseq):
         logger.warn(f'Unexpected {cseq=}')
 
       if unk1 != 0x2:
@@ -946,15 +1191,20 @@ class UdpServer(threading.Thread):
       for i in range(24):
         p, = unpack('<B')
         prog.append(p)
-      logger.info(f'{deviceid=} {room=} {day=} prog={ [ hex(l) for l in prog ] }')
+      if logger.isEnabledFor(logging.INFO):
+        logger.info('deviceid=%s room=%s day=%s prog=%s',deviceid,room,day,[ hex(l) for l in prog ])
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
-      roomStatus = getRoomStatus(deviceid,room)
-      roomStatus['days'][day] = prog
-      logger.info(getStatus())
+      with getStatusLock():
+        roomStatus = getRoomStatus(deviceid,room)
+        roomStatus['days'][day] = prog
+      invalidateRoom(deviceid,room)
+
+      # Only a response completes a pending request for the room/day, not a PROGRAM the device
+      # sends on its own (eg when the program is changed on the thermostat)
+      if wrapper.response==1 and cseq==UNUSED_CSEQ:
+        SignalCSeq(deviceStatus,ProgTag(room,day),prog)
 
       if cseq != UNUSED_CSEQ:
         logger.warn(f'Unexpected {cseq=}')
@@ -986,37 +1236,38 @@ class UdpServer(threading.Thread):
         logger.warn(f'Unrecognised MsgType {wrapper.msgType:x}')
         value = None
 
-      deviceStatus = getDeviceStatus(deviceid)
-      peerStatus['devices'].add(deviceid)
-      deviceStatus['addr'] = addr
+      deviceStatus = setDeviceAddr(deviceid,addr)
 
       roomStatus = getRoomStatus(deviceid,room)
 
-      logger.info(f'{cseq=} {deviceid=} {room=} {value=}')
+      logger.info('cseq=%s deviceid=%s room=%s value=%s',cseq,deviceid,room,value)
 
       # Update the device status with the updated value
-      if wrapper.msgType == MsgId.SET_T1:
-        roomStatus['t1'] = value
-      elif wrapper.msgType == MsgId.SET_T2:
-        roomStatus['t2'] = value
-      elif wrapper.msgType == MsgId.SET_T3:
-        roomStatus['t3'] = value
-      elif wrapper.msgType == MsgId.SET_MIN_HEAT_SETP:
-        roomStatus['minsetp'] = value
-      elif wrapper.msgType == MsgId.SET_MAX_HEAT_SETP:
-        roomStatus['maxsetp'] = value
-      elif wrapper.msgType == MsgId.SET_UNITS:
-        roomStatus['units'] = value
-      elif wrapper.msgType == MsgId.SET_SEASON:
-        roomStatus['winter'] = value
-      elif wrapper.msgType == MsgId.SET_ADVANCE:
-        roomStatus['advance'] = value
-      elif wrapper.msgType == MsgId.SET_MODE:
-        roomStatus['mode'] = value
-      elif wrapper.msgType == MsgId.SET_SENSOR_INFLUENCE:
-        roomStatus['sensorinfluence'] = value
-      elif wrapper.msgType == MsgId.SET_CURVE:
-        roomStatus['tempcurve'] = value
+      with getStatusLock():
+        if wrapper.msgType == MsgId.SET_T1:
+          roomStatus['t1'] = value
+        elif wrapper.msgType == MsgId.SET_T2:
+          roomStatus['t2'] = value
+        elif wrapper.msgType == MsgId.SET_T3:
+          roomStatus['t3'] = value
+        elif wrapper.msgType == MsgId.SET_MIN_HEAT_SETP:
+          roomStatus['minsetp'] = value
+        elif wrapper.msgType == MsgId.SET_MAX_HEAT_SETP:
+          roomStatus['maxsetp'] = value
+        elif wrapper.msgType == MsgId.SET_UNITS:
+          roomStatus['units'] = value
+        elif wrapper.msgType == MsgId.SET_SEASON:
+          roomStatus['winter'] = value
+        elif wrapper.msgType == MsgId.SET_ADVANCE:
+          roomStatus['advance'] = value
+        elif wrapper.msgType == MsgId.SET_MODE:
+          roomStatus['mode'] = value
+        elif wrapper.msgType == MsgId.SET_SENSOR_INFLUENCE:
+          roomStatus['sensorinfluence'] = value
+        elif wrapper.msgType == MsgId.SET_CURVE:
+          roomStatus['tempcurve'] = value
+
+      self.writeStatus(deviceid,room,roomStatus)
 
       if unk2 != 0x1:
         logger.warn(f'Unexpected {unk2=:x}')
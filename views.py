@@ -0,0 +1,65 @@
+import json
+import threading
+
+#
+# Pre-rendered JSON responses for the status endpoints
+#
+# Each view is rendered to bytes once and reused until the entity it shows is
+# invalidated (by the UdpServer when it handles a message for that entity).
+#
+# Views are keyed by eg ('device',deviceid), ('room',deviceid,room), ('peers',)
+#
+
+class ViewCache():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.versions = {}            # key -> version, bumped on each invalidation
+    self.rendered = {}            # key -> (version,bytes)
+    self.generation = 0           # bumped by invalidateAll()
+
+  def invalidate(self,*keys):
+    with self.lock:
+      for key in keys:
+        self.versions[key] = self.versions.get(key,0) + 1
+
+  def invalidateAll(self):
+    with self.lock:
+      self.generation += 1
+
+  def render(self,key,build):
+    # Returns the JSON bytes for the view, calling build() to get the data if it has changed
+    with self.lock:
+      version = (self.generation,self.versions.get(key,0))
+      cached = self.rendered.get(key)
+    if cached is not None and cached[0] == version:
+      return cached[1]
+    body = json.dumps(build(),separators=(',',':')).encode()
+    with self.lock:
+      self.rendered[key] = (version,body)
+    return body
+
+  def discard(self,key):
+    with self.lock:
+      self.versions.pop(key,None)
+      self.rendered.pop(key,None)
+
+Views = ViewCache()
+
+def getViews():
+  return Views
+
+def invalidateDevice(deviceid):
+  Views.invalidate(('device',deviceid))
+
+def invalidateRoom(deviceid,room):
+  # The device view includes its rooms
+  Views.invalidate(('room',deviceid,room),('device',deviceid))
+
+def invalidatePeers():
+  Views.invalidate(('peers',))
+
+def discardDevice(deviceid,rooms=()):
+  # The device has been removed from the status
+  Views.discard(('device',deviceid))
+  for room in rooms:
+    Views.discard(('room',deviceid,room))
@@ -0,0 +1,374 @@
+import os
+import json
+import math
+import time
+import bisect
+import threading
+import logging
+import requests
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime, formatdate
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+#
+# Uses met.no to get the weather at the servers' (or devices') latitude, longitude
+# See https://api.met.no/doc/TermsOfService and https://api.met.no/doc/License
+#
+# Forecasts are cached per location, where locations are quantized to a grid
+# so nearby homes share the same forecast.
+# The forecasts are fetched by a background thread ahead of their expiry, and
+# requests are always served from the cache (even if it is stale) so a slow
+# or unavailable met.no never blocks a caller.
+# The cache is saved to disk so a restart does not need to fetch it again.
+#
+
+#
+# The met.no "complete" forecast is several hundred KB of JSON, so it is parsed
+# once into a compact forecast holding an array per variable we use.
+# Subsets of the forecast are rendered to JSON bytes once and then reused.
+#
+
+def _isoformat(ts):
+  return datetime.fromtimestamp(ts,timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _timestamp(iso):
+  return datetime.fromisoformat(iso.replace('Z','+00:00')).timestamp()
+
+class Forecast():
+  # Variables kept from the met.no timeseries: name -> (section of the timeseries entry, name in that section)
+  FIELDS = {
+    'air_temperature' : ('instant','air_temperature'),
+    'relative_humidity' : ('instant','relative_humidity'),
+    'wind_speed' : ('instant','wind_speed'),
+    'cloud_area_fraction' : ('instant','cloud_area_fraction'),
+    'air_pressure_at_sea_level' : ('instant','air_pressure_at_sea_level'),
+    'precipitation_amount' : ('next_1_hours','precipitation_amount'),
+  }
+  MAX_RENDERED = 32
+
+  def __init__(self,times,values,updated=None):
+    self.times = array('d',times)
+    self.values = { field : array('d',values[field]) for field in self.FIELDS }
+    self.updated = updated
+    self.lock = threading.Lock()
+    self.rendered = {}            # (start,hours,fields) -> bytes
+
+  @classmethod
+  def fromMetNo(cls,js):
+    times = []
+    values = { field : [] for field in cls.FIELDS }
+    for entry in js['properties']['timeseries']:
+      times.append(_timestamp(entry['time']))
+      for field, (section, name) in cls.FIELDS.items():
+        values[field].append(entry['data'].get(section,{}).get('details',{}).get(name,math.nan))
+    updated = js['properties'].get('meta',{}).get('updated_at')
+    return cls(times,values,updated)
+
+  @classmethod
+  def fromJson(cls,d):
+    return cls(d['times'],d['values'],d['updated'])
+
+  def toJson(self):
+    # For persisting the forecast
+    return { 'times' : list(self.times), 'values' : { field : list(v) for field,v in self.values.items() }, 'updated' : self.updated }
+
+  def index(self,ts=None):
+    # Index of the forecast entry covering ts (default now)
+    if ts is None:
+      ts = time.time()
+    return max(0,bisect.bisect_right(self.times,ts)-1)
+
+  def current(self,field='air_temperature'):
+    if len(self.times)==0:
+      return None
+    v = self.values[field][self.index()]
+    return None if math.isnan(v) else v
+
+  def render(self,hours=None,fields=None):
+    # Returns the forecast from now for the next hours as JSON bytes:
+    # { "updated" : ..., "time" : [ ... ], "<field>" : [ ... ], ... }
+    if fields is None:
+      fields = tuple(self.FIELDS)
+    start = self.index()
+    key = (start,hours,tuple(fields))
+    with self.lock:
+      body = self.rendered.get(key)
+    if body is not None:
+      return body
+
+    end = len(self.times)
+    if hours is not None:
+      end = bisect.bisect_left(self.times,self.times[start]+hours*3600) if start<end else end
+    js = { 'updated' : self.updated, 'time' : [ _isoformat(t) for t in self.times[start:end] ] }
+    for field in fields:
+      js[field] = [ None if math.isnan(v) else v for v in self.values[field][start:end] ]
+    body = json.dumps(js,separators=(',',':')).encode()
+
+    with self.lock:
+      if len(self.rendered) >= self.MAX_RENDERED:
+        self.rendered.clear()
+      self.rendered[key] = body
+    return body
+
+class WeatherLocation():
+  def __init__(self,latitude,longitude):
+    self.latitude = latitude
+    self.longitude = longitude
+    self.ready = threading.Event()
+    self.data = None
+    self.expires = 0
+    self.lastModified = None
+    self.nextRefresh = 0
+    self.lastUsed = time.time()
+
+  def toJson(self):
+    return { 'latitude' : self.latitude, 'longitude' : self.longitude, 'data' : self.data.toJson(), 'expires' : self.expires, 'lastModified' : self.lastModified }
+
+class WeatherService(threading.Thread):
+  URL = 'https://api.met.no/weatherapi/locationforecast/2.0/complete'
+  USER_AGENT = 'BeSim/0.1 github.com/jimmyH/BeSIM'
+  TIMEOUT = 10              # seconds for the HTTP request
+  DEFAULT_TTL = 3600        # seconds, if the response has no Expires header
+  REFRESH_AHEAD = 300       # seconds before expiry to refresh the forecast
+  RETRY = 300               # seconds before retrying a failed refresh
+  MIN_INTERVAL = 60         # minimum seconds between refreshes of a location
+  GRID = 0.05               # degrees, locations in the same grid cell share a forecast (~5km)
+  MAX_LOCATIONS = 64
+  IDLE_TTL = 2*86400        # seconds, locations which have not been used for this long are dropped
+
+  def __init__(self,url=URL,cachefile=None,onUpdate=None):
+    threading.Thread.__init__(self,daemon=True)
+    self.url = url
+    self.cachefile = cachefile
+    self.onUpdate = onUpdate
+    self.session = requests.Session()
+    self.session.headers['User-Agent'] = self.USER_AGENT
+    self.lock = threading.Lock()
+    self.wakeup = threading.Event()
+    self.stop = False
+    self.locations = OrderedDict()  # cell -> WeatherLocation, least recently used first
+    self.pinned = set()             # cells which are never dropped
+    self.load()
+
+  def cell(self,latitude,longitude):
+    return ( round(latitude/self.GRID), round(longitude/self.GRID) )
+
+  def location(self,latitude,longitude):
+    # Returns the cached location for the grid cell containing latitude, longitude
+    cell = self.cell(latitude,longitude)
+    with self.lock:
+      location = self.locations.get(cell)
+      if location is None:
+        # met.no asks for no more than 4 decimals
+        location = WeatherLocation(round(cell[0]*self.GRID,4),round(cell[1]*self.GRID,4))
+        self.locations[cell] = location
+        # Drop the least recently used cells beyond MAX_LOCATIONS, but never a pinned cell or this one
+        # (so if all MAX_LOCATIONS cells are pinned, one unpinned cell is kept beyond the limit)
+        evictable = [ old for old in self.locations if old not in self.pinned and old != cell ]
+        for old in evictable[:len(self.locations)-self.MAX_LOCATIONS]:
+          del self.locations[old]
+        self.wakeup.set()
+      self.locations.move_to_end(cell)
+      location.lastUsed = time.time()
+    return location
+
+  def pin(self,latitude,longitude):
+    # Keep refreshing this location even if it is not used
+    self.pinned.add(self.cell(latitude,longitude))
+    return self.location(latitude,longitude)
+
+  def load(self):
+    if self.cachefile is None or not os.path.exists(self.cachefile):
+      return
+    try:
+      with open(self.cachefile) as f:
+        cache = json.load(f)
+      for entry in cache['locations']:
+        location = WeatherLocation(entry['latitude'],entry['longitude'])
+        location.data = Forecast.fromJson(entry['data'])
+        location.expires = entry['expires']
+        location.lastModified = entry['lastModified']
+        location.nextRefresh = location.expires - self.REFRESH_AHEAD
+        location.ready.set()
+        self.locations[self.cell(location.latitude,location.longitude)] = location
+      logger.info(f'Loaded weather for {len(self.locations)} locations from {self.cachefile}')
+    except (OSError,ValueError,KeyError):
+      logger.exception(f'Failed to load weather cache {self.cachefile}')
+
+  def save(self):
+    if self.cachefile is None:
+      return
+    with self.lock:
+      cache = { 'locations' : [ location.toJson() for location in self.locations.values() if location.data is not None ] }
+    try:
+      tmp = f'{self.cachefile}.{os.getpid()}.tmp' # unique, in case another process saves the same cache
+      with open(tmp,'w') as f:
+        json.dump(cache,f)
+      os.replace(tmp,self.cachefile)
+    except OSError:
+      logger.exception(f'Failed to save weather cache {self.cachefile}')
+
+  def _expiry(self,r):
+    expires = r.headers.get('Expires')
+    if expires is not None:
+      try:
+        return parsedate_to_datetime(expires).timestamp()
+      except (TypeError,ValueError):
+        pass
+    return time.time() + self.DEFAULT_TTL
+
+  def refresh(self,location):
+    # Returns True if we have a valid forecast after the refresh
+    params = { 'lat':location.latitude, 'lon':location.longitude }
+    headers = {}
+    if location.data is not None and location.lastModified is not None:
+      headers['If-Modified-Since'] = location.lastModified
+    try:
+      r = self.session.get(self.url,params=params,headers=headers,timeout=self.TIMEOUT)
+    except requests.RequestException as e:
+      logger.warning(f'Failed to get weather: {e}')
+      return False
+
+    if r.status_code==200:
+      data = Forecast.fromMetNo(r.json())
+      with self.lock:
+        location.data = data
+        location.expires = self._expiry(r)
+        location.lastModified = r.headers.get('Last-Modified',formatdate(usegmt=True))
+    elif r.status_code==304 and location.data is not None:
+      with self.lock:
+        location.expires = self._expiry(r)
+    else:
+      logger.warning(f'Failed to get weather: {r.status_code}')
+      return False
+
+    self.save()
+    location.ready.set()
+    if self.onUpdate is not None:
+      try:
+        self.onUpdate(location)
+      except Exception:
+        logger.exception('Weather update callback failed')
+    return True
+
+  def get(self,latitude,longitude):
+    # Returns the cached Forecast (possibly stale) for the location, and the http status code
+    location = self.location(latitude,longitude)
+    if not location.ready.is_set():
+      # Nothing cached yet, wait for the first fetch
+      location.ready.wait(self.TIMEOUT)
+    with self.lock:
+      if location.data is None:
+        return None, 503
+      return location.data, 200
+
+  def shutdown(self):
+    self.stop = True
+    self.wakeup.set()
+
+  def run(self):
+    while not self.stop:
+      self.wakeup.clear()
+      now = time.time()
+      with self.lock:
+        for cell in [ cell for cell,location in self.locations.items() if location.lastUsed + self.IDLE_TTL < now and cell not in self.pinned ]:
+          del self.locations[cell]
+        locations = list(self.locations.values())
+
+      for location in locations:
+        if now >= location.nextRefresh:
+          if self.refresh(location):
+            location.nextRefresh = max(now + self.MIN_INTERVAL,location.expires - self.REFRESH_AHEAD)
+          else:
+            location.nextRefresh = now + self.RETRY
+
+      nextRefresh = min([ location.nextRefresh for location in locations ],default=now+self.RETRY)
+      self.wakeup.wait(max(0,nextRefresh-time.time()))
+
+class RemoteWeatherService():
+  # Stands in for the WeatherService in a REST worker process (see wsgi.py)
+  # Forecasts come from the engine over IPC, so only the engine fetches from met.no
+  # and writes the cache. A forecast is only sent again once it has been updated.
+  MAX_LOCATIONS = WeatherService.MAX_LOCATIONS
+
+  def __init__(self,remote):
+    self.remote = remote          # RemoteUdpServer
+    self.lock = threading.Lock()
+    self.forecasts = OrderedDict() # (latitude,longitude) -> Forecast, least recently used first
+
+  def get(self,latitude,longitude):
+    key = (latitude,longitude)
+    with self.lock:
+      cached = self.forecasts.get(key)
+    data, status = self.remote.getWeather(latitude,longitude,cached.updated if cached is not None else None)
+    if status != 200:
+      return None, status
+    forecast = Forecast.fromJson(data) if data is not None else cached
+    with self.lock:
+      self.forecasts[key] = forecast
+      self.forecasts.move_to_end(key)
+      while len(self.forecasts) > self.MAX_LOCATIONS:
+        self.forecasts.popitem(last=False)
+    return forecast, 200
+
+def getWeatherUpdate(latitude,longitude,updated=None):
+  # For the REST workers: returns the forecast for the location as JSON, or None if it
+  # is still the one updated at updated, and the http status code
+  data, status = getWeatherService().get(latitude,longitude)
+  if data is None:
+    return None, status
+  return (None if updated is not None and data.updated == updated else data.toJson()), status
+
+def getDefaultLocation():
+  # Returns the (latitude, longitude) configured in the environment, or None
+  try:
+    return float(os.getenv('LATITUDE',None)), float(os.getenv('LONGITUDE',None))
+  except (TypeError,ValueError):
+    return None
+
+def logOutsideTemperature(location):
+  # The outside temperature history is only kept for the servers' location
+  default = getDefaultLocation()
+  if default is None or Service.cell(*default) != Service.cell(location.latitude,location.longitude):
+    return
+  temp = location.data.current('air_temperature')
+  if temp is not None:
+    Database().log_outside_temperature(temp)
+
+Service = None
+ServiceLock = threading.Lock()
+
+def setWeatherService(service):
+  # Use service (eg a RemoteWeatherService) rather than fetching the weather in this process
+  global Service
+  with ServiceLock:
+    Service = service
+
+def getWeatherService(recordHistory=True):
+  # Creates (and starts) the weather service
+  # If recordHistory is set then the outside temperature is logged in the database
+  global Service
+  with ServiceLock:
+    if Service is None:
+      url = os.getenv('BESIM_WEATHER_URL',WeatherService.URL)
+      cachefile = os.getenv('BESIM_WEATHER_CACHE','besim_weather.json')
+      Service = WeatherService(url=url,cachefile=cachefile,onUpdate=logOutsideTemperature if recordHistory else None)
+      Service.start()
+      default = getDefaultLocation()
+      if default is not None:
+        Service.pin(*default)
+  return Service
+
+def getWeather(latitude=None,longitude=None):
+  # Returns the Forecast for the location (default is the servers' location), and the http status code
+  if latitude is None or longitude is None:
+    default = getDefaultLocation()
+    if default is None:
+      return None, 500
+    latitude, longitude = default
+  return getWeatherService().get(latitude,longitude)
@@ -0,0 +1,43 @@
+import os
+import logging
+
+from database import Database
+from restapi import app
+from ipc import RemoteUdpServer, StatusMirror
+from weather import setWeatherService, RemoteWeatherService
+from shmstatus import StatusTable, getStatusTablePath
+from logsetup import setupLogging
+from segmentstore import SegmentStore, getSegmentPath
+
+#
+# Entry point for running the REST API in worker processes under a WSGI server, eg
+#    gunicorn -w 4 -b 0.0.0.0:80 wsgi:app
+# The UDP server must be running in its own process, see BESIM_MODE=engine in app.py
+#
+
+logger = logging.getLogger(__name__)
+
+setupLogging()
+
+database_name=os.getenv('BESIM_DATABASE', 'besim.db')
+segmentPath = getSegmentPath()
+Database(name=database_name,store=SegmentStore(segmentPath) if segmentPath is not None else None)
+
+remote = RemoteUdpServer()
+
+# The engine process fetches the weather and records the outside temperature history
+setWeatherService(RemoteWeatherService(remote))
+mirror = StatusMirror(remote)
+app.config['udpServer'] = remote
+
+# Read the room status from shared memory if the UDP server provides it
+statusTablePath = getStatusTablePath()
+if statusTablePath is not None:
+  app.config['statusTable'] = StatusTable.open(statusTablePath)
+
+@app.before_request
+def refreshStatus():
+  try:
+    mirror.refresh()
+  except Exception:
+    logger.exception('Failed to refresh status from the UDP server') # serve the last known status